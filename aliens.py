@@ -5,7 +5,7 @@ Shows a mini game where you have to defend against aliens.
 
 What does it show you about pygame?
 
-* pg.sprite, the difference between Sprite and Group.
+* an entity-component-system (engine.World) instead of one Sprite per object.
 * dirty rectangle optimization for processing for speed.
 * music with pg.mixer.music, including fadeout
 * sound effects with pg.Sound
@@ -23,13 +23,24 @@ Controls
 
 """
 
+import argparse
 import os
 import random
+import time
 from typing import List
 
+STARTED = time.perf_counter()  # startup timing (TTFF/TTI) is measured from here
+
 # import basic pygame modules
 import pygame as pg
 
+import sampler
+import telemetry
+from engine import DESCEND, KILL_OUTSIDE, Archetype, Clip, Renderer, World, anchored, group_rects
+from governor import QualityGovernor
+from startup import AssetLoader, Startup, init_mixer, load_sound, play_music
+from waves import WaveCursor, WaveSchedule
+
 # see if we can load more than standard BMP
 if not pg.image.get_extended():
     raise SystemExit("Sorry, extended image module required")
@@ -37,12 +48,18 @@ if not pg.image.get_extended():
 
 # game constants
 MAX_SHOTS = 2  # most player bullets onscreen
-ALIEN_ODDS = 22  # chances a new alien appears
-BOMB_ODDS = 60  # chances a new bomb will drop
+ALIEN_ODDS = 22  # chances a new alien appears (level 0, gets lower every level)
+BOMB_ODDS = 60  # chances a new bomb will drop (level 0, gets lower every level)
 ALIEN_RELOAD = 12  # frames between new aliens
+LEVEL_TICKS = 800  # frames per level (20 seconds at 40fps)
 SCREENRECT = pg.Rect(0, 0, 640, 480)
 SCORE = 0
 
+# collision groups (bit masks)
+ALIENS = 1
+SHOTS = 2
+BOMBS = 4
+
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 
 
@@ -56,159 +73,128 @@ def load_image(file):
     return surface.convert()
 
 
-def load_sound(file):
-    """because pygame can be compiled without mixer."""
-    if not pg.mixer:
-        return None
-    file = os.path.join(main_dir, "data", file)
-    try:
-        sound = pg.mixer.Sound(file)
-        return sound
-    except pg.error:
-        print(f"Warning, unable to load, {file}")
-    return None
+def play_sound(sound, limit=None):
+    """plays a sound unless 'limit' copies of it are already playing"""
+    if pg.mixer and sound is not None and (limit is None or sound.get_num_channels() < limit):
+        sound.play()
 
 
-# Each type of game object gets an init and an update function.
-# The update function is called once per frame, and it is when each object should
-# change its current position and state.
+# Each type of game object is an Archetype: a handful of class attributes
+# (size, speed, what happens at the screen edge, lifetime, animation) that
+# the shared engine.World uses to move, bound, animate and expire every
+# entity of that type in one pass per frame.
 #
-# The Player object actually gets a "move" function instead of update,
-# since it is passed extra information about the keyboard.
+# The Player archetype also gets a "move" function, since it is passed
+# extra information about the keyboard.
 
 
-class Player(pg.sprite.Sprite):
+class Player(Archetype):
     """Representing the player as a moon buggy type car."""
 
     speed = 10
     bounce = 24
     gun_offset = -11
+    size = (90, 61)
     images: List[pg.Surface] = []
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=SCREENRECT.midbottom)
-        self.reloading = 0
-        self.origtop = self.rect.top
-        self.facing = -1
-
-    def move(self, direction):
-        if direction:
-            self.facing = direction
-        self.rect.move_ip(direction * self.speed, 0)
-        self.rect = self.rect.clamp(SCREENRECT)
+    @classmethod
+    def spawn(cls, world):
+        x, y = anchored(cls.size, midbottom=SCREENRECT.midbottom)
+        return world.spawn(cls, x, y)
+
+    @classmethod
+    def move(cls, world, eid, direction):
+        """The image (frame 0 or 1) doubles as the facing, left or right."""
+        world.move(eid, direction * cls.speed)
+        slot = world.slot_of[eid]
         if direction < 0:
-            self.image = self.images[0]
+            world.frame[slot] = 0
         elif direction > 0:
-            self.image = self.images[1]
-        self.rect.top = self.origtop - (self.rect.left // self.bounce % 2)
+            world.frame[slot] = 1
+        origtop = SCREENRECT.bottom - cls.size[1]
+        world.y[slot] = origtop - (world.x[slot] // cls.bounce % 2)
 
-    def gunpos(self):
-        pos = self.facing * self.gun_offset + self.rect.centerx
-        return pos, self.rect.top
+    @classmethod
+    def gunpos(cls, world, eid):
+        slot = world.slot_of[eid]
+        facing = 1 if world.frame[slot] else -1
+        pos = facing * cls.gun_offset + world.x[slot] + world.w[slot] // 2
+        return pos, world.y[slot]
 
 
-class Alien(pg.sprite.Sprite):
+class Alien(Archetype):
     """An alien space ship. That slowly moves down the screen."""
 
     speed = 13
-    animcycle = 12
+    clip = Clip((0, 1, 2), 12)
+    size = (80, 71)
+    groups = ALIENS
+    bounds = DESCEND
     images: List[pg.Surface] = []
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect()
-        self.facing = random.choice((-1, 1)) * Alien.speed
-        self.frame = 0
-        if self.facing < 0:
-            self.rect.right = SCREENRECT.right
-            print(self.rect.right)
+    @classmethod
+    def spawn(cls, world, direction):
+        facing = direction * cls.speed
+        x = SCREENRECT.right - cls.size[0] if facing < 0 else 0
+        telemetry.emit("alien_spawn", x=x, facing=facing)
+        return world.spawn(cls, x, 0, vx=facing)
 
-    def update(self):
-        self.rect.move_ip(self.facing, 0)
-        if not SCREENRECT.contains(self.rect):
-            self.facing = -self.facing
-            self.rect.top = self.rect.bottom + 1
-            self.rect = self.rect.clamp(SCREENRECT)
-        self.frame = self.frame + 1
-        self.image = self.images[self.frame // self.animcycle % 3]
 
+class Explosion(Archetype):
+    """An explosion. Hopefully the Alien and not the player!
 
-class Explosion(pg.sprite.Sprite):
-    """An explosion. Hopefully the Alien and not the player!"""
+    The world's timer wheel removes it after 'lifetime' ticks.
+    """
 
-    defaultlife = 12
-    animcycle = 3
+    lifetime = 12
+    clip = Clip((0, 1), 3)
+    size = (90, 90)
     images: List[pg.Surface] = []
 
-    def __init__(self, actor, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(center=actor.rect.center)
-        self.life = self.defaultlife
-
-    def update(self):
-        """called every time around the game loop.
-
-        Show the explosion surface for 'defaultlife'.
-        Every game tick(update), we decrease the 'life'.
+    @classmethod
+    def spawn(cls, world, center):
+        x, y = anchored(cls.size, center=center)
+        return world.spawn(cls, x, y)
 
-        Also we animate the explosion.
-        """
-        self.life = self.life - 1
-        self.image = self.images[self.life // self.animcycle % 2]
-        if self.life <= 0:
-            self.kill()
 
-
-class Shot(pg.sprite.Sprite):
+class Shot(Archetype):
     """a bullet the Player sprite fires."""
 
     speed = -11
+    size = (9, 18)
+    groups = SHOTS
+    bounds = KILL_OUTSIDE
     images: List[pg.Surface] = []
 
-    def __init__(self, pos, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=pos)
+    @classmethod
+    def spawn(cls, world, pos):
+        x, y = anchored(cls.size, midbottom=pos)
+        return world.spawn(cls, x, y, vy=cls.speed)
 
-    def update(self):
-        """called every time around the game loop.
-
-        Every tick we move the shot upwards.
-        """
-        self.rect.move_ip(0, self.speed)
-        if self.rect.top <= 0:
-            self.kill()
 
+class Bomb(Archetype):
+    """A bomb the aliens drop.
 
-class Bomb(pg.sprite.Sprite):
-    """A bomb the aliens drop."""
+    When it reaches the ground (floor) the world removes it and main()
+    makes an explosion there.
+    """
 
     speed = 9
+    size = (16, 24)
+    groups = BOMBS
+    bounds = KILL_OUTSIDE
+    floor = 470
     images: List[pg.Surface] = []
 
-    def __init__(self, alien, explosion_group, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=alien.rect.move(0, 5).midbottom)
-        self.explosion_group = explosion_group
-
-    def update(self):
-        """called every time around the game loop.
+    @classmethod
+    def spawn(cls, world, alien):
+        slot = world.slot_of[alien]
+        pos = world.x[slot] + world.w[slot] // 2, world.y[slot] + world.h[slot] + 5
+        x, y = anchored(cls.size, midbottom=pos)
+        return world.spawn(cls, x, y, vy=cls.speed)
 
-        Every frame we move the sprite 'rect' down.
-        When it reaches the bottom we:
 
-        - make an explosion.
-        - remove the Bomb.
-        """
-        self.rect.move_ip(0, self.speed)
-        if self.rect.bottom >= 470:
-            Explosion(self, self.explosion_group)
-            self.kill()
+ARCHETYPES = (Player, Alien, Explosion, Shot, Bomb)
 
 
 class Score(pg.sprite.Sprite):
@@ -231,75 +217,89 @@ class Score(pg.sprite.Sprite):
             self.image = self.font.render(msg, 0, self.color)
 
 
-def main(winstyle=0):
-    # Initialize pygame
-    if pg.get_sdl_version()[0] == 2:
-        pg.mixer.pre_init(44100, 32, 2, 1024)
-    pg.init()
-    if pg.mixer and not pg.mixer.get_init():
-        print("Warning, no sound")
-        pg.mixer = None
+def main(winstyle=0, seed=None, level=0):
+    """seed and level pick the wave schedule; the same pair always plays the same waves."""
+    startup = Startup(STARTED)
+    # Initialize pygame, leaving the mixer for the asset loader
+    with startup.step("pg.init"):
+        pg.display.init()
+        pg.font.init()
 
     fullscreen = False
     # Set the display mode
-    winstyle = 0  # |FULLSCREEN
-    bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
-    screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
-
-    # Load images, assign to sprite classes
-    # (do this before the classes are used, after screen setup)
-    img = load_image("player1.gif")
-    Player.images = [img, pg.transform.flip(img, 1, 0)]
-    img = load_image("explosion1.gif")
-    Explosion.images = [img, pg.transform.flip(img, 1, 1)]
-    Alien.images = [load_image(im) for im in ("alien1.gif", "alien2.gif", "alien3.gif")]
-    Bomb.images = [load_image("bomb.gif")]
-    Shot.images = [load_image("shot.gif")]
+    with startup.step("display"):
+        winstyle = 0  # |FULLSCREEN
+        bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
+        screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
+
+    # Load images, assign to archetypes
+    # (do this before the renderer is created, after screen setup)
+    with startup.step("images"):
+        img = load_image("player1.gif")
+        Player.images = [img, pg.transform.flip(img, 1, 0)]
+        img = load_image("explosion1.gif")
+        Explosion.images = [img, pg.transform.flip(img, 1, 1)]
+        Alien.images = [load_image(im) for im in ("alien1.gif", "alien2.gif", "alien3.gif")]
+        Bomb.images = [load_image("bomb.gif")]
+        Shot.images = [load_image("shot.gif")]
 
     # decorate the game window
-    icon = pg.transform.scale(Alien.images[0], (32, 32))
-    pg.display.set_icon(icon)
-    pg.display.set_caption("Pygame Aliens")
-    pg.mouse.set_visible(0)
-
-    # create the background, tile the bgd image
-    bgdtile = load_image("background.gif")
-    background = pg.Surface(SCREENRECT.size)
-    for x in range(0, SCREENRECT.width, bgdtile.get_width()):
-        background.blit(bgdtile, (x, 0))
-    screen.blit(background, (0, 0))
-    pg.display.flip()
-
-    # load the sound effects
-    boom_sound = load_sound("boom.wav")
-    shoot_sound = load_sound("car_door.wav")
-    if pg.mixer:
-        music = os.path.join(main_dir, "data", "house_lo.wav")
-        pg.mixer.music.load(music)
-        pg.mixer.music.play(-1)
-
-    # Initialize Game Groups
-    aliens = pg.sprite.Group()
-    shots = pg.sprite.Group()
-    bombs = pg.sprite.Group()
-    all = pg.sprite.RenderUpdates()
-    lastalien = pg.sprite.GroupSingle()
+    with startup.step("background"):
+        icon = pg.transform.scale(Alien.images[0], (32, 32))
+        pg.display.set_icon(icon)
+        pg.display.set_caption("Pygame Aliens")
+        pg.mouse.set_visible(0)
+
+        # create the background, tile the bgd image
+        bgdtile = load_image("background.gif")
+        background = pg.Surface(SCREENRECT.size)
+        for x in range(0, SCREENRECT.width, bgdtile.get_width()):
+            background.blit(bgdtile, (x, 0))
+        screen.blit(background, (0, 0))
+        pg.display.flip()
+    startup.mark("first_frame")
+
+    # load the sound effects and music in the background; until then
+    # the game just runs silently
+    sounds = {}
+    assets = AssetLoader(startup)
+    assets.add("mixer", init_mixer)
+    assets.add("sound:boom", lambda: load_sound("boom.wav"), lambda sound: sounds.__setitem__("boom", sound))
+    assets.add("sound:shoot", lambda: load_sound("car_door.wav"), lambda sound: sounds.__setitem__("shoot", sound))
+    assets.add("music", play_music)
+    assets.start()
+
+    # The world holds every game object, the hud only the score
+    world = World(ARCHETYPES, SCREENRECT)
+    renderer = Renderer(ARCHETYPES)
+    hud = pg.sprite.RenderUpdates()
 
     # Create Some Starting Values
-    alienreload = ALIEN_RELOAD
+    # alien spawns and bomb drops are planned a level at a time from the seed;
+    # everything else timed (explosions) runs off simulation ticks
+    if seed is None:
+        seed = random.randrange(1 << 31)
+    telemetry.emit("wave_schedule", seed=seed, level=level)  # enough to replay these waves
+    waves = WaveCursor(
+        WaveSchedule(seed, LEVEL_TICKS, ALIEN_ODDS, BOMB_ODDS, ALIEN_RELOAD), level, world.tick
+    )
     clock = pg.time.Clock()
+    # drops detail (then render rate) when frames run over the 25ms budget
+    governor = QualityGovernor()
 
-    # initialize our starting sprites
+    # initialize our starting entities
     global SCORE
-    player = Player(all)
-    Alien(
-        aliens, all, lastalien
-    )  # note, this 'lives' because it goes into a sprite group
+    player = Player.spawn(world)
+    reloading = 0
+    lastalien = None  # the first alien comes from the schedule on the first frame
     if pg.font:
-        all.add(Score(all))
+        Score(hud)
 
     # Run our main loop whilst the player is alive.
-    while player.alive():
+    while world.alive(player):
+        assets.poll()
+        boom_sound, shoot_sound = sounds.get("boom"), sounds.get("shoot")
+        quality = governor.quality
         # get input
         for event in pg.event.get():
             if event.type == pg.QUIT:
@@ -307,90 +307,118 @@ def main(winstyle=0):
             if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
                 return
             if event.type == pg.KEYDOWN:
+                if event.key == pg.K_F10:
+                    sampler.toggle()  # capture a few seconds of profile samples
                 if event.key == pg.K_f:
                     if not fullscreen:
-                        print("Changing to FULLSCREEN")
+                        telemetry.emit("display_mode", fullscreen=True)
                         screen_backup = screen.copy()
                         screen = pg.display.set_mode(
                             SCREENRECT.size, winstyle | pg.FULLSCREEN, bestdepth
                         )
                         screen.blit(screen_backup, (0, 0))
                     else:
-                        print("Changing to windowed mode")
+                        telemetry.emit("display_mode", fullscreen=False)
                         screen_backup = screen.copy()
                         screen = pg.display.set_mode(
                             SCREENRECT.size, winstyle, bestdepth
                         )
                         screen.blit(screen_backup, (0, 0))
                     pg.display.flip()
+                    renderer.reset()
                     fullscreen = not fullscreen
 
         keystate = pg.key.get_pressed()
 
-        # clear/erase the last drawn sprites
-        all.clear(screen, background)
-
-        # update all the sprites
-        all.update()
+        # update all the entities; bombs that reached the ground explode there
+        for _, archetype, center in world.update():
+            if archetype is Bomb:
+                Explosion.spawn(world, center)
 
         # handle player input
         direction = keystate[pg.K_RIGHT] - keystate[pg.K_LEFT]
-        player.move(direction)
+        Player.move(world, player, direction)
         firing = keystate[pg.K_SPACE]
-        if not player.reloading and firing and len(shots) < MAX_SHOTS:
-            Shot(player.gunpos(), shots, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-        player.reloading = firing
-
-        # Create new alien
-        if alienreload:
-            alienreload = alienreload - 1
-        elif not int(random.random() * ALIEN_ODDS):
-            Alien(aliens, all, lastalien)
-            alienreload = ALIEN_RELOAD
-
-        # Drop bombs
-        if lastalien and not int(random.random() * BOMB_ODDS):
-            Bomb(lastalien.sprite, all, bombs, all)
+        if not reloading and firing and world.count(SHOTS) < MAX_SHOTS:
+            Shot.spawn(world, Player.gunpos(world, player))
+            play_sound(shoot_sound, quality.sound_limit)
+            telemetry.emit("shot", shooter="Player", kind="Shot")
+        reloading = firing
+
+        # Create new aliens and drop bombs as the wave schedule says
+        facing, bomb = waves.advance(world.tick)
+        if facing:
+            lastalien = Alien.spawn(world, facing)
+
+        if bomb and world.alive(lastalien):
+            Bomb.spawn(world, lastalien)
+            telemetry.emit("shot", shooter="Alien", kind="Bomb")
 
         # Detect collisions between aliens and players.
-        for alien in pg.sprite.spritecollide(player, aliens, 1):
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
-            Explosion(alien, all)
-            Explosion(player, all)
+        # Every alien that touches the player dies, but the player only dies once.
+        for alien in world.collide(player, ALIENS):
+            play_sound(boom_sound, quality.sound_limit)
+            Explosion.spawn(world, world.center(alien))
             SCORE = SCORE + 1
-            player.kill()
+            world.despawn(alien)
+            if world.alive(player):
+                Explosion.spawn(world, world.center(player))
+                world.despawn(player)
+                telemetry.emit("hit", target="Player", by="Alien")
 
         # See if shots hit the aliens.
-        for alien in pg.sprite.groupcollide(aliens, shots, 1, 1).keys():
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
-            Explosion(alien, all)
+        # Each shot kills at most one alien, even where aliens overlap.
+        for alien, shot in world.collide_groups(ALIENS, SHOTS):
+            if not world.alive(alien) or not world.alive(shot):
+                continue
+            play_sound(boom_sound, quality.sound_limit)
+            Explosion.spawn(world, world.center(alien))
+            world.despawn(alien)
+            world.despawn(shot)
             SCORE = SCORE + 1
+            telemetry.emit("hit", target="Alien", by="Shot", score=SCORE)
 
         # See if alien bombs hit the player.
-        for bomb in pg.sprite.spritecollide(player, bombs, 1):
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
-            Explosion(player, all)
-            Explosion(bomb, all)
-            player.kill()
-
-        # draw the scene
-        dirty = all.draw(screen)
-        pg.display.update(dirty)
+        for bomb in world.collide(player, BOMBS):
+            play_sound(boom_sound, quality.sound_limit)
+            Explosion.spawn(world, world.center(bomb))
+            world.despawn(bomb)
+            if world.alive(player):
+                Explosion.spawn(world, world.center(player))
+                world.despawn(player)
+                telemetry.emit("hit", target="Player", by="Bomb")
+
+        # draw the scene (the governor may skip some frames; the world still moves)
+        if governor.render_due():
+            renderer.clear(screen, background)
+            hud.clear(screen, background)
+            if governor.hud_due():
+                hud.update()
+            dirty = renderer.draw(screen, world.records(), group_rects(hud))
+            dirty += hud.draw(screen)
+            pg.display.update(dirty)
 
         # cap the framerate at 40fps. Also called 40HZ or 40 times per second.
         clock.tick(40)
+        if governor.frame(clock.get_rawtime() / 1000):
+            world.set_clip(Explosion, Explosion.clip if governor.quality.animate_explosions else None)
 
-    if pg.mixer:
+    telemetry.emit("match_result", winner="Alien", score=SCORE, level=waves.level.number)
+    if pg.mixer and pg.mixer.get_init():
         pg.mixer.music.fadeout(1000)
     pg.time.wait(1000)
 
 
 # call the "main" function if running this script
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, help="wave schedule seed (random if omitted)")
+    parser.add_argument("--level", type=int, default=0, help="level to start at")
+    args = parser.parse_args()
+    telemetry.start(os.path.join(main_dir, "logs"))
+    sampler.install(os.path.join(main_dir, "logs"))  # F10 or SIGUSR1 starts a capture
+    try:
+        main(seed=args.seed, level=args.level)
+    finally:
+        telemetry.stop()
     pg.quit()
@@ -0,0 +1,238 @@
+"""
+tracemallocを使ったフレーム単位のメモリ確保プロファイラ(オプトイン)
+
+メインループのフレームの区切りでframe()を呼ぶと、2つのことを測る。
+  一時的な確保: フレームの始めにtracemalloc.reset_peak()し、終わりのピークから始めの量を
+    引いたもの。フレームの中で作って捨てる弾・爆発・ゲージの文字のSurface・clamp()のRectなどは
+    差し引きでは0になるので、フレームごとの確保の量はこちらで見る。
+  残った増加(retained growth): tracemallocのスナップショットを前回と比べて増えたバイト数と
+    オブジェクト数を確保した行ごとに積み上げる。フレームをまたいで残ったものだけが載る。
+tracemallocはプロセス全体を追うので、テレメトリのライタースレッドなど別スレッドの確保も
+そのときのフレームに数えられる。
+同時にgc.callbacksでガベージコレクションの停止時間を測り、フレーム時間が跳ねたフレームと
+GCが走ったフレームが重なっているかを数えるので、フレームの引っかかりの原因が
+GCかどうかを確かめられる。
+stop()で上位N件の行とサブシステム(モジュール・クラス)ごとの集計をテキストに書き出す。
+
+スナップショットを取るたびに数ミリ秒かかるので、計測中はフレームレートが落ちる。
+フレーム時間にはプロファイラ自身の処理時間を含めない。
+"""
+
+import gc
+import linecache
+import os
+import time
+import tracemalloc
+
+# 集計から外すファイル (プロファイラ自身とtracemalloc)
+IGNORED = ("<frozen importlib._bootstrap>", "<unknown>", tracemalloc.__file__, __file__)
+SPIKE_RATIO = 2.0  # フレーム時間が中央値のこの倍を超えたら「跳ねた」とみなす
+
+
+class AllocationProfiler:
+    """
+    フレーム単位のメモリ確保プロファイラ
+    directory : レポートの出力先
+    top : レポートに載せる行の数
+    interval : 何フレームごとにスナップショットを比べるか
+    nframes : 記録するトレースバックの深さ。深いほど重い
+    """
+
+    def __init__(self, directory, top=20, interval=1, nframes=1):
+        self.directory = directory
+        self.top = top
+        self.interval = interval
+        self.nframes = nframes
+        self.sites = {}  # (ファイル, 行) -> [増えたバイト数, 増えたオブジェクト数, 増えたフレーム数]
+        self.frame_bytes = []  # スナップショットごとに残って増えたバイト数
+        self.frame_peak = []  # フレームごとの一時的な確保のバイト数 (ピーク - フレームの始めの量)
+        self.frame_times = []  # フレームごとの時間(秒)
+        self.frame_gc = []  # フレームごとのGCの停止時間(秒)
+        self.gc_counts = [0, 0, 0]
+        self.gc_pause = 0.0
+        self.gc_max = 0.0
+        self.frames = 0
+        self.previous = None
+        self._gc_start = None
+        self._gc_in_frame = 0.0
+        self._frame_start = None
+        self._frame_traced = 0
+
+    def start(self):
+        tracemalloc.start(self.nframes)
+        gc.callbacks.append(self._on_gc)
+        self.previous = self._snapshot()
+        self._begin_frame()
+        return self
+
+    def _begin_frame(self):
+        """次のフレームの時間・GC・一時的な確保をここから測る"""
+        self._gc_in_frame = 0.0
+        tracemalloc.reset_peak()
+        self._frame_traced = tracemalloc.get_traced_memory()[0]
+        self._frame_start = time.perf_counter()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED]
+        )
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            pause = time.perf_counter() - self._gc_start
+            self._gc_start = None
+            self.gc_counts[info["generation"]] += 1
+            self.gc_pause += pause
+            self.gc_max = max(self.gc_max, pause)
+            self._gc_in_frame += pause
+
+    def frame(self):
+        """
+        メインループの1フレームの終わりに呼ぶ
+        """
+        now = time.perf_counter()
+        self.frame_times.append(now - self._frame_start)
+        self.frame_gc.append(self._gc_in_frame)
+        self.frame_peak.append(tracemalloc.get_traced_memory()[1] - self._frame_traced)
+        self.frames += 1
+        if self.frames % self.interval == 0:
+            snapshot = self._snapshot()
+            grown = 0
+            sites = self.sites
+            for stat in snapshot.compare_to(self.previous, "lineno"):
+                if stat.size_diff <= 0:
+                    continue
+                frame = stat.traceback[0]
+                site = sites.get((frame.filename, frame.lineno))
+                if site is None:
+                    site = sites[(frame.filename, frame.lineno)] = [0, 0, 0]
+                site[0] += stat.size_diff
+                site[1] += max(0, stat.count_diff)
+                site[2] += 1
+                grown += stat.size_diff
+            self.frame_bytes.append(grown)
+            self.previous = snapshot
+        # スナップショットの時間とその間に走ったGCや確保は次のフレームに含めない
+        self._begin_frame()
+
+    def skip(self):
+        """
+        フレームを進めずに待っていた周(アイドル中や勝利画面)の終わりに呼ぶ
+        その周をフレームとして数えず、次のフレームの時間とGCと確保をここから測り直す
+        """
+        self._begin_frame()
+
+    def stop(self):
+        """
+        計測を止めてレポートを書き出す
+        戻り値: レポートのパス
+        """
+        if self._on_gc in gc.callbacks:
+            gc.callbacks.remove(self._on_gc)
+        tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, time.strftime("alloc-%Y%m%d-%H%M%S.txt"))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.report())
+        return path
+
+    def report(self):
+        lines = [f"frames: {self.frames}"]
+        if self.frame_peak:
+            peaks = sorted(self.frame_peak)
+            lines.append(
+                f"transient allocation per frame: median {peaks[len(peaks) // 2]} B, "
+                f"p95 {peaks[min(len(peaks) - 1, int(len(peaks) * 0.95))]} B, max {peaks[-1]} B"
+            )
+            lines.append("  (process-wide: includes other threads such as the telemetry writer)")
+        if self.frame_bytes:
+            total = sum(self.frame_bytes)
+            lines.append(
+                f"retained growth per snapshot: mean {total / len(self.frame_bytes):.0f} B, "
+                f"max {max(self.frame_bytes)} B (every {self.interval} frames)"
+            )
+
+        lines += [
+            "", f"top {self.top} call sites by retained growth (allocations freed within a frame do not appear)",
+            "     bytes    objects  frames  site",
+        ]
+        ranked = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)
+        for (filename, lineno), (size, count, frames) in ranked[:self.top]:
+            source = linecache.getline(filename, lineno).strip()
+            lines.append(f"{size:10d} {count:10d} {frames:7d}  {subsystem(filename, lineno)} {os.path.basename(filename)}:{lineno}  {source}")
+
+        lines += ["", "retained growth by subsystem", "     bytes    objects  subsystem"]
+        totals = {}
+        for (filename, lineno), (size, count, _) in self.sites.items():
+            total = totals.setdefault(subsystem(filename, lineno), [0, 0])
+            total[0] += size
+            total[1] += count
+        for name, (size, count) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True):
+            lines.append(f"{size:10d} {count:10d}  {name}")
+
+        lines += ["", "garbage collection"]
+        lines.append(f"collections by generation: {self.gc_counts[0]} / {self.gc_counts[1]} / {self.gc_counts[2]}")
+        lines.append(f"total pause {self.gc_pause * 1000:.2f} ms, max pause {self.gc_max * 1000:.3f} ms")
+        if self.frame_times:
+            times = sorted(self.frame_times)
+            median = times[len(times) // 2]
+            spikes = [index for index, t in enumerate(self.frame_times) if t > median * SPIKE_RATIO]
+            with_gc = sum(1 for index in spikes if self.frame_gc[index] > 0)
+            lines.append(f"frame time: median {median * 1000:.2f} ms, max {times[-1] * 1000:.2f} ms")
+            lines.append(
+                f"spike frames (> {SPIKE_RATIO:g}x median): {len(spikes)}, of which {with_gc} had a GC pause"
+            )
+            if spikes:
+                peaks = sorted(self.frame_peak)
+                lines.append(
+                    f"transient allocation: median {peaks[len(peaks) // 2]} B over all frames, "
+                    f"median {sorted(self.frame_peak[index] for index in spikes)[len(spikes) // 2]} B in spike frames"
+                )
+            for index in sorted(spikes, key=lambda index: self.frame_times[index], reverse=True)[:self.top]:
+                lines.append(
+                    f"  frame {index}: {self.frame_times[index] * 1000:.2f} ms, gc {self.frame_gc[index] * 1000:.3f} ms, "
+                    f"allocated {self.frame_peak[index]} B"
+                )
+        return "\n".join(lines) + "\n"
+
+
+_functions = {}
+
+
+def subsystem(filename, lineno):
+    """
+    行が属するサブシステムの名前。ゲームのファイルなら「モジュール.クラス.関数」まで、
+    それ以外(pygameや標準ライブラリ)はモジュール名だけにする
+    """
+    module = os.path.splitext(os.path.basename(filename))[0]
+    if os.path.dirname(os.path.abspath(filename)) != os.path.dirname(os.path.abspath(__file__)):
+        return module
+    return f"{module}.{enclosing(filename, lineno)}".rstrip(".")
+
+
+def enclosing(filename, lineno):
+    """
+    ソースのインデントからlinenoを含むクラスと関数の名前を求める
+    """
+    key = (filename, lineno)
+    if key in _functions:
+        return _functions[key]
+    names = []
+    indent = None
+    for number in range(lineno, 0, -1):
+        line = linecache.getline(filename, number)
+        stripped = line.lstrip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        depth = len(line) - len(stripped)
+        if indent is not None and depth >= indent:
+            continue
+        if stripped.startswith(("def ", "class ", "async def ")):
+            names.append(stripped.split("(")[0].split(":")[0].split()[-1])
+        indent = depth
+        if depth == 0:
+            break
+    _functions[key] = ".".join(reversed(names))
+    return _functions[key]
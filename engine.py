@@ -0,0 +1,540 @@
+"""
+2つのゲームで共有するエンティティ・コンポーネント・システム(ECS)のコア
+
+エンティティの状態はスプライトのインスタンスではなく、コンポーネントごとの
+配列(array.array)に詰めて持つ。i番目の要素がi番目のエンティティの値になり、
+エンティティを消すときは最後の要素を穴に移すので、配列は常に隙間なく埋まっている。
+移動・画面端・アニメーション・当たり判定などのシステムはこの配列をまとめて回す。
+
+ゲーム側のPlayerやShotなどはArchetypeのサブクラスとして、大きさや速さ、
+画面端での扱いなどをクラス属性で定義するだけにする。
+"""
+
+import struct
+from array import array
+from typing import List
+
+import pygame as pg
+
+from timerwheel import TimerWheel
+
+# 画面端での扱い
+FREE = 0  # 何もしない
+CLAMP = 1  # 画面内に押し戻す
+KILL_OUTSIDE = 2  # 画面端(またはfloor)に触れたら消す
+BOUNCE = 3  # 左右の端で跳ね返る
+DESCEND = 4  # 左右の端で折り返して一段下がる
+
+# エンティティごとに持つコンポーネント(配列)の名前と型
+COMPONENTS = (
+    ("ids", "q"),  # エンティティID
+    ("kind", "B"),  # アーキタイプの番号
+    ("x", "i"),  # 位置 (左上)
+    ("y", "i"),
+    ("w", "H"),  # 大きさ
+    ("h", "H"),
+    ("vx", "i"),  # 速度 (1tickあたり)
+    ("vy", "i"),
+    ("frame", "B"),  # 表示する画像の番号
+    ("born", "q"),  # アニメーションの基準のtick (生成されたtickから位相のずれを引いたもの)
+    ("expires", "q"),  # 寿命が尽きるtick。0なら寿命なし
+    ("owner", "B"),  # 持ち主 (ゲーム側で決める番号)
+    ("groups", "B"),  # 当たり判定のグループ (ビットマスク)
+    ("gauge", "B"),  # ゲージの量
+    ("gauge_max", "B"),  # ゲージの最大容量。0ならゲージを持たない
+)
+
+# snapshot()の形式: ヘッダー、コンポーネントごとの配列(容量分)、タイマー
+SNAPSHOT = struct.Struct("<4sqqII")  # マジック, tick, next_id, エンティティ数, 配列の容量
+SNAPSHOT_MAGIC = b"ECS1"
+SNAPSHOT_BLOCK = 64  # 配列の容量はこの倍数に切り上げる
+
+
+class Clip:
+    """
+    アニメーションのクリップ。アーキタイプごとに1つ定義し、全インスタンスで共有する
+    frames : 順に表示する画像の番号 (アーキタイプのimagesの添字)
+    cycle : 1コマを表示するtick数
+    loop : Falseなら最後のコマで止まる
+    どのコマを出すかはWorldのtick(全体で共通の時計)とエンティティごとの基準tickの差だけで決まるので、
+    インスタンスごとにカウンタを持たない
+    """
+
+    def __init__(self, frames, cycle, loop=True):
+        self.frames = tuple(frames)
+        self.cycle = cycle
+        self.loop = loop
+        self.length = len(self.frames) * cycle
+        # 経過tick -> コマ の表。毎tickの計算を表引き1回にする
+        self.table = array("B", (self.frames[age // cycle] for age in range(self.length)))
+
+    def frame_at(self, age):
+        if age >= self.length:
+            age = age % self.length if self.loop else self.length - 1
+        return self.table[age]
+
+
+class Archetype:
+    """
+    エンティティの種類(アーキタイプ)の定義
+    ゲーム側でサブクラスを作り、クラス属性で性質を決める。インスタンスは作らない
+    images : 描画に使う画像のリスト (frameの番号で引く)
+             mask(frame)を持つ(RotationCacheなど)ときは、当たり判定を矩形のあとマスクでも確かめる
+    size : 当たり判定と描画の大きさ。画像を読み込まなくても使えるように数値で持つ
+    groups : 当たり判定のグループ (ビットマスク)
+    bounds : 画面端での扱い (FREE, CLAMP, KILL_OUTSIDE, BOUNCE, DESCEND)
+    floor : KILL_OUTSIDEで消える下端のy座標。Noneなら画面の下端
+    lifetime : 寿命のtick数。0なら寿命なし
+    clip : アニメーションのClip。Noneならアニメーションしない (frameはゲーム側で決める)
+    """
+
+    images: List[pg.Surface] = []
+    size = (0, 0)
+    groups = 0
+    bounds = FREE
+    floor = None
+    lifetime = 0
+    clip = None
+
+
+def anchored(size, **anchor):
+    """
+    midbottom=pos のような指定から、大きさsizeの矩形の左上の座標を求める
+    """
+    rect = pg.Rect((0, 0), size)
+    for name, value in anchor.items():
+        setattr(rect, name, value)
+    return rect.x, rect.y
+
+
+class World:
+    """
+    エンティティのコンポーネント配列とシステムをまとめたクラス
+    archetypes : このWorldで使うアーキタイプのリスト。並び順がkindの番号になる
+    area : 画面の矩形
+    tick : 進めたtick数
+    timers : tickで動くタイマーホイール。寿命やゲージの回復に使う
+    """
+
+    def __init__(self, archetypes, area):
+        self.archetypes = list(archetypes)
+        self.kind_ids = {archetype: kind for kind, archetype in enumerate(self.archetypes)}
+        self.area = pg.Rect(area)
+        self.tick = 0
+        self.timers = TimerWheel()
+        self.next_id = 1
+        self.slot_of = {}  # エンティティID -> 配列の添字
+        # snapshot()でタイマーのコールバックを番号で記録するための表
+        self.callbacks = [self.despawn, self.charge]
+        for name, typecode in COMPONENTS:
+            setattr(self, name, array(typecode))
+        # アーキタイプの性質をkindの番号で引ける表にしておく
+        self.bounds_of = [archetype.bounds for archetype in self.archetypes]
+        self.floor_of = [self.area.bottom if archetype.floor is None else archetype.floor for archetype in self.archetypes]
+        self.clip_of = [archetype.clip for archetype in self.archetypes]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def spawn(self, archetype, x, y, vx=0, vy=0, frame=0, owner=0, groups=None, size=None, phase=0):
+        """
+        エンティティを1つ作ってIDを返す
+        groups, sizeを省略するとアーキタイプの値を使う
+        phase : アニメーションを何tick分進めた状態から始めるか
+        """
+        eid = self.next_id
+        self.next_id += 1
+        w, h = archetype.size if size is None else size
+        self.slot_of[eid] = len(self.ids)
+        self.ids.append(eid)
+        self.kind.append(self.kind_ids[archetype])
+        self.x.append(x)
+        self.y.append(y)
+        self.w.append(w)
+        self.h.append(h)
+        self.vx.append(int(vx))
+        self.vy.append(int(vy))
+        clip = self.clip_of[self.kind_ids[archetype]]
+        self.frame.append(frame if clip is None else clip.frame_at(phase))
+        self.born.append(self.tick - phase)
+        self.owner.append(owner)
+        self.groups.append(archetype.groups if groups is None else groups)
+        self.gauge.append(0)
+        self.gauge_max.append(0)
+        if archetype.lifetime:
+            self.expires.append(self.tick + archetype.lifetime)
+            self.timers.schedule(archetype.lifetime, self.despawn, eid)
+        else:
+            self.expires.append(0)
+        return eid
+
+    def despawn(self, eid):
+        """
+        エンティティを消す。最後の要素を空いた場所に移して配列を詰める
+        すでに消えているIDなら何もしない
+        """
+        slot = self.slot_of.pop(eid, None)
+        if slot is None:
+            return
+        last = len(self.ids) - 1
+        for name, _ in COMPONENTS:
+            store = getattr(self, name)
+            if slot != last:
+                store[slot] = store[last]
+            store.pop()
+        if slot != last:
+            self.slot_of[self.ids[slot]] = slot
+
+    def alive(self, eid):
+        return eid in self.slot_of
+
+    def clear(self):
+        """
+        すべてのエンティティとタイマーを消す
+        """
+        for name, _ in COMPONENTS:
+            del getattr(self, name)[:]
+        self.slot_of.clear()
+        self.timers.clear()
+
+    def save(self):
+        """
+        ロールバック用に現在の状態を丸ごと記録する
+        コンポーネント配列はコピーするだけなので、エンティティが数十個なら数十マイクロ秒で済む
+        """
+        stores = tuple(getattr(self, name)[:] for name, _ in COMPONENTS)
+        return self.tick, self.next_id, stores, self.timers.save()
+
+    def load(self, state):
+        """
+        save()した時点の状態に戻す。配列は作り直さずに中身だけ入れ替える
+        """
+        self.tick, self.next_id, stores, timers = state
+        for (name, _), saved in zip(COMPONENTS, stores):
+            getattr(self, name)[:] = saved
+        self.slot_of = {eid: slot for slot, eid in enumerate(self.ids)}
+        self.timers.load(timers)
+
+    def snapshot(self):
+        """
+        状態を固定レイアウトのバイト列にする(セーブデータやクラッシュダンプ用)
+        配列はエンティティ数をSNAPSHOT_BLOCKの倍数に切り上げた容量分ずつ並べるので、
+        エンティティが少し増減しても各配列の位置は変わらず、delta()の差分が小さく済む
+        バイトオーダーは実行しているマシンのもの
+        """
+        count = len(self.ids)
+        capacity = -(-count // SNAPSHOT_BLOCK) * SNAPSHOT_BLOCK
+        parts = [SNAPSHOT.pack(SNAPSHOT_MAGIC, self.tick, self.next_id, count, capacity)]
+        for name, _ in COMPONENTS:
+            store = getattr(self, name)
+            parts.append(store.tobytes())
+            parts.append(bytes((capacity - count) * store.itemsize))
+        parts.append(self.timers.pack(self.callbacks))
+        return b"".join(parts)
+
+    def restore(self, data, offset=0):
+        """
+        snapshot()したバイト列から状態を戻す
+        戻り値: 読み終わった位置
+        """
+        magic, self.tick, self.next_id, count, capacity = SNAPSHOT.unpack_from(data, offset)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a world snapshot")
+        offset += SNAPSHOT.size
+        data = memoryview(data)
+        for name, _ in COMPONENTS:
+            store = getattr(self, name)
+            del store[:]
+            store.frombytes(data[offset:offset + count * store.itemsize])
+            offset += capacity * store.itemsize
+        self.slot_of = {eid: slot for slot, eid in enumerate(self.ids)}
+        return self.timers.unpack(data, self.callbacks, offset)
+
+    def is_static(self):
+        """
+        動いているエンティティもアニメーションしているエンティティもなければTrue
+        タイマーが発火するまでは、tickを進めても盤面が変わらない
+        """
+        if any(self.vx) or any(self.vy):
+            return False
+        clip_of = self.clip_of
+        return all(clip_of[kind] is None for kind in self.kind)
+
+    def of_kind(self, archetype):
+        """
+        アーキタイプがarchetypeのエンティティIDのリスト
+        """
+        kind = self.kind_ids[archetype]
+        ids = self.ids
+        return [ids[slot] for slot, k in enumerate(self.kind) if k == kind]
+
+    def count(self, groups):
+        """
+        groupsのどれかに属するエンティティの数
+        """
+        return sum(1 for g in self.groups if g & groups)
+
+    def rect(self, eid):
+        slot = self.slot_of[eid]
+        return pg.Rect(self.x[slot], self.y[slot], self.w[slot], self.h[slot])
+
+    def center(self, eid):
+        slot = self.slot_of[eid]
+        return self.x[slot] + self.w[slot] // 2, self.y[slot] + self.h[slot] // 2
+
+    # ---- ゲージ ----
+
+    def add_gauge(self, eid, capacity, interval):
+        """
+        エンティティにゲージを持たせ、interval tickごとに1ずつ回復させる
+        戻り値: 回復タイマー
+        """
+        slot = self.slot_of[eid]
+        self.gauge[slot] = 0
+        self.gauge_max[slot] = capacity
+        return self.timers.every(interval, self.charge, eid)
+
+    def charge(self, eid, amount=1):
+        slot = self.slot_of.get(eid)
+        if slot is not None:
+            self.gauge[slot] = min(self.gauge[slot] + amount, self.gauge_max[slot])
+
+    def gauge_value(self, eid):
+        slot = self.slot_of.get(eid)
+        return 0 if slot is None else self.gauge[slot]
+
+    def spend(self, eid, amount):
+        """
+        ゲージがamount以上あれば消費してTrueを返す
+        """
+        slot = self.slot_of[eid]
+        if self.gauge[slot] < amount:
+            return False
+        self.gauge[slot] -= amount
+        return True
+
+    # ---- システム ----
+
+    def update(self):
+        """
+        1tick進める: 移動、画面端の処理、アニメーション、タイマー
+        戻り値: 画面端で消えたエンティティの (ID, アーキタイプ, 中心座標) のリスト
+        """
+        self.tick += 1
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        for slot in range(len(x)):
+            x[slot] += vx[slot]
+            y[slot] += vy[slot]
+        removed = self.apply_bounds()
+        self.animate()
+        self.timers.advance()
+        return removed
+
+    def apply_bounds(self):
+        x, y, w, h, vx, kind = self.x, self.y, self.w, self.h, self.vx, self.kind
+        bounds_of, floor_of = self.bounds_of, self.floor_of
+        left, top, right = self.area.left, self.area.top, self.area.right
+        removed = []
+        for slot in range(len(x)):
+            policy = bounds_of[kind[slot]]
+            if policy == FREE:
+                continue
+            if policy == KILL_OUTSIDE:
+                if x[slot] <= left or y[slot] <= top or x[slot] + w[slot] >= right or y[slot] + h[slot] >= floor_of[kind[slot]]:
+                    removed.append(self.ids[slot])
+            elif policy == BOUNCE:
+                if x[slot] <= left or x[slot] + w[slot] >= right:
+                    vx[slot] = -vx[slot]
+            elif policy == DESCEND:
+                if x[slot] < left or x[slot] + w[slot] > right:
+                    vx[slot] = -vx[slot]
+                    y[slot] += h[slot] + 1
+                    self.clamp_slot(slot)
+            elif policy == CLAMP:
+                self.clamp_slot(slot)
+        result = []
+        for eid in removed:
+            slot = self.slot_of[eid]
+            result.append((eid, self.archetypes[kind[slot]], (x[slot] + w[slot] // 2, y[slot] + h[slot] // 2)))
+            self.despawn(eid)
+        return result
+
+    def set_clip(self, archetype, clip):
+        """
+        アーキタイプのアニメーションを差し替える。Noneなら今のコマのまま止める
+        """
+        self.clip_of[self.kind_ids[archetype]] = clip
+
+    def animate(self):
+        """
+        Clipを持つアーキタイプのコマを、共通の時計(tick)と基準tickの差から決める
+        コマが変わったエンティティだけframeを書き換えるので、Rendererは変わらないものを描き直さない
+        """
+        tick, kind, frame, born, clip_of = self.tick, self.kind, self.frame, self.born, self.clip_of
+        for slot in range(len(kind)):
+            clip = clip_of[kind[slot]]
+            if clip is not None:
+                age = tick - born[slot]
+                if age >= clip.length:
+                    age = age % clip.length if clip.loop else clip.length - 1
+                current = clip.table[age]
+                if frame[slot] != current:
+                    frame[slot] = current
+
+    def move(self, eid, dx, dy=0):
+        """
+        入力で動かすエンティティ用。移動してから画面内に押し戻す
+        """
+        slot = self.slot_of[eid]
+        self.x[slot] += dx
+        self.y[slot] += dy
+        self.clamp_slot(slot)
+
+    def clamp_slot(self, slot):
+        area = self.area
+        self.x[slot] = max(area.left, min(self.x[slot], area.right - self.w[slot]))
+        self.y[slot] = max(area.top, min(self.y[slot], area.bottom - self.h[slot]))
+
+    def collide(self, eid, groups):
+        """
+        eidと重なっている、groupsのどれかに属するエンティティIDのリスト
+        """
+        slot = self.slot_of.get(eid)
+        if slot is None:
+            return []
+        x, y, w, h, g, ids = self.x, self.y, self.w, self.h, self.groups, self.ids
+        left, top = x[slot], y[slot]
+        right, bottom = left + w[slot], top + h[slot]
+        hits = []
+        for other in range(len(x)):
+            if other != slot and g[other] & groups and x[other] < right and left < x[other] + w[other] and y[other] < bottom and top < y[other] + h[other]:
+                if self.masks_overlap(slot, other):
+                    hits.append(ids[other])
+        return hits
+
+    def mask_of(self, slot):
+        """
+        エンティティの当たり判定のマスクと、左上からのずれ
+        画像がマスクを持たないアーキタイプ(画像を読み込まないMatchも)ではNone
+        """
+        images = self.archetypes[self.kind[slot]].images
+        if not hasattr(images, "mask"):
+            return None
+        return images.mask(self.frame[slot])
+
+    def masks_overlap(self, slot, other):
+        """
+        矩形が重なっている2つのエンティティが、マスクでも重なっているか
+        マスクを持たない側は矩形いっぱいのマスクとして扱う
+        """
+        a, b = self.mask_of(slot), self.mask_of(other)
+        if a is None and b is None:
+            return True
+        x, y, w, h = self.x, self.y, self.w, self.h
+        mask_a, (ax, ay) = a or (pg.Mask((w[slot], h[slot]), fill=True), (0, 0))
+        mask_b, (bx, by) = b or (pg.Mask((w[other], h[other]), fill=True), (0, 0))
+        offset = (x[other] + bx - x[slot] - ax, y[other] + by - y[slot] - ay)
+        return mask_a.overlap(mask_b, offset) is not None
+
+    def collide_groups(self, groups_a, groups_b):
+        """
+        groups_aのエンティティとgroups_bのエンティティで重なっている組のリスト
+        """
+        g, ids = self.groups, self.ids
+        pairs = []
+        for slot in range(len(g)):
+            if g[slot] & groups_a:
+                eid = ids[slot]
+                for other in self.collide(eid, groups_b):
+                    pairs.append((eid, other))
+        return pairs
+
+    def records(self):
+        """
+        描画や転送用の (kind, frame, x, y) の並び
+        """
+        return zip(self.kind, self.frame, self.x, self.y)
+
+    def columns(self):
+        """
+        転送用の (kind, frame, x, y) の配列。コピーしないので読むだけにすること
+        """
+        return self.kind, self.frame, self.x, self.y
+
+
+def group_rects(group):
+    """
+    pygameのスプライトグループが前のフレームで描いた矩形 (group.clear()が背景で消す場所)
+    Renderer.draw()のdamagedに渡す
+    """
+    return [rect for rect in group.spritedict.values() if rect]
+
+
+class Renderer:
+    """
+    Worldのエンティティをダーティ矩形方式で描画するクラス
+    前のフレームと (kind, frame, x, y) が変わったエンティティだけを消して描き直し、
+    描き直した場所だけを画面に反映する。動かずコマも変わらないエンティティには触れない
+    (そのため、どちらも変わらずに重なっているエンティティ同士の上下は前のフレームのまま)
+    imagesがoffset(frame)を持つ(RotationCacheなど)ときは、その分ずらして描く
+    """
+
+    def __init__(self, archetypes):
+        self.images = [archetype.images for archetype in archetypes]
+        self.offsets = [getattr(archetype.images, "offset", None) for archetype in archetypes]
+        self.drawn = {}  # 前のフレームで描いたレコード -> 矩形
+        self.background = None
+        self.blits = 0  # 最後のdraw()で描いたエンティティの数
+
+    def clear(self, screen, background):
+        """
+        消すのは変わったものが分かるdraw()の中で行うので、ここでは背景を覚えておくだけ
+        """
+        self.background = background
+
+    def draw(self, screen, records, damaged=()):
+        """
+        (kind, frame, x, y) の並びを描画して、画面に反映すべき矩形のリストを返す
+        damaged : ほかの描画(hudなど)が背景で消した矩形。重なっているエンティティは描き直す
+        """
+        images, offsets = self.images, self.offsets
+        background = self.background
+        blit = screen.blit
+        previous = self.drawn
+        current = {}  # レコード -> 前のフレームで描いた矩形 (新しいものはNone)
+        order = []
+        for record in records:
+            key = record
+            while key in current:
+                key = (key, 1)  # 同じレコードが重なっているときは2つ目以降を別のキーにする
+            current[key] = previous.get(key)
+            order.append((key, record))
+        # 消えたか動いたかコマが変わったものの跡を消す
+        erased = [rect for record, rect in previous.items() if record not in current]
+        if background is not None:
+            for rect in erased:
+                blit(background, rect, rect)
+        # 新しいものと、消した場所やそれより下に描き直したものに重なっているものを、
+        # 元の並び順(下から上)で描き直す
+        touched = erased + list(damaged)
+        drawn = []
+        for key, record in order:
+            rect = current[key]
+            if rect is None or rect.collidelist(touched) != -1:
+                kind, frame, x, y = record
+                offset = offsets[kind]
+                if offset is not None:
+                    dx, dy = offset(frame)
+                    x, y = x + dx, y + dy
+                current[key] = rect = blit(images[kind][frame], (x, y))
+                drawn.append(rect)
+                touched.append(rect)
+        self.drawn = current
+        self.blits = len(drawn)
+        return erased + drawn
+
+    def reset(self):
+        """
+        画面全体を描き直した後に呼ぶ。次のdraw()ですべて描き直す
+        """
+        self.drawn = {}
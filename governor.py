@@ -0,0 +1,115 @@
+"""
+フレーム時間に応じて描画の品質を上げ下げするガバナー
+
+clock.tick(40)の1フレーム25msに処理が収まらなくなると、ゲームはそのまま遅くなる。
+ガバナーは直近のフレームの処理時間(clock.tickで待った時間を除く)を見て、予算を
+超えそうなら品質を1段ずつ下げ、余裕が戻ったら1段ずつ上げる。
+下げるときと上げるときでしきい値と待つフレーム数を変えて(ヒステリシス)、
+境目で品質が行ったり来たりしないようにする。段が変わるたびにテレメトリで知らせる。
+(フレームが予算を超えているときに変わるので、ゲームスレッドで同期的にprintはしない)
+
+どの段で何を省くかはQualityの値で表し、ゲームループがそれを見て従う。
+シミュレーションのtickは品質に関係なく毎フレーム進める。
+"""
+
+from collections import deque
+
+import telemetry
+
+
+class Quality:
+    """
+    品質の1段
+    name : ログに出す名前
+    animate_explosions : Falseなら爆発のアニメーションを止めて1コマだけにする
+    sound_limit : 同じサウンドを同時に鳴らせる数。Noneなら制限しない
+    hud_interval : HUDの文字を何フレームごとに描き直すか
+    render_interval : 何フレームごとに描画するか (シミュレーションは毎フレーム進む)
+    """
+
+    def __init__(self, name, animate_explosions=True, sound_limit=None, hud_interval=1, render_interval=1):
+        self.name = name
+        self.animate_explosions = animate_explosions
+        self.sound_limit = sound_limit
+        self.hud_interval = hud_interval
+        self.render_interval = render_interval
+
+
+# 上から順に品質を下げていく。各段はそれより上の段で省いたものも省く
+LEVELS = (
+    Quality("full"),
+    Quality("no-explosion-animation", animate_explosions=False),
+    Quality("fewer-sounds", animate_explosions=False, sound_limit=1),
+    Quality("slow-hud", animate_explosions=False, sound_limit=1, hud_interval=8),
+    Quality("half-rate", animate_explosions=False, sound_limit=1, hud_interval=8, render_interval=2),
+)
+
+
+class QualityGovernor:
+    """
+    品質を決めるガバナー
+    budget : 1フレームの予算(秒)
+    window : 平均をとる直近のフレーム数
+    high : 平均が予算のこの割合を超えたら品質を下げる
+    low : 平均が予算のこの割合を下回ったら品質を上げる
+    hold : 品質を下げてから次に下げるまでに待つフレーム数
+    recover : 品質を変えてから上げるまでに待つフレーム数 (holdより長くする)
+    """
+
+    def __init__(self, budget=1 / 40, window=40, high=0.9, low=0.5, hold=40, recover=200, levels=LEVELS):
+        self.budget = budget
+        self.high = high
+        self.low = low
+        self.hold = hold
+        self.recover = recover
+        self.levels = levels
+        self.level = 0
+        self.times = deque(maxlen=window)
+        self.total = 0.0
+        self.since_change = 0
+        self.frames = 0
+        self.changes = 0
+
+    @property
+    def quality(self):
+        return self.levels[self.level]
+
+    def render_due(self):
+        """このフレームを描画するか"""
+        return self.frames % self.quality.render_interval == 0
+
+    def hud_due(self):
+        """このフレームでHUDの文字を描き直すか"""
+        return self.frames % self.quality.hud_interval == 0
+
+    def frame(self, seconds):
+        """
+        1フレームの終わりに、そのフレームの処理時間(秒)を渡す
+        戻り値: 品質の段が変わったらTrue
+        """
+        times = self.times
+        if len(times) == times.maxlen:
+            self.total -= times[0]
+        times.append(seconds)
+        self.total += seconds
+        self.frames += 1
+        self.since_change += 1
+        if len(times) < times.maxlen:
+            return False
+        mean = self.total / len(times)
+        if mean > self.budget * self.high and self.since_change >= self.hold and self.level < len(self.levels) - 1:
+            return self.change(self.level + 1, mean)
+        if mean < self.budget * self.low and self.since_change >= self.recover and self.level > 0:
+            return self.change(self.level - 1, mean)
+        return False
+
+    def change(self, level, mean):
+        previous = self.levels[self.level].name
+        self.level = level
+        self.since_change = 0
+        self.changes += 1
+        telemetry.emit(
+            "quality_change", level=level, quality=self.quality.name, previous=previous,
+            frame_ms=round(mean * 1000, 2), budget_ms=round(self.budget * 1000, 2),
+        )
+        return True
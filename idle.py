@@ -0,0 +1,119 @@
+"""
+何も動いていない間はフレームを回さずに入力を待つアイドルモード
+
+ゲームループは何も起きない間もclock.tick(40)で毎秒40回描画と入力の確認を続けるので、
+誰も操作していないときや勝利画面のままのときもCPUを使い続ける。
+ループは盤面が止まっている(動くものもアニメーションもなく、入力もない)ことを確かめたら
+IdleWaiter.wait()を呼び、次のタイマーが発火するまで眠る。
+pygame 2のpg.event.wait(timeout)は中で1msごとにイベントを見に行くループなので、
+待つだけで毎秒1000回のポーリングになり、フレームを回すより重くなる。そこで
+POLL_MSごとに眠ってはpg.event.peek()でキューを見る。入力が来ていればそこで目を覚まし、
+次の周ですぐ処理するので、入力の遅れは長くてもPOLL_MSで、1フレーム(25ms)ごとに
+入力を見ていた通常のループより大きくならない。
+
+待っている間に経ったtick数を返すので、ループはそのぶんだけ試合を進めて
+ゲームの時間を実時間に合わせておく。アイドルの時間と、その間に使ったCPU時間、
+通常のフレームが1フレームに使うCPU時間を記録し、節約できたCPU時間を見積もって報告する。
+"""
+
+import statistics
+import time
+from collections import deque
+
+import pygame as pg
+
+import telemetry
+
+MAX_WAIT_TICKS = 40  # 1回に待つ最長のtick数。タイマーがなくてもこの間隔で目を覚ます
+POLL_MS = 10  # 待っている間にイベントを見に行く間隔(ms)。1フレームの25msより短くする
+
+
+class IdleWaiter:
+    """
+    アイドル中の待ち合わせと、節約したCPU時間の計測
+    period : 1tickの秒数
+    window : 1フレームのCPU時間の中央値をとる、直近の通常のフレーム数
+    """
+
+    def __init__(self, period=1 / 40, window=200):
+        self.period = period
+        self.waits = 0  # wait()の回数
+        self.wakeups = 0  # 入力で目を覚ました回数
+        self.idle_seconds = 0.0  # 待っていた実時間
+        self.idle_cpu = 0.0  # 待っている間に使ったCPU時間
+        self.idle_ticks = 0  # 待っている間に経ったtick数 (本来ならその数だけフレームを回していた)
+        self.active_frames = 0
+        self.active_cpu = 0.0  # 通常のフレームに使ったCPU時間
+        self.frame_cpu = deque(maxlen=window)  # 直近の通常のフレームごとのCPU時間
+        self._mark = time.process_time()
+
+    def frame(self):
+        """
+        通常のフレームの終わりに呼ぶ。前の区切りからのCPU時間を通常のフレームの分として数える
+        """
+        now = time.process_time()
+        self.active_cpu += now - self._mark
+        self.frame_cpu.append(now - self._mark)
+        self._mark = now
+        self.active_frames += 1
+
+    def wait(self, ticks=MAX_WAIT_TICKS):
+        """
+        入力が来るか、ticks tick分の時間が経つまでブロックする
+        イベントはキューから取り出さないので、呼び出し側はいつもどおりpg.event.get()で処理する
+        戻り値: 待っている間に経ったtick数 (ticks以下)
+        """
+        ticks = min(ticks, MAX_WAIT_TICKS)
+        start = time.perf_counter()
+        deadline = start + ticks * self.period
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            pg.time.wait(max(1, min(POLL_MS, int(remaining * 1000))))
+            if pg.event.peek():
+                self.wakeups += 1
+                break
+        elapsed = time.perf_counter() - start
+        elapsed_ticks = min(ticks, int(elapsed / self.period))
+        now = time.process_time()
+        self.waits += 1
+        self.idle_seconds += elapsed
+        self.idle_cpu += now - self._mark  # アイドル中にループを1周する分も含める
+        self.idle_ticks += elapsed_ticks
+        self._mark = now
+        return elapsed_ticks
+
+    def saved_cpu(self):
+        """
+        アイドルの間にフレームを回していたら使ったはずのCPU時間から、実際に使った分を引いた見積もり(秒)
+        起動直後の重いフレームに引きずられないよう、1フレームのCPU時間は中央値を使う
+        """
+        return self.idle_ticks * self.typical_frame() - self.idle_cpu
+
+    def typical_frame(self):
+        """直近の通常のフレームが使ったCPU時間の中央値(秒)"""
+        return statistics.median(self.frame_cpu) if self.frame_cpu else 0.0
+
+    def report(self):
+        """
+        アイドルの統計をテレメトリに出して表示する
+        """
+        per_frame = self.typical_frame()
+        saved = self.saved_cpu()
+        telemetry.emit(
+            "idle_stats",
+            waits=self.waits,
+            wakeups=self.wakeups,
+            idle_s=round(self.idle_seconds, 3),
+            idle_ticks=self.idle_ticks,
+            idle_cpu_ms=round(self.idle_cpu * 1000, 3),
+            active_frames=self.active_frames,
+            frame_cpu_ms=round(per_frame * 1000, 3),
+            saved_cpu_ms=round(saved * 1000, 1),
+        )
+        if self.waits:
+            print(
+                f"Idle {self.idle_seconds:.1f} s in {self.waits} waits, "
+                f"saved about {saved * 1000:.0f} ms of CPU ({per_frame * 1000:.2f} ms per frame)"
+            )
@@ -0,0 +1,338 @@
+"""
+たくさんの試合を1つのasyncioイベントループで動かすヘッドレスの対戦サーバー
+
+試合はサーバー側だけで進め(サーバー権威)、クライアントは入力ビットを送って
+毎tickの盤面を受け取るだけにする。すべての試合を1つの固定レートのスケジューラで
+同じtickに進めるので、試合がいくつあってもタイマーやスレッドは増えない。
+
+プロトコル
+  TCP  クライアント -> サーバー: HELLO(最初に1回)、その後は入力ビットを1バイトずつ
+       サーバー -> クライアント: 毎tick STATE + 盤面
+  UDP  クライアント -> サーバー: DATAGRAM(入力を送るたびに)
+       サーバー -> クライアント: 毎tick STATE + 盤面 を1データグラムで
+試合を作るのはTCPのHELLOか、ホストするプログラムからのopen()だけにする。
+UDPは送信元を確かめられないので、知らない試合IDのデータグラムは捨てる。
+試合のそれぞれの側は、最初にその側を名乗ったTCP接続かUDPのアドレスのものになり、
+ほかの相手からその側への入力は捨てる(UDPのアドレスは時間切れで手放す)。
+試合の数はmax_roomsまでで、それを超えるHELLOは断る。
+盤面はエンティティごとのレコードではなく、kind(B), frame(B), x(h), y(h) の
+配列をレコード数分ずつ並べたもの。Worldの配列をそのままバイト列にできるので、
+1エンティティずつpackするより速い
+"""
+
+import asyncio
+import random
+import struct
+import time
+from array import array
+
+import telemetry
+
+MAGIC = b"PVA1"
+HELLO = struct.Struct("<4sIB")  # マジック, 試合ID, 操作する側 (0: Player, 1: Alien)
+DATAGRAM = struct.Struct("<4sIBB")  # マジック, 試合ID, 操作する側, 入力ビット
+STATE = struct.Struct("<IIH8i")  # 試合ID, tick, レコード数, ゲーム固有の値8つ
+STATE_VALUES = 8
+MAX_RECORDS = 512
+UDP_TIMEOUT = 10.0  # この秒数入力が届かないUDPクライアントは切断したものとみなす
+WRITE_LIMIT = 1 << 16  # 送信バッファがこれより溜まっているTCPクライアントにはそのtickの盤面を送らない
+MAX_ROOMS = 1024  # 同時に開いておく試合の数の上限
+
+
+class Room:
+    """
+    1試合分の状態と、その試合につながっているクライアント
+    """
+
+    def __init__(self, match_id, match):
+        self.match_id = match_id
+        self.match = match
+        self.inputs = [0, 0]
+        self.owners = [None, None]  # 側ごとに入力を送ってよい相手 (TCPのwriterかUDPのアドレス)
+        self.writers = set()  # TCPクライアント
+        self.peers = {}  # UDPクライアントのアドレス -> 最後に入力が届いた時刻
+
+    @property
+    def empty(self):
+        return not self.writers and not self.peers
+
+    def encode(self, describe):
+        """
+        今の盤面をSTATE + 盤面のバイト列にする
+        """
+        values, (kind, frame, x, y) = describe(self.match)
+        values = tuple(values) + (0,) * (STATE_VALUES - len(values))
+        count = min(len(kind), MAX_RECORDS)
+        return b"".join((
+            STATE.pack(self.match_id, self.match.tick, count, *values),
+            kind[:count].tobytes(),
+            frame[:count].tobytes(),
+            array("h", x[:count]).tobytes(),
+            array("h", y[:count]).tobytes(),
+        ))
+
+
+class MatchServer:
+    """
+    試合をまとめて進めるサーバー
+    factory : factory(試合ID) で試合を作る。試合はstep(入力0, 入力1)とtickを持つ
+    describe : describe(試合) で (ゲーム固有の値, (kind, frame, x, y)の配列) を返す
+    tick_rate : 1秒あたりのtick数
+    report_interval : 統計を出す間隔(秒)
+    max_rooms : 同時に開いておく試合の数の上限
+    """
+
+    def __init__(self, factory, describe, tick_rate=40, report_interval=5.0, max_rooms=MAX_ROOMS):
+        self.factory = factory
+        self.describe = describe
+        self.tick_rate = tick_rate
+        self.report_interval = report_interval
+        self.max_rooms = max_rooms
+        self.rooms = {}
+        self.rejected = 0  # 試合の数が上限に達していたために断ったHELLOの数
+        self.unknown = 0  # 開いていない試合IDに届いたために捨てたデータグラムの数
+        self.foreign = 0  # ほかの相手が持っている側に届いたために捨てたHELLOとデータグラムの数
+        self.servers = []
+        self.udp = None
+        self.tick = 0
+        self.overruns = 0  # 1tickの予算(1/tick_rate秒)を使い切ったtickの数
+        self.costs = []  # 前回の統計から後の、1tickの処理にかかったCPU時間(このスレッドの分だけ)
+        self.last_report = None
+
+    def open(self, match_id):
+        """
+        試合を開く。すでに開いていればその試合を返す
+        戻り値: Room。試合の数が上限に達していればNone
+        """
+        room = self.rooms.get(match_id)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms:
+                self.rejected += 1
+                telemetry.emit("server_match_rejected", match=match_id, matches=len(self.rooms), rejected=self.rejected)
+                return None
+            room = self.rooms[match_id] = Room(match_id, self.factory(match_id))
+            telemetry.emit("server_match_open", match=match_id, matches=len(self.rooms))
+        return room
+
+    def close_room_if_empty(self, room):
+        if room.empty and self.rooms.get(room.match_id) is room:
+            del self.rooms[room.match_id]
+            telemetry.emit("server_match_close", match=room.match_id, matches=len(self.rooms))
+
+    async def start(self, host="0.0.0.0", tcp_port=50010, udp_port=50010):
+        """
+        TCPとUDPで待ち受けを始める。ポートが0ならOSに選ばせる
+        戻り値: 実際に待ち受けている (TCPのポート, UDPのポート)
+        """
+        loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_tcp, host, tcp_port, backlog=1024)
+        self.servers.append(server)
+        transport, _ = await loop.create_datagram_endpoint(lambda: UdpProtocol(self), local_addr=(host, udp_port))
+        self.udp = transport
+        return server.sockets[0].getsockname()[1], transport.get_extra_info("sockname")[1]
+
+    async def handle_tcp(self, reader, writer):
+        try:
+            magic, match_id, side = HELLO.unpack(await reader.readexactly(HELLO.size))
+        except (asyncio.IncompleteReadError, ConnectionError, struct.error):
+            writer.close()
+            return
+        if magic != MAGIC or side > 1:
+            writer.close()
+            return
+        room = self.open(match_id)
+        if room is None:
+            writer.close()
+            return
+        if room.owners[side] is not None:
+            self.foreign += 1  # その側はもうほかの相手が操作している
+            writer.close()
+            self.close_room_if_empty(room)
+            return
+        room.owners[side] = writer
+        room.writers.add(writer)
+        try:
+            while True:
+                data = await reader.read(256)
+                if not data:
+                    break
+                room.inputs[side] = data[-1]  # 溜まっていたら最新の入力だけを使う
+        except ConnectionError:
+            pass
+        finally:
+            room.writers.discard(writer)
+            room.owners[side] = None
+            room.inputs[side] = 0
+            writer.close()
+            self.close_room_if_empty(room)
+
+    def datagram_received(self, data, addr):
+        if len(data) != DATAGRAM.size:
+            return
+        magic, match_id, side, bits = DATAGRAM.unpack(data)
+        if magic != MAGIC or side > 1:
+            return
+        room = self.rooms.get(match_id)
+        if room is None:
+            self.unknown += 1  # UDPでは試合を作らない。数だけ数えて統計で出す
+            return
+        owner = room.owners[side]
+        if owner is None:
+            room.owners[side] = owner = addr
+        if owner != addr:
+            self.foreign += 1
+            return
+        room.peers[addr] = time.monotonic()
+        room.inputs[side] = bits
+
+    def step(self):
+        """
+        すべての試合を1tick進めて、つながっているクライアントに盤面を送る
+        """
+        self.tick += 1
+        now = time.monotonic()
+        describe = self.describe
+        udp = self.udp
+        for room in list(self.rooms.values()):
+            room.match.step(*room.inputs)
+            if not room.writers and not room.peers:
+                continue
+            state = room.encode(describe)
+            for writer in room.writers:
+                if writer.transport.get_write_buffer_size() < WRITE_LIMIT:
+                    writer.write(state)
+            if room.peers:
+                for addr, seen in list(room.peers.items()):
+                    if now - seen > UDP_TIMEOUT:
+                        del room.peers[addr]
+                        for side, owner in enumerate(room.owners):
+                            if owner == addr:
+                                room.owners[side] = None
+                                room.inputs[side] = 0
+                    else:
+                        udp.sendto(state, addr)
+                self.close_room_if_empty(room)
+
+    async def run(self, duration=None):
+        """
+        固定レートで全試合を進め続ける。durationを指定するとその秒数で止まる
+        遅れたtickは取り戻そうとせず、次のtickの時刻を今に合わせ直す
+        """
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.tick_rate
+        start = next_tick = loop.time()
+        self.last_report = start
+        while duration is None or loop.time() - start < duration:
+            cpu = time.thread_time()
+            self.step()
+            cost = time.thread_time() - cpu
+            self.costs.append(cost)
+            if cost > period:
+                self.overruns += 1
+            now = loop.time()
+            if now - self.last_report >= self.report_interval:
+                self.report(now - self.last_report)
+                self.last_report = now
+            next_tick += period
+            delay = next_tick - loop.time()
+            if delay < -period:
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(max(0.0, delay))
+
+    def report(self, elapsed):
+        """
+        1tickあたりのCPU時間と、40Hzを保てる試合数の見積もりを出す
+        見積もりは99パーセンタイルのtick時間を試合数で割った1試合あたりの時間から求める
+        """
+        costs = sorted(self.costs)
+        self.costs = []
+        if not costs:
+            return
+        mean = sum(costs) / len(costs)
+        p99 = costs[min(len(costs) - 1, int(len(costs) * 0.99))]
+        matches = len(self.rooms)
+        budget = 1.0 / self.tick_rate
+        capacity = int(budget / (p99 / matches)) if matches and p99 > 0 else 0
+        stats = {
+            "matches": matches,
+            "ticks": len(costs),
+            "tick_hz": round(len(costs) / elapsed, 1),
+            "mean_ms": round(mean * 1000, 3),
+            "p99_ms": round(p99 * 1000, 3),
+            "max_ms": round(costs[-1] * 1000, 3),
+            "overruns": self.overruns,
+            "capacity": capacity,
+            "rejected": self.rejected,
+            "unknown_datagrams": self.unknown,
+            "foreign_inputs": self.foreign,
+        }
+        telemetry.emit("server_tick_stats", **stats)
+        print(
+            f"matches={matches} tick={stats['tick_hz']}Hz cpu/tick mean={stats['mean_ms']}ms "
+            f"p99={stats['p99_ms']}ms max={stats['max_ms']}ms overruns={self.overruns} "
+            f"max matches at {self.tick_rate}Hz~{capacity}"
+        )
+        return stats
+
+    def close(self):
+        for server in self.servers:
+            server.close()
+        if self.udp is not None:
+            self.udp.close()
+
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+
+async def bot(host, port, match_id, side, tick_rate=40, seed=None):
+    """
+    負荷試験用のクライアント。TCPでつないでランダムな入力を送り、届いた盤面は読み捨てる
+    """
+    rng = random.Random(seed)
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(HELLO.pack(MAGIC, match_id, side))
+
+    async def drain():
+        while await reader.read(1 << 16):
+            pass
+
+    reading = asyncio.ensure_future(drain())
+    bits = 0
+    try:
+        while not reading.done():
+            if rng.random() < 0.1:
+                bits = rng.randrange(64)  # 同じ入力をしばらく押し続ける
+            writer.write(bytes((bits,)))
+            await asyncio.sleep(1.0 / tick_rate)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        reading.cancel()
+        writer.close()
+
+
+async def serve(server, host="0.0.0.0", port=50010, bots=0, duration=None):
+    """
+    サーバーを起動して動かし続ける
+    bots : 負荷試験として、ローカルのTCPクライアントでつなぐ試合の数
+    """
+    tcp_port, udp_port = await server.start(host, port, port)
+    print(f"Match server listening on tcp:{tcp_port} udp:{udp_port}")
+    tasks = [
+        asyncio.ensure_future(bot("127.0.0.1", tcp_port, match_id, side, server.tick_rate, match_id * 2 + side))
+        for match_id in range(bots)
+        for side in (0, 1)
+    ]
+    try:
+        await server.run(duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        server.close()
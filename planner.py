@@ -0,0 +1,145 @@
+"""
+CPU対戦相手のための時間制限つき先読み(anytime探索)
+
+ゲームループは毎フレームobserve()で今の盤面のスナップショットを渡し、
+それまでに見つかっている一番よい手を受け取るだけなので、呼び出しは探索の
+重さに関係なくすぐ戻る。探索は別スレッドで、ゲームと同じMatchをもう1つ作り、
+候補の手ごとにsave()した状態からload()しては実際にstep()して結果を評価する。
+物理や当たり判定を別に書き直さないので、弾の軌道や相手の動きの予測はゲーム本体と
+ずれない。
+
+探索は先読みの深さを浅い順に広げ(反復深化)、深さごとに全候補を評価し終えたら
+その深さでの一番よい手を公開する。1フレームに使うCPU時間はbudgetまでで、
+使い切ったら途中の深さは捨てて次の盤面を待つ。新しい盤面が届いたときも
+そこで打ち切ってやり直す。公開した手は常に評価し終えた深さのものなので、
+いつ打ち切っても手が返る。
+"""
+
+import threading
+import time
+
+import telemetry
+
+YIELD_INTERVAL = 0.0005  # 探索スレッドがGILを手放す間隔(秒)。ゲームループを待たせるのは長くてもこれくらい
+
+
+class AnytimePlanner:
+    """
+    別スレッドで先読みする探索
+    factory : factory() で探索用の試合を作る。試合はrestore(), save(), load(), step(), winnerを持つ
+    candidates : 候補の手のリスト。同じ評価なら前にあるものを選ぶ
+    inputs : inputs(手, 何tick目か, context) で (Playerの入力ビット, Alienの入力ビット) を返す
+    evaluate : evaluate(試合, 進めたtick数, context) で盤面の評価値を返す。大きいほどよい
+    budget : 1フレーム(1回のobserve)あたりに探索に使うCPU時間(秒)
+    depths : 先読みするtick数。浅い順に試す
+    """
+
+    def __init__(self, factory, candidates, inputs, evaluate, budget=0.002, depths=(4, 8, 16, 32)):
+        self.factory = factory
+        self.candidates = list(candidates)
+        self.inputs = inputs
+        self.evaluate = evaluate
+        self.budget = budget
+        self.depths = depths
+        self.best = self.candidates[0]
+        self.depth = 0  # bestを選んだときの深さ。0ならまだ探索していない
+        self._pending = None  # まだ探索を始めていない (スナップショット, context)
+        self._condition = threading.Condition()
+        self._stop = False
+        # 統計
+        self.searches = 0
+        self.rollouts = 0
+        self.depth_counts = {depth: 0 for depth in (0,) + tuple(depths)}  # 公開した深さごとの探索の数
+        self.max_search = 0.0  # 1回の探索に使った最大のCPU時間
+        self.max_observe = 0.0  # observe()にかかった最大の時間
+        self._thread = threading.Thread(target=self._run, name="cpu-planner", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def observe(self, snapshot, context=None):
+        """
+        ゲームループから毎フレーム呼ぶ。盤面を探索スレッドに渡し、今までで一番よい手を返す
+        返る手はひとつ前までの盤面で選んだもの
+        """
+        start = time.perf_counter()
+        with self._condition:
+            self._pending = (snapshot, context)
+            self._condition.notify()
+        best = self.best
+        self.max_observe = max(self.max_observe, time.perf_counter() - start)
+        return best
+
+    def close(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        telemetry.emit(
+            "cpu_planner_stats",
+            searches=self.searches,
+            rollouts=self.rollouts,
+            depths={str(depth): count for depth, count in self.depth_counts.items()},
+            max_search_ms=round(self.max_search * 1000, 3),
+            max_observe_ms=round(self.max_observe * 1000, 3),
+        )
+
+    def _run(self):
+        match = self.factory()
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    return
+                snapshot, context = self._pending
+                self._pending = None
+            self._search(match, snapshot, context)
+
+    def _search(self, match, snapshot, context):
+        start = time.thread_time()
+        deadline = start + self.budget
+        match.restore(snapshot)
+        base = match.save()
+        # 前の盤面で一番よかった手から試すと、浅いところで打ち切られても同じ手を保ちやすい
+        order = [self.best] + [candidate for candidate in self.candidates if candidate != self.best]
+        published = 0
+        yielded = start
+        for depth in self.depths:
+            best = best_score = None
+            for candidate in order:
+                score = self._rollout(match, base, candidate, depth, context, deadline)
+                if score is None:
+                    break
+                if time.thread_time() - yielded > YIELD_INTERVAL:
+                    time.sleep(0)  # GILを手放してゲームループを待たせない
+                    yielded = time.thread_time()
+                if best_score is None or score > best_score or (
+                    score == best_score and self.candidates.index(candidate) < self.candidates.index(best)
+                ):
+                    best, best_score = candidate, score
+            else:
+                self.best, self.depth, published = best, depth, depth
+                order = [best] + [candidate for candidate in order if candidate != best]
+                continue
+            break
+        self.searches += 1
+        self.depth_counts[published] += 1
+        self.max_search = max(self.max_search, time.thread_time() - start)
+
+    def _rollout(self, match, base, candidate, depth, context, deadline):
+        """
+        候補の手でdepth tick進めて評価する。途中で時間切れになるか、新しい盤面が届いたらNone
+        """
+        match.load(base)
+        inputs = self.inputs
+        ticks = 0
+        while ticks < depth and match.winner is None:
+            if time.thread_time() > deadline or self._pending is not None or self._stop:
+                return None
+            match.step(*inputs(candidate, ticks, context))
+            ticks += 1
+        self.rollouts += 1
+        return self.evaluate(match, ticks, context)
@@ -0,0 +1,281 @@
+"""
+ロールバック方式のオンライン対戦
+
+自分の入力はすぐに反映し、まだ届いていない相手の入力は最後に届いた入力が
+続くものとして予測して進める。相手の本当の入力が届いて予測と違っていたら、
+そのフレームの直前に保存しておいた状態に戻し、今のフレームまでまとめて
+シミュレーションし直す(再シミュレーション)。
+
+通信はUDPで、パケットには相手がまだ受け取っていない自分の入力をまとめて入れるので、
+途中のパケットが落ちても次のパケットで埋め合わせられる。
+LossyTransportで遅延と欠落を加えれば、ローカルのループバックで回線の悪い状態を再現できる。
+
+予測で進めたフレームのイベント(命中や決着)は、予測が外れれば起きなかったことになる。
+そこでフレームごとのイベントはテレメトリに出さずに保存した状態と一緒に持っておき、
+進め直したら入れ替え、相手の入力が揃って確定したフレームの分だけを順に出す。
+"""
+
+import heapq
+import random
+import socket
+import struct
+import time
+
+import telemetry
+
+MAGIC = 0x5254
+# マジック, 先頭の入力のフレーム, 受信済みの相手の入力の最終フレーム, 入力の数
+PACKET = struct.Struct("<HiiB")
+MAX_INPUTS = 64  # 1パケットに入れる入力の最大数
+
+
+class UdpTransport:
+    """
+    ノンブロッキングのUDPソケット
+    local_addr : 待ち受けるアドレス
+    peer_addr : 相手のアドレス。Noneなら最初に届いたパケットの送信元を相手にする
+                相手が決まったら、それ以外のアドレスから届いたパケットは捨てる
+    """
+
+    def __init__(self, local_addr, peer_addr=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(local_addr)
+        self.sock.setblocking(False)
+        if peer_addr is not None:
+            # recvfromの送信元と比べられるよう、ホスト名はIPアドレスにしておく
+            peer_addr = (socket.gethostbyname(peer_addr[0]), peer_addr[1])
+        self.peer_addr = peer_addr
+
+    @property
+    def address(self):
+        return self.sock.getsockname()
+
+    def send(self, data):
+        if self.peer_addr is None:
+            return
+        try:
+            self.sock.sendto(data, self.peer_addr)
+        except OSError:
+            pass  # 相手がまだ起動していないなど。UDPなので落ちたものとして扱う
+
+    def receive(self):
+        """
+        届いているデータグラムを全部返す
+        """
+        packets = []
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except (BlockingIOError, ConnectionResetError):
+                return packets
+            if self.peer_addr is None:
+                self.peer_addr = addr
+            elif addr != self.peer_addr:
+                continue  # 相手以外から届いたものは捨てる
+            packets.append(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class LossyTransport:
+    """
+    送信するパケットに遅延・ゆらぎ・欠落を加えるラッパー(回線の悪い状態の再現用)
+    delay : 片道の遅延(秒)
+    jitter : 遅延に加えるゆらぎの最大値(秒)
+    loss : パケットを捨てる確率
+    """
+
+    def __init__(self, transport, delay=0.0, jitter=0.0, loss=0.0, seed=None):
+        self.transport = transport
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.queue = []  # (送る時刻, 連番, データ) のヒープ
+        self.sequence = 0
+
+    @property
+    def address(self):
+        return self.transport.address
+
+    def send(self, data):
+        if self.rng.random() < self.loss:
+            return
+        self.sequence += 1
+        due = time.perf_counter() + self.delay + self.rng.uniform(0, self.jitter)
+        heapq.heappush(self.queue, (due, self.sequence, data))
+        self.flush()
+
+    def flush(self):
+        """
+        送る時刻が来たパケットを実際に送る
+        """
+        now = time.perf_counter()
+        while self.queue and self.queue[0][0] <= now:
+            self.transport.send(heapq.heappop(self.queue)[2])
+
+    def receive(self):
+        self.flush()
+        return self.transport.receive()
+
+    def close(self):
+        self.transport.close()
+
+
+def loopback_pair(delay=0.0, jitter=0.0, loss=0.0, seed=None):
+    """
+    127.0.0.1上でつながったUDPの組を作る。delayなどを指定するとLossyTransportで包む
+    戻り値: (0番側, 1番側)
+    """
+    a = UdpTransport(("127.0.0.1", 0))
+    b = UdpTransport(("127.0.0.1", 0), a.address)
+    a.peer_addr = b.address
+    if delay or jitter or loss:
+        rng = random.Random(seed)
+        a = LossyTransport(a, delay, jitter, loss, rng.random())
+        b = LossyTransport(b, delay, jitter, loss, rng.random())
+    return a, b
+
+
+class RollbackSession:
+    """
+    1人分のロールバックの進行役
+    sim : save(), load(state), step(入力0, 入力1)とrecorded属性を持つシミュレーション
+          recordedがリストの間、simはイベントをテレメトリに出さずにそこへ(名前, 値)を溜める
+    transport : send(data)とreceive()を持つ通信路
+    local_index : 自分の入力が何番目か (0か1)
+    max_rollback : 巻き戻せる最大フレーム数。相手の入力がこれ以上遅れたら追いつくまで待つ
+    frame : 次にシミュレーションするフレーム番号
+    """
+
+    def __init__(self, sim, transport, local_index, max_rollback=12):
+        self.sim = sim
+        self.transport = transport
+        self.local_index = local_index
+        self.max_rollback = max_rollback
+        self.frame = 0
+        self.local_inputs = {}  # フレーム -> 自分の入力
+        self.remote_inputs = {}  # フレーム -> 届いた相手の入力
+        self.used = {}  # フレーム -> シミュレーションで使った相手の入力(予測を含む)
+        self.states = {}  # フレーム -> そのフレームを進める前の状態
+        self.events = {}  # フレーム -> そのフレームで起きたイベント。確定したら出す
+        self.remote_frame = -1  # 相手の入力がここまで途切れずに届いている
+        self.acked = -1  # 相手が自分の入力をここまで受け取っている
+        self.rollback_from = None  # 予測が外れていた最初のフレーム
+        # 統計
+        self.rollbacks = 0
+        self.stalls = 0
+        self.max_resim_frames = 0
+        self.max_resim_seconds = 0.0
+
+    def advance(self, local_bits):
+        """
+        1フレーム進める
+        戻り値: 今のフレームのstep()の戻り値。相手を待つために進めなかったらNone
+        """
+        self.poll()
+        if self.frame - (self.remote_frame + 1) >= self.max_rollback:
+            # これ以上進むと巻き戻せなくなるので、相手の入力が届くまで待つ
+            self.stalls += 1
+            self.send()
+            return None
+        if self.rollback_from is not None:
+            self.resimulate()
+        self.local_inputs[self.frame] = local_bits
+        result = self.simulate(self.frame)
+        self.frame += 1
+        self.send()
+        self.prune()
+        return result
+
+    def simulate(self, frame):
+        """
+        frameの直前の状態を保存してから1フレーム進める
+        """
+        remote = self.remote_inputs.get(frame)
+        if remote is None:
+            remote = self.remote_inputs.get(self.remote_frame, 0)  # 最後に届いた入力が続くと予測する
+        self.used[frame] = remote
+        self.states[frame] = self.sim.save()
+        inputs = (self.local_inputs[frame], remote) if self.local_index == 0 else (remote, self.local_inputs[frame])
+        self.sim.recorded = self.events[frame] = []  # 進め直したら前のイベントは捨てる
+        try:
+            return self.sim.step(*inputs)
+        finally:
+            self.sim.recorded = None
+
+    def resimulate(self):
+        """
+        予測が外れていたフレームまで戻り、今のフレームまでまとめて進め直す
+        """
+        start = time.perf_counter()
+        first = self.rollback_from
+        self.rollback_from = None
+        self.sim.load(self.states[first])
+        for frame in range(first, self.frame):
+            self.simulate(frame)  # イベントは入れ替わるだけで、確定するまで出さない
+        elapsed = time.perf_counter() - start
+        frames = self.frame - first
+        self.rollbacks += 1
+        self.max_resim_frames = max(self.max_resim_frames, frames)
+        self.max_resim_seconds = max(self.max_resim_seconds, elapsed)
+        telemetry.emit("rollback", frame=self.frame, frames=frames, ms=round(elapsed * 1000, 3))
+
+    def poll(self):
+        """
+        届いたパケットから相手の入力を取り込み、予測と違っていたら巻き戻す位置を記録する
+        """
+        for data in self.transport.receive():
+            if len(data) < PACKET.size:
+                continue
+            magic, first, ack, count = PACKET.unpack_from(data)
+            if magic != MAGIC or len(data) < PACKET.size + count:
+                continue
+            # まだ送っていないフレームまで受け取ったという確認は信じない
+            self.acked = max(self.acked, min(ack, self.frame - 1))
+            horizon = self.remote_frame + MAX_INPUTS + self.max_rollback  # 正しい相手はここより先の入力を送らない
+            for offset, bits in enumerate(data[PACKET.size:PACKET.size + count]):
+                frame = first + offset
+                if frame >= horizon:
+                    break
+                if frame <= self.remote_frame or frame in self.remote_inputs:
+                    continue
+                self.remote_inputs[frame] = bits
+                used = self.used.get(frame)
+                if used is not None and used != bits and frame < self.frame:
+                    if self.rollback_from is None or frame < self.rollback_from:
+                        self.rollback_from = frame
+            while self.remote_frame + 1 in self.remote_inputs:
+                self.remote_frame += 1
+
+    def send(self):
+        """
+        相手がまだ受け取っていない自分の入力をまとめて送る
+        """
+        first = max(self.acked + 1, self.frame - MAX_INPUTS)
+        inputs = bytes(self.local_inputs[frame] for frame in range(first, self.frame))
+        self.transport.send(PACKET.pack(MAGIC, first, self.remote_frame, len(inputs)) + inputs)
+
+    def prune(self):
+        """
+        もう巻き戻すことのないフレームの状態と、相手に届いた入力を捨てる
+        確定したフレームのイベントはここでフレーム順にテレメトリに出す
+        """
+        confirmed = self.remote_frame + 1  # ここより前のフレームは予測が入っていない
+        for frame in sorted(frame for frame in self.states if frame < confirmed):
+            del self.states[frame]
+            del self.used[frame]
+            for event, fields in self.events.pop(frame):
+                telemetry.emit(event, **fields)
+        for frame in [frame for frame in self.local_inputs if frame <= self.acked and frame < confirmed]:
+            del self.local_inputs[frame]
+        for frame in [frame for frame in self.remote_inputs if frame < self.remote_frame]:
+            del self.remote_inputs[frame]
+
+    def close(self):
+        telemetry.emit(
+            "rollback_stats", frames=self.frame, rollbacks=self.rollbacks, stalls=self.stalls,
+            max_resim_frames=self.max_resim_frames, max_resim_ms=round(self.max_resim_seconds * 1000, 3),
+        )
+        self.transport.close()
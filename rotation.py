@@ -0,0 +1,99 @@
+"""
+向きを持つ弾のための、角度を量子化した回転済み画像のキャッシュ
+
+弾の向きは速度ベクトルから求め、STEP度ごとに丸めた番号にしてframeに入れる。
+frameはシミュレーション側で決まる数値なので、画像を持たないMatchでもそのまま計算でき、
+共有メモリや観戦用の配信でも1バイトのまま送れる。
+描画側はRotationCacheをアーキタイプのimagesの代わりに置く。cache[frame]で
+その角度に回した画像が返り、まだ作っていない角度はその場で1回だけ回転して覚えておく。
+よく使う角度はアセットの読み込み時にprewarm()で作っておき、覚えておく枚数は
+capacityまでに抑えて、長く使われていない角度から捨てる。
+
+回した画像ごとにマスクも作っておき、mask(frame)で当たり判定に渡す。斜めに回した弾は
+矩形の角に透明な部分が多いので、World.collide()は矩形が重なったあとマスクでも確かめる。
+"""
+
+import math
+from collections import OrderedDict
+
+import pygame as pg
+
+STEP = 5  # 角度を丸める単位(度)
+ANGLES = 360 // STEP
+
+
+def heading_frame(base, dx, dy, native=0):
+    """
+    速度(dx, dy)で進む弾のframe
+    base : 元の画像の番号
+    native : 元の画像が向いている方向 (画面の上を0として時計回りの度。下向きなら180)
+    """
+    heading = math.degrees(math.atan2(dx, -dy)) - native
+    return base * ANGLES + round(heading / STEP) % ANGLES
+
+
+class RotationCache:
+    """
+    回転済み画像のキャッシュ。imagesのリストの代わりにframeで引ける
+    images : 元の画像のリスト。画像の番号はここの添字
+             ピクセルごとのアルファを持たない画像はconvert_alpha()して、カラーキーの色を透明にしてから回す
+    capacity : 覚えておく回転済み画像の数の上限
+    """
+
+    def __init__(self, images, capacity=48):
+        if len(images) * ANGLES > 256:
+            raise ValueError("too many images to fit the angle in one byte")
+        # convert()した画像を回すと、広がった角がカラーキーではない色で埋まることがある
+        self.images = [image if image.get_flags() & pg.SRCALPHA else image.convert_alpha() for image in images]
+        self.capacity = capacity
+        self.entries = OrderedDict()  # frame -> (画像, 元の画像に中心を合わせるためのずれ, マスク)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.images) * ANGLES
+
+    def __getitem__(self, frame):
+        return self.entry(frame)[0]
+
+    def offset(self, frame):
+        """
+        frameの画像を、元の画像と中心が同じになるように描くための左上のずれ
+        """
+        return self.entry(frame)[1]
+
+    def mask(self, frame):
+        """
+        frameの画像のマスクと、エンティティの左上からのずれ
+        """
+        _, offset, mask = self.entry(frame)
+        return mask, offset
+
+    def entry(self, frame):
+        entries = self.entries
+        entry = entries.get(frame)
+        if entry is not None:
+            self.hits += 1
+            entries.move_to_end(frame)
+            return entry
+        self.misses += 1
+        base, index = divmod(frame, ANGLES)
+        image = self.images[base]
+        rotated = pg.transform.rotate(image, -index * STEP)
+        entry = entries[frame] = (
+            rotated,
+            ((image.get_width() - rotated.get_width()) // 2, (image.get_height() - rotated.get_height()) // 2),
+            pg.mask.from_surface(rotated),
+        )
+        if len(entries) > self.capacity:
+            entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def prewarm(self, frames):
+        """
+        アセットの読み込み時に、よく使うframeを先に作っておく
+        """
+        for frame in frames:
+            self.entry(frame)
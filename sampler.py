@@ -0,0 +1,167 @@
+"""
+ホットキーやシグナルで起動するサンプリングプロファイラ
+
+起動すると別スレッドが一定間隔でsys._current_frames()からメインスレッドの
+スタックを読み、決めた秒数がたったらファイルに書き出して自分で止まる。
+ゲームを止めたりcProfileで起動し直したりせずに、フレームレートが落ちている
+その場で計測できる。メインスレッドには何も仕掛けないので、計測中の負荷は
+サンプリングスレッドがGILを取る分だけになる。
+
+出力 (logs/profile-<時刻>.*)
+  .collapsed  flamegraph.plやspeedscopeにそのまま渡せる「関数;関数;... 回数」の形式
+  .pstats     サンプル数から作ったpstatsのデータ。python -m pstatsで読める
+"""
+
+import marshal
+import os
+import signal
+import sys
+import threading
+import time
+
+import telemetry
+
+MAX_DEPTH = 128  # これより深いスタックは根元を切り捨てる
+
+
+class SamplingProfiler:
+    """
+    サンプリングプロファイラ
+    directory : 出力先
+    duration : 1回の計測の秒数
+    interval : サンプリングの間隔(秒)
+    thread_id : 計測するスレッド。Noneなら作ったスレッド
+    """
+
+    def __init__(self, directory, duration=5.0, interval=0.005, thread_id=None):
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        計測を始める。計測中なら何もしない
+        """
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        計測を途中で止める。それまでのサンプルは書き出される
+        """
+        self._stop.set()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self):
+        stacks = {}  # スタック(根元から順の関数のタプル) -> サンプル数
+        start = time.perf_counter()
+        telemetry.emit("profiler_start", duration=self.duration, interval=self.interval)
+        while not self._stop.wait(self.interval) and time.perf_counter() - start < self.duration:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break  # 計測するスレッドが終わった
+            stack = []
+            while frame is not None and len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            del frame
+            stack = tuple(reversed(stack))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        elapsed = time.perf_counter() - start
+        paths = self.write(stacks, elapsed)
+        telemetry.emit("profiler_stop", samples=sum(stacks.values()), seconds=round(elapsed, 3), path=paths[0])
+        print(f"Profile written to {paths[0]} and {paths[1]}")
+
+    def write(self, stacks, elapsed):
+        """
+        集めたスタックをcollapsed形式とpstats形式で書き出す
+        戻り値: (collapsedのパス, pstatsのパス)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S"))
+        base, f = claim(stamp, ".collapsed")
+        with f:
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True):
+                f.write(";".join(f"{os.path.basename(file)}:{name}" for file, _, name in stack))
+                f.write(f" {count}\n")
+        with open(base + ".pstats", "wb") as f:
+            marshal.dump(to_pstats(stacks, elapsed / max(1, sum(stacks.values()))), f)
+        return base + ".collapsed", base + ".pstats"
+
+
+def claim(stem, ext):
+    """
+    まだないファイル名を選んで作る。同じ秒に取ったプロファイルは stem-1, stem-2, ... にして上書きしない
+    戻り値: (拡張子を除いたパス, 書き込み用に開いたファイル)
+    """
+    base, number = stem, 0
+    while True:
+        try:
+            return base, open(base + ext, "x", encoding="utf-8")
+        except FileExistsError:
+            number += 1
+            base = f"{stem}-{number}"
+
+
+def to_pstats(stacks, seconds_per_sample):
+    """
+    サンプルをpstatsが読める形 {関数: (呼び出し数, 呼び出し数, 自身の時間, 累積時間, {呼び出し元: ...})} にする
+    呼び出し数の代わりにその関数が現れたサンプル数を入れる
+    """
+    stats = {}
+    for stack, count in stacks.items():
+        seconds = count * seconds_per_sample
+        seen = set()
+        for depth, function in enumerate(stack):
+            calls, _, own, cumulative, callers = stats.get(function, (0, 0, 0.0, 0.0, {}))
+            if depth == len(stack) - 1:
+                own += seconds
+            if function not in seen:  # 再帰していても累積時間は1回だけ数える
+                seen.add(function)
+                calls += count
+                cumulative += seconds
+            if depth:
+                caller = stack[depth - 1]
+                c_calls, _, c_own, c_cumulative = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (
+                    c_calls + count, c_calls + count,
+                    c_own + (seconds if depth == len(stack) - 1 else 0.0), c_cumulative + seconds,
+                )
+            stats[function] = (calls, calls, own, cumulative, callers)
+    return stats
+
+
+_active = None
+
+
+def install(directory, duration=5.0, interval=0.005):
+    """
+    呼んだスレッドを計測するプロファイラを用意し、使えればSIGUSR1で起動できるようにする
+    """
+    global _active
+    _active = SamplingProfiler(directory, duration, interval)
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, lambda signum, frame: _active.start())
+    return _active
+
+
+def toggle():
+    """ホットキーから呼ぶ。計測中なら止め、そうでなければ始める"""
+    if _active is not None:
+        _active.toggle()
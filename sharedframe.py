@@ -0,0 +1,124 @@
+"""
+シミュレーションプロセスと描画プロセスで共有するダブルバッファ
+
+multiprocessing.shared_memoryの1ブロックを次のように分けて使う。
+  [latest]          最後に書き終わったバッファの番号
+  [input]           描画プロセス -> シミュレーションプロセスの入力
+  [buffer 0][buffer 1]  シミュレーションプロセス -> 描画プロセスの盤面
+
+書き込み側は最新でない方のバッファに書いてからlatestを切り替える。
+各ブロックは先頭にシーケンス番号を持ち、書き込み中は奇数になる(シーケンスロック)。
+読み込み側は前後でシーケンス番号が変わっていなければ完全なデータとみなすので、
+どちらの側もロックを取らずに済む。
+Struct.pack_intoは書き込む範囲を一度0で埋めてから値を書くので、シーケンス番号と
+中身を同じpack_intoで書くと、読み込み側が偶数の番号と書きかけの中身を同時に見ることがある。
+中身はシーケンス番号を除いたStructで奇数のうちに書き、偶数の番号は最後に単独で書く。
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+LATEST = struct.Struct("<I4x")
+SEQ = struct.Struct("<I")
+INPUT = struct.Struct("<I4i")  # seq, 入力値4つ
+INPUT_BODY = struct.Struct("<4i")  # INPUTのseqより後ろ
+HEADER = struct.Struct("<IIH2x8i")  # seq, tick, 件数, ゲーム固有の値8つ
+HEADER_BODY = struct.Struct("<IH2x8i")  # HEADERのseqより後ろ
+RECORD = struct.Struct("<BBhh")  # 種類, 画像番号, x, y
+INPUT_VALUES = 4
+HEADER_VALUES = 8
+
+
+class SharedFrame:
+    """
+    共有メモリ上のダブルバッファ
+    name : 既存のブロックに接続するときの名前。Noneなら新しく作る
+    capacity : 1バッファに入れられるレコードの最大数
+    """
+
+    def __init__(self, name=None, capacity=512):
+        self.capacity = capacity
+        self.buffer_size = HEADER.size + RECORD.size * capacity
+        self.input_offset = LATEST.size
+        self.buffer_offset = self.input_offset + INPUT.size
+        size = self.buffer_offset + self.buffer_size * 2
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.buf = self.shm.buf
+        if self.owner:
+            self.buf[:size] = bytes(size)
+        self._input_seq = 0
+        self._seqs = [0, 0]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def write_input(self, *values):
+        """
+        描画プロセスから入力値(最大4つ)を書き込む
+        """
+        self._input_seq += 1
+        SEQ.pack_into(self.buf, self.input_offset, self._input_seq * 2 - 1)  # 奇数: 書き込み中
+        values = tuple(values) + (0,) * (INPUT_VALUES - len(values))
+        INPUT_BODY.pack_into(self.buf, self.input_offset + SEQ.size, *values)
+        SEQ.pack_into(self.buf, self.input_offset, self._input_seq * 2)  # 偶数: 書き込み完了
+
+    def read_input(self):
+        """
+        シミュレーションプロセスから最新の入力値を読む
+        """
+        while True:
+            seq, *values = INPUT.unpack_from(self.buf, self.input_offset)
+            if seq % 2 == 0 and SEQ.unpack_from(self.buf, self.input_offset)[0] == seq:
+                return values
+
+    def publish(self, tick, values, records):
+        """
+        最新でない方のバッファに盤面を書き込み、書き終わったらlatestを切り替える
+        values : ゲーム固有の値(最大8つ)
+        records : (種類, 画像番号, x, y) のイテラブル。capacityを超えた分は捨てる
+        """
+        index = 1 - LATEST.unpack_from(self.buf, 0)[0]
+        offset = self.buffer_offset + self.buffer_size * index
+        seq = self._seqs[index] + 1
+        SEQ.pack_into(self.buf, offset, seq)  # 奇数: 書き込み中
+        count = 0
+        record_offset = offset + HEADER.size
+        buf = self.buf
+        pack_into = RECORD.pack_into
+        for record in records:
+            if count == self.capacity:
+                break
+            pack_into(buf, record_offset, *record)
+            record_offset += RECORD.size
+            count += 1
+        values = tuple(values) + (0,) * (HEADER_VALUES - len(values))
+        HEADER_BODY.pack_into(buf, offset + SEQ.size, tick, count, *values)
+        SEQ.pack_into(buf, offset, seq + 1)  # 偶数: 書き込み完了
+        self._seqs[index] = seq + 1
+        LATEST.pack_into(buf, 0, index)
+
+    def read(self):
+        """
+        最後に書き終わったバッファを読む
+        戻り値: (tick, values, records)
+        共有メモリを直接読み、途中で書き換えられていたら読み直す
+        """
+        buf = self.buf
+        while True:
+            index = LATEST.unpack_from(buf, 0)[0]
+            offset = self.buffer_offset + self.buffer_size * index
+            seq, tick, count, *values = HEADER.unpack_from(buf, offset)
+            if seq % 2:
+                continue
+            start = offset + HEADER.size
+            records = list(RECORD.iter_unpack(buf[start:start + RECORD.size * count]))
+            if SEQ.unpack_from(buf, offset)[0] == seq:
+                return tick, values, records
@@ -0,0 +1,59 @@
+"""
+スナップショット(バイト列)同士の差分
+
+delta()は新しいスナップショットのうち古いものと違うチャンクだけを並べ、
+apply_delta()は古いスナップショットにそれを重ねて新しいスナップショットを作る。
+World.snapshot()は配列の位置が変わりにくいレイアウトなので、
+1tick分の差分は元の大きさの数分の1程度になる。
+"""
+
+import struct
+
+DELTA = struct.Struct("<4sII")  # マジック, 新しいスナップショットの長さ, 変化した区間の数
+DELTA_MAGIC = b"DLT1"
+RUN = struct.Struct("<II")  # 区間の開始位置, 長さ
+CHUNK = 16  # 比較の単位(バイト)
+
+
+def delta(old, new):
+    """
+    oldからnewへの差分をバイト列で返す
+    """
+    old = memoryview(old)
+    new = memoryview(new)
+    runs = []
+    start = None
+    for offset in range(0, len(new), CHUNK):
+        if new[offset:offset + CHUNK] != old[offset:offset + CHUNK]:
+            if start is None:
+                start = offset
+        elif start is not None:
+            runs.append((start, offset))
+            start = None
+    if start is not None:
+        runs.append((start, len(new)))
+    parts = [DELTA.pack(DELTA_MAGIC, len(new), len(runs))]
+    for start, end in runs:
+        parts.append(RUN.pack(start, end - start))
+        parts.append(new[start:end])
+    return b"".join(parts)
+
+
+def apply_delta(old, patch):
+    """
+    oldにdelta()の差分を適用して新しいスナップショットを返す
+    """
+    magic, length, count = DELTA.unpack_from(patch)
+    if magic != DELTA_MAGIC:
+        raise ValueError("not a snapshot delta")
+    result = bytearray(old[:length])
+    if len(result) < length:
+        result.extend(bytes(length - len(result)))
+    patch = memoryview(patch)
+    offset = DELTA.size
+    for _ in range(count):
+        start, size = RUN.unpack_from(patch, offset)
+        offset += RUN.size
+        result[start:start + size] = patch[offset:offset + size]
+        offset += size
+    return bytes(result)
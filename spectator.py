@@ -0,0 +1,279 @@
+"""
+観戦用の盤面配信
+
+ゲームループは毎tick publish()を呼ぶだけで、エンコード済みのメッセージを
+上限つきのキューに入れたら戻る。キューが溢れたら捨てるので、観戦者が何人いても、
+どれだけ遅くてもゲームループは待たされない。
+配信スレッドがキューを読み、つながっているTCPの観戦者全員に送る。
+
+メッセージは一定間隔のキーフレーム(盤面全体)と、その間の差分
+(直前のキーフレームに対するsnapshot.delta())からなる。差分は常に最後の
+キーフレームに対するものなので、途中を落としても次のメッセージから正しく復元できる。
+送り切れずに溜まった観戦者は、溜まった分を捨てて最新のキーフレームからやり直させる。
+"""
+
+import queue
+import selectors
+import socket
+import struct
+import threading
+from array import array
+from collections import deque
+
+import telemetry
+from snapshot import apply_delta, delta
+
+# 盤面: ヘッダーのあとにkind(B), frame(B), x(h), y(h)の配列を容量分ずつ並べる
+VIEW = struct.Struct("<4sIHH8i")  # マジック, tick, エンティティ数, 配列の容量, ゲーム固有の値8つ
+VIEW_MAGIC = b"VEW1"
+VIEW_VALUES = 8
+VIEW_BLOCK = 64  # 配列の容量はこの倍数に切り上げる(差分が小さくなるように)
+MESSAGE = struct.Struct("<BI")  # 種類, 本体の長さ
+KEYFRAME = 0
+DELTA = 1
+
+
+def encode_view(tick, values, columns):
+    """
+    (kind, frame, x, y)の配列とゲーム固有の値を盤面のバイト列にする
+    """
+    kind, frame, x, y = columns
+    count = len(kind)
+    capacity = -(-count // VIEW_BLOCK) * VIEW_BLOCK
+    pad = capacity - count
+    values = tuple(values) + (0,) * (VIEW_VALUES - len(values))
+    return b"".join((
+        VIEW.pack(VIEW_MAGIC, tick, count, capacity, *values),
+        kind.tobytes(), bytes(pad),
+        frame.tobytes(), bytes(pad),
+        array("h", x).tobytes(), bytes(pad * 2),
+        array("h", y).tobytes(), bytes(pad * 2),
+    ))
+
+
+def decode_view(data):
+    """
+    盤面のバイト列を読む
+    戻り値: (tick, ゲーム固有の値, (kind, frame, x, y)のリスト)
+    """
+    magic, tick, count, capacity, *values = VIEW.unpack_from(data)
+    if magic != VIEW_MAGIC:
+        raise ValueError("not a spectator view")
+    columns = []
+    offset = VIEW.size
+    for typecode in ("B", "B", "h", "h"):
+        column = array(typecode)
+        column.frombytes(data[offset:offset + count * column.itemsize])
+        columns.append(column)
+        offset += capacity * column.itemsize
+    return tick, values, list(zip(*columns))
+
+
+class Subscriber:
+    """
+    1人の観戦者への送信待ちのメッセージ
+    """
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.pending = deque()
+        self.offset = 0  # pending[0]のうち送り終わった長さ
+        self.size = 0  # pendingの合計の長さ
+        self.resyncs = 0
+
+
+class SpectatorFeed:
+    """
+    観戦用の配信
+    port : 観戦者を待ち受けるTCPポート (0ならOSに選ばせる)
+    keyframe_interval : キーフレームを入れる間隔(tick)
+    queue_size : ゲームループと配信スレッドの間のキューの長さ
+    buffer_limit : 1人の観戦者に溜めておける送信待ちのバイト数。超えたらキーフレームからやり直す
+    """
+
+    def __init__(self, port=50020, host="127.0.0.1", keyframe_interval=40, queue_size=64, buffer_limit=1 << 18):
+        self.keyframe_interval = keyframe_interval
+        self.buffer_limit = buffer_limit
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0  # キューが溢れて捨てたメッセージの数
+        self.keyframe = None  # 最後のキーフレームの盤面 (ゲームループ側)
+        self.keyframe_tick = None
+        self.last_keyframe = None  # 最後に配ったキーフレームのメッセージ (配信スレッド側)
+        self.subscribers = []
+        self.listener = socket.create_server((host, port), backlog=64)
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spectator-feed", daemon=True)
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        for subscriber in self.subscribers:
+            subscriber.sock.close()
+        self.selector.close()
+        self.listener.close()
+
+    def publish(self, tick, values, columns):
+        """
+        ゲームループから毎tick呼ぶ。キーフレームか差分にエンコードしてキューに入れる
+        """
+        view = encode_view(tick, values, columns)
+        if self.keyframe is None or tick - self.keyframe_tick >= self.keyframe_interval or tick < self.keyframe_tick:
+            self.keyframe = view
+            self.keyframe_tick = tick
+            kind, body = KEYFRAME, view
+        else:
+            kind, body = DELTA, delta(self.keyframe, view)
+        try:
+            self.queue.put_nowait(MESSAGE.pack(kind, len(body)) + body)
+        except queue.Full:
+            self.dropped += 1
+            if kind == KEYFRAME:
+                self.keyframe = None  # 配れなかったキーフレームに対する差分は作らない
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                message = self.queue.get(timeout=0.02)
+            except queue.Empty:
+                message = None
+            while message is not None:
+                self._fan_out(message)
+                try:
+                    message = self.queue.get_nowait()
+                except queue.Empty:
+                    message = None
+            self._poll()
+
+    def _fan_out(self, message):
+        if message[0] == KEYFRAME:
+            self.last_keyframe = message
+        for subscriber in self.subscribers:
+            if subscriber.size + len(message) > self.buffer_limit:
+                self._resync(subscriber, message)
+            else:
+                subscriber.pending.append(message)
+                subscriber.size += len(message)
+
+    def _resync(self, subscriber, message):
+        """
+        送り切れていない観戦者のメッセージを捨て、最新のキーフレームからやり直させる
+        送りかけのメッセージだけは途中で切ると読めなくなるので残す
+        """
+        pending = subscriber.pending
+        partial = pending[0] if pending and subscriber.offset else None
+        pending.clear()
+        if partial is not None:
+            pending.append(partial)
+        if self.last_keyframe is not None and message is not self.last_keyframe:
+            pending.append(self.last_keyframe)
+        pending.append(message)
+        subscriber.size = sum(len(item) for item in pending) - subscriber.offset
+        subscriber.resyncs += 1
+        telemetry.emit("spectator_resync", addr=str(subscriber.addr), resyncs=subscriber.resyncs)
+
+    def _poll(self):
+        """
+        新しい観戦者を受け付け、溜まっているメッセージを送れるだけ送る
+        """
+        for key, _ in self.selector.select(timeout=0):
+            if key.fileobj is self.listener:
+                self._accept()
+        for subscriber in list(self.subscribers):
+            self._flush(subscriber)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except BlockingIOError:
+                return
+            sock.setblocking(False)
+            # カーネルの送信バッファが大きいと遅い観戦者の遅れがそこに隠れてしまうので小さめにする
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 16)
+            subscriber = Subscriber(sock, addr)
+            if self.last_keyframe is not None:
+                subscriber.pending.append(self.last_keyframe)
+                subscriber.size = len(self.last_keyframe)
+            self.subscribers.append(subscriber)
+            telemetry.emit("spectator_join", addr=str(addr), subscribers=len(self.subscribers))
+
+    def _flush(self, subscriber):
+        pending = subscriber.pending
+        try:
+            while pending:
+                head = pending[0]
+                sent = subscriber.sock.send(memoryview(head)[subscriber.offset:])
+                subscriber.offset += sent
+                subscriber.size -= sent
+                if subscriber.offset < len(head):
+                    return
+                pending.popleft()
+                subscriber.offset = 0
+        except BlockingIOError:
+            return
+        except OSError:
+            subscriber.sock.close()
+            self.subscribers.remove(subscriber)
+            telemetry.emit("spectator_leave", addr=str(subscriber.addr), subscribers=len(self.subscribers))
+
+
+class SpectatorClient:
+    """
+    観戦者側。受信スレッドでメッセージを読み、最新の盤面だけを持っておく
+    latest : (tick, ゲーム固有の値, (kind, frame, x, y)のリスト)。まだ受け取っていなければNone
+    """
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.keyframe = None
+        self.latest = None
+        self.connected = True
+        self._thread = threading.Thread(target=self._run, name="spectator-client", daemon=True)
+        self._thread.start()
+
+    def _read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("feed closed")
+            data += chunk
+        return bytes(data)
+
+    def _run(self):
+        try:
+            while True:
+                kind, length = MESSAGE.unpack(self._read(MESSAGE.size))
+                body = self._read(length)
+                if kind == KEYFRAME:
+                    self.keyframe = body
+                    view = body
+                elif self.keyframe is not None:
+                    view = apply_delta(self.keyframe, body)
+                else:
+                    continue  # 最初のキーフレームが届くまで差分は読み捨てる
+                self.latest = decode_view(view)
+        except OSError:
+            pass
+        finally:
+            self.connected = False
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,202 @@
+"""
+起動時間の計測と、最初のフレームに要らないアセットの後回し読み込み
+
+Startupは起動の各ステップにかかった時間と、プロセス開始から
+最初のフレームを出すまで(TTFF)・入力を受け付けるまで(TTI)の時間を記録する。
+AssetLoaderは勝利画面やサウンド、BGMのような最初のフレームに要らないものを
+バックグラウンドのスレッドで読み込み、仕上げ(Surfaceのconvertなど画面を使う処理)は
+メインループから呼ばれるpoll()の中でメインスレッドが行う。
+init_mixer, load_sound, play_musicは、2つのゲームがAssetLoaderに登録するサウンドの読み込み。
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import pygame as pg
+
+import telemetry
+
+data_dir = os.path.join(os.path.split(os.path.abspath(__file__))[0], "data")
+
+
+class Startup:
+    """
+    起動時間の記録
+    started : プロセス開始とみなす時刻 (time.perf_counter())。スクリプトの先頭で取っておく
+    budget : TTFFの目標(秒)。超えたらレポートで知らせる
+    """
+
+    def __init__(self, started=None, budget=0.5):
+        self.started = time.perf_counter() if started is None else started
+        self.budget = budget
+        self.steps = []  # (名前, 秒)
+        self.marks = {}  # 名前 -> プロセス開始からの秒
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.steps.append((name, seconds))
+
+    def mark(self, name):
+        """
+        節目の時刻を記録する。同じ名前は最初の1回だけ
+        """
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter() - self.started
+
+    def report(self):
+        """
+        ステップごとの時間とTTFF/TTIをテレメトリに出して表示する
+        """
+        with self.lock:
+            steps = list(self.steps)
+        ttff = self.marks.get("first_frame")
+        fields = {name: round(seconds * 1000, 1) for name, seconds in steps}
+        telemetry.emit(
+            "startup",
+            ttff_ms=None if ttff is None else round(ttff * 1000, 1),
+            tti_ms=None if "interactive" not in self.marks else round(self.marks["interactive"] * 1000, 1),
+            assets_ms=None if "assets_ready" not in self.marks else round(self.marks["assets_ready"] * 1000, 1),
+            steps=fields,
+        )
+        lines = ["startup:"]
+        lines += [f"  {name:<20} {seconds * 1000:8.1f} ms" for name, seconds in steps]
+        for name in ("first_frame", "interactive", "assets_ready"):
+            if name in self.marks:
+                lines.append(f"  {name + ' at':<20} {self.marks[name] * 1000:8.1f} ms")
+        if ttff is not None and ttff > self.budget:
+            lines.append(f"  time to first frame is over the {self.budget * 1000:.0f} ms budget")
+        print("\n".join(lines))
+
+
+class AssetLoader:
+    """
+    バックグラウンドでアセットを読み込むスレッド
+    add(名前, load, finish) で登録した順にload()を別スレッドで呼び、
+    結果はメインスレッドのpoll()かwait()の中でfinish(結果)に渡す
+    """
+
+    def __init__(self, startup=None):
+        self.startup = startup
+        self.jobs = {}  # 名前 -> Job
+        self.order = []
+        self._thread = threading.Thread(target=self._run, name="asset-loader", daemon=True)
+
+    def add(self, name, load, finish=None):
+        job = Job(name, load, finish)
+        self.jobs[name] = job
+        self.order.append(job)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        for job in self.order:
+            start = time.perf_counter()
+            try:
+                job.result = job.load()
+            except Exception as error:  # 読めなかったアセットはないものとして続ける
+                print(f"Warning, unable to load {job.name}: {error}")
+            if self.startup is not None:
+                self.startup.record("bg:" + job.name, time.perf_counter() - start)
+            job.loaded.set()
+
+    @property
+    def done(self):
+        """すべてのアセットの読み込みと仕上げが終わったらTrue"""
+        return all(job.finished for job in self.order)
+
+    def poll(self):
+        """
+        メインループから毎フレーム呼ぶ。読み込みが終わったアセットの仕上げをする
+        最初の呼び出しを入力を受け付け始めた時刻(TTI)として記録する
+        """
+        if self.startup is not None:
+            self.startup.mark("interactive")
+        pending = False
+        for job in self.order:
+            if job.finished:
+                continue
+            if job.loaded.is_set():
+                job.finish_once()
+            else:
+                pending = True
+        if not pending and self.startup is not None and "assets_ready" not in self.startup.marks:
+            self.startup.mark("assets_ready")
+            self.startup.report()
+
+    def wait(self, name):
+        """
+        アセットを今すぐ使うときに呼ぶ。読み込み中なら終わるまで待つ
+        """
+        job = self.jobs[name]
+        job.loaded.wait()
+        job.finish_once()
+        return job.result
+
+
+class Job:
+    def __init__(self, name, load, finish):
+        self.name = name
+        self.load = load
+        self.finish = finish
+        self.result = None
+        self.loaded = threading.Event()
+        self.finished = False
+
+    def finish_once(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.finish is not None and self.result is not None:
+            self.finish(self.result)
+
+
+def init_mixer():
+    """
+    サウンドを初期化する。オーディオデバイスを開くのに時間がかかることがあるので
+    バックグラウンドで呼ぶ
+    """
+    if not pg.mixer:
+        return None
+    if pg.get_sdl_version()[0] == 2:
+        pg.mixer.pre_init(44100, 32, 2, 1024)
+    try:
+        pg.mixer.init()
+    except pg.error:
+        pass
+    if not pg.mixer.get_init():
+        print("Warning, no sound")
+        pg.mixer = None
+    return None
+
+
+def load_sound(file):
+    """because pygame can be compiled without mixer."""
+    if not pg.mixer:
+        return None
+    file = os.path.join(data_dir, file)
+    try:
+        sound = pg.mixer.Sound(file)
+        return sound
+    except pg.error:
+        print(f"Warning, unable to load, {file}")
+    return None
+
+
+def play_music():
+    if pg.mixer:
+        music = os.path.join(data_dir, "house_lo.wav")
+        pg.mixer.music.load(music)
+        pg.mixer.music.play(-1)
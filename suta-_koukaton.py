@@ -1,12 +1,33 @@
 #!/usr/bin/env python
+import argparse
+import asyncio
 import os
 import random
+import struct
 import math
+import multiprocessing
+import time
 from typing import List
 
+STARTED = time.perf_counter()  # 起動時間(TTFF/TTI)の基準。pygameのimportより前に取る
+
 # import basic pygame modules
 import pygame as pg
 
+import matchserver
+import sampler
+import telemetry
+from allocprofile import AllocationProfiler
+from engine import BOUNCE, CLAMP, KILL_OUTSIDE, Archetype, Clip, Renderer, World, anchored, group_rects
+from governor import QualityGovernor
+from idle import MAX_WAIT_TICKS, IdleWaiter
+from planner import AnytimePlanner
+from rotation import RotationCache, heading_frame
+from rollback import RollbackSession, UdpTransport
+from sharedframe import SharedFrame
+from spectator import SpectatorClient, SpectatorFeed
+from startup import AssetLoader, Startup, init_mixer, load_sound, play_music
+
 # see if we can load more than standard BMP
 if not pg.image.get_extended():
     raise SystemExit("Sorry, extended image module required")
@@ -16,7 +37,27 @@ if not pg.image.get_extended():
 MAX_SHOTS = 1  # most player bullets onscreen
 MAX_BOMBS = 1
 SCREENRECT = pg.Rect(0, 0, 640, 480)
-SCORE = 0
+# ラウンドの状態 (playing -> victory -> rematch -> playing)
+PLAYING = "playing"
+VICTORY = "victory"
+REMATCH = "rematch"
+# 入力のビット (PlayerとAlienで同じ並び)
+MOVE_LEFT = 1
+MOVE_RIGHT = 2
+FIRE = 4
+SPREAD = 8
+WAVY = 16
+REMATCH_REQUEST = 32  # オンライン対戦で決着後に再戦を求める
+# 当たり判定のグループ
+SHOTS = 1  # Playerの弾
+BOMBS = 2  # Alienの弾
+# エンティティの持ち主
+PLAYER = 1
+ALIEN = 2
+# Match.snapshot()の形式: ヘッダー、乱数の状態、Worldのスナップショット
+MATCH_SNAPSHOT = struct.Struct("<4sBBBqqqi")  # マジック, 勝者, リロード中x2, Player, Alien, アイテム, スコア
+MATCH_SNAPSHOT_MAGIC = b"MCH1"
+RNG_STATE = struct.Struct("<625I?d")  # Mersenne Twisterの状態と添字, gaussの次の値
 main_dir = os.path.split(os.path.abspath(__file__))[0]
 
 
@@ -29,34 +70,31 @@ def load_image(file):
         raise SystemExit(f'Could not load image "{file}" {pg.get_error()}')
     return surface.convert()
 
-def load_sound(file):
-    """because pygame can be compiled without mixer."""
-    if not pg.mixer:
-        return None
-    file = os.path.join(main_dir, "data", file)
-    try:
-        sound = pg.mixer.Sound(file)
-        return sound
-    except pg.error:
-        print(f"Warning, unable to load, {file}")
-    return None
+def read_image(file):
+    """
+    画像をconvertせずに読む。画面に依存しないのでバックグラウンドのスレッドから呼べる
+    """
+    return pg.image.load(os.path.join(main_dir, "data", file))
+
 
 class Gauge(pg.sprite.Sprite):
     """
-    ゲージを管理して表示するクラス
+    ゲージを表示するクラス
+    ゲージの量そのものはWorldのゲージコンポーネントが持ち、毎フレームcurrent_valueに写す
     """
 
+    capacity = 10  # ゲージの最大容量
+    recharge_ticks = 80  # ゲージが1増えるまでのtick数 (40fpsで2秒)
+
     def __init__(self, position, *groups):
         super().__init__(*groups)
         self.image = pg.Surface((30, 100))
         self.image.fill((0, 0, 0))
         self.rect = self.image.get_rect()
         self.rect.topleft = position
-        self.capacity = 10  # ゲージの最大容量
         self.current_value = 0  # 現在のゲージの量
         self.fill_color = (0, 255, 0)  # ゲージの満タン時の色
         self.empty_color = (255, 0, 0)  # ゲージの空の時の色
-        self.last_update = pg.time.get_ticks()  # 前回ゲージが更新された時間
         self.font = pg.font.Font(None, 20)  # 数字表示用のフォント
 
     def update(self):
@@ -74,247 +112,159 @@ class Gauge(pg.sprite.Sprite):
         text_rect = text.get_rect(center=self.rect.center)
         self.image.blit(text, text_rect)
 
-    def increase(self):
-        """
-        2秒ごとにゲージを2増やす
-        """
-        now = pg.time.get_ticks()
-        if now - self.last_update > 2000:  # 2秒経過したら
-            self.last_update = now
-            self.current_value += 1
-            if self.current_value > self.capacity:
-                self.current_value = self.capacity
-
-    def can_fire(self):
-        """
-        ゲージが2以上なら発射可能
-        """
-        return self.current_value >= 2
 
-
-
-class Player(pg.sprite.Sprite):
+class Player(Archetype):
     """
-    Playerのイニシャライザ
+    Playerのアーキタイプ
     動作メソッド、
-    銃の発射位置メソッドを生成しているクラス
+    銃の発射位置メソッドを持つ
     """
 
     speed = 5
     gun_offset = 0
+    size = (48, 48)
+    bounds = CLAMP
     images: List[pg.Surface] = []
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=SCREENRECT.midbottom)
-        self.reloading = 0
-        self.origtop = self.rect.top
-        self.facing = -1
-        self.gauge = Gauge((10, SCREENRECT.height - 100), *groups)  # プレイヤーのゲージ
-
-    def move(self, direction):
+    @classmethod
+    def spawn(cls, world):
+        x, y = anchored(cls.size, midbottom=SCREENRECT.midbottom)
+        return world.spawn(cls, x, y, owner=PLAYER)
+
+    @classmethod
+    def move(cls, world, eid, direction):
+        world.move(eid, direction * cls.speed)
         if direction:
-            self.facing = direction
-        self.rect.move_ip(direction * self.speed, 0)
-        self.rect = self.rect.clamp(SCREENRECT)
-        if direction < 0:
-            self.image = self.images[0]
-        elif direction > 0:
-            self.image = self.images[1]
-        # self.rect.top = self.origtop - (self.rect.left // self.bounce % 2)
-
-    def gunpos(self):
-        pos = self.facing * self.gun_offset + self.rect.centerx
-        return pos, self.rect.top
-    
-    # def update(self):
-    #     # 当たり判定のチェック
-    #     if pg.sprite.spritecollideany(self, bombs) or pg.sprite.spritecollideany(self, WavyShot) or pg.sprite.spritecollideany(self, spread_shots):
-    #         self.kill()
-    #         Explosion(self, all)
-    #         boom_sound.play()
-
-
-
-class Alien(pg.sprite.Sprite):
-    """
-    エイリアンのイニシャライザ
+            world.frame[world.slot_of[eid]] = 0 if direction < 0 else 1
+
+    @classmethod
+    def gunpos(cls, world, eid):
+        slot = world.slot_of[eid]
+        return world.x[slot] + world.w[slot] // 2 + cls.gun_offset, world.y[slot]
+
+
+class Alien(Player):
+    """
+    エイリアンのアーキタイプ
     動作メソッド
-    銃の発射位置メソッド
-    エイリアンの位置更新メソッドを生成しているクラス
+    銃の発射位置メソッドを持つ
     """
-    
+
     speed = 5
-    gun_offset = 0
+    size = (80, 71)
     images: List[pg.Surface] = []
 
-    def __init__(self, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.reloading = 0
-        self.rect = self.image.get_rect(midtop=SCREENRECT.midtop)
-        self.facing = -1
-        self.origbottom = self.rect.bottom
-        self.gauge = Gauge((10, 10), *groups)  # エイリアンのゲージ
-        
-    def move(self, direction):
-        if direction:
-            self.facing = direction
-        self.rect.move_ip(direction * self.speed, 0)
-        self.rect = self.rect.clamp(SCREENRECT)
-        if direction < 0:
-            self.image = self.images[0]
-        elif direction > 0:
-            self.image = self.images[1]
-    
-    def gunpos(self):
-        pos = self.rect.centerx
-        return pos, self.rect.bottom
-
-    def update(self):
-        #self.rect.move_ip(self.facing, 0)
-        if not SCREENRECT.contains(self.rect):
-            self.facing = -self.facing
-            self.rect = self.rect.clamp(SCREENRECT)
+    @classmethod
+    def spawn(cls, world):
+        x, y = anchored(cls.size, midtop=SCREENRECT.midtop)
+        return world.spawn(cls, x, y, owner=ALIEN)
 
-        # if pg.sprite.spritecollideany(self, shots) or pg.sprite.spritecollideany(self, WavyShot) or pg.sprite.spritecollideany(self, spread_shots):
-        #     self.kill()
-        #     Explosion(self, all)
-        #     boom_sound.play()
-        #     global SCORE
-        #     SCORE += 1
+    @classmethod
+    def gunpos(cls, world, eid):
+        slot = world.slot_of[eid]
+        return world.x[slot] + world.w[slot] // 2, world.y[slot] + world.h[slot]
 
 
-class Explosion(pg.sprite.Sprite):
+class Explosion(Archetype):
     """
-    オブジェクトが衝突した際に爆発する演出を作成するクラス
+    オブジェクトが衝突した際に爆発する演出のアーキタイプ
+    寿命(lifetime)が来るとWorldのタイマーが消す
     """
 
-    defaultlife = 12
-    animcycle = 3
+    lifetime = 12
+    clip = Clip((0, 1), 3)
+    size = (90, 90)
     images: List[pg.Surface] = []
 
-    def __init__(self, actor, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(center=actor.rect.center)
-        self.life = self.defaultlife
-
-    def update(self):
-        """
-        called every time around the game loop.
-
-        Show the explosion surface for 'defaultlife'.
-        Every game tick(update), we decrease the 'life'.
-
-        Also we animate the explosion.
-        """
-        self.life = self.life - 1
-        self.image = self.images[self.life // self.animcycle % 2]
-        if self.life <= 0:
-            self.kill()
+    @classmethod
+    def spawn(cls, world, center):
+        x, y = anchored(cls.size, center=center)
+        return world.spawn(cls, x, y)
 
 
-class Shot(pg.sprite.Sprite):
+class Shot(Archetype):
     """
-    Playerが使う銃を生成するクラス
+    Playerが使う銃のアーキタイプ
     """
 
     speed = -10
+    size = (9, 18)
+    groups = SHOTS
+    bounds = KILL_OUTSIDE
     images: List[pg.Surface] = []
 
-    def __init__(self, pos, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=pos)
-
-    def update(self):
-        """
-        called every time around the game loop.
-
-        Every tick we move the shot upwards.
-        """
-        self.rect.move_ip(0, self.speed)
-        if self.rect.top <= 0:
-            self.kill()
+    @classmethod
+    def spawn(cls, world, pos):
+        x, y = anchored(cls.size, midbottom=pos)
+        return world.spawn(cls, x, y, vy=cls.speed, owner=PLAYER)
 
 
-class Bomb(pg.sprite.Sprite):
+class Bomb(Archetype):
     """
-    Alienが落とす爆弾を生成するクラス
+    Alienが落とす爆弾のアーキタイプ
     """
 
     speed = 10
+    size = (16, 24)
+    groups = BOMBS
+    bounds = KILL_OUTSIDE
     images: List[pg.Surface] = []
 
-    def __init__(self, alien_pos,*groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midtop=alien_pos)
+    @classmethod
+    def spawn(cls, world, pos):
+        x, y = anchored(cls.size, midtop=pos)
+        return world.spawn(cls, x, y, vy=cls.speed, owner=ALIEN)
 
-    def update(self):
-        """
-        - make an explosion.
-        - remove the Bomb.
-        """
-        self.rect.move_ip(0, self.speed)
-        if self.rect.bottom >= SCREENRECT.bottom:
-            self.kill()
 
-class WavyShot(pg.sprite.Sprite):
+class WavyShot(Archetype):
     Player_speed = -10
     Alien_speed = 10
     amplitude = 100
     frequency = 2
+    size = (9, 18)
     images: List[pg.Surface] = []
 
-    def __init__(self, pos, is_player, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = self.images[0]
-        self.rect = self.image.get_rect(midbottom=pos) if is_player else self.image.get_rect(midtop=pos)
-        self.speed = self.Player_speed if is_player else self.Alien_speed
-        self.time = 10
+    @classmethod
+    def spawn(cls, world, pos, is_player):
+        x, y = anchored(cls.size, midbottom=pos) if is_player else anchored(cls.size, midtop=pos)
+        return world.spawn(cls, x, y, owner=PLAYER if is_player else ALIEN)
 
-    # def update(self):
-    #     self.time += 1
-    #     self.rect.move_ip(self.amplitude * math.sin(self.frequency * self.time), self.speed)
-    #     if self.rect.top <= 0 or self.rect.bottom >= SCREENRECT.bottom:
-    #         self.kill()
 
+class SpreadShot(Archetype):
+    """
+    扇形に広がる弾のアーキタイプ
+    画像と大きさはPlayer用(shot.gif)とAlien用(bomb.gif)で分け、frameには
+    画像の番号と進む向きを入れる (画像はRotationCacheが向きに合わせて回す)
+    """
 
-class SpreadShot(pg.sprite.Sprite):
     Player_speed = -10
     Alien_speed = 10
     spread_angle = 90
-    # player_images: List[pg.Surface] = []
-    # alien_images: List[pg.Surface] = []
+    angles = (-15, 0, 15)  # 1回に撃つ弾の角度
+    sizes = ((9, 18), (16, 24))
+    headings = (0, 180)  # 画像の向き (shot.gifは上向き、bomb.gifは下向き)
+    bounds = KILL_OUTSIDE
+    images: List[pg.Surface] = []
 
-    def __init__(self, pos, angle,is_player, *groups):
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.is_player = is_player
-        self.image = self.player_images[0] if is_player else self.alien_images[0]
-        self.rect = self.image.get_rect(midbottom=pos) if is_player else self.image.get_rect(midtop=pos)
-        self.speed = self.Player_speed if is_player else self.Alien_speed
-        self.angle = angle
+    @classmethod
+    def velocity(cls, angle, is_player):
+        speed = cls.Player_speed if is_player else cls.Alien_speed
+        return speed * math.sin(math.radians(angle)), speed * math.cos(math.radians(angle))
 
-    def update(self):
-        dx = self.speed * math.sin(math.radians(self.angle))
-        dy = self.speed * math.cos(math.radians(self.angle))
-        self.rect.move_ip(dx, dy)
-
-        if self.rect.top <= 0 or self.rect.left <= 0 or self.rect.right >= SCREENRECT.right  or self.rect.bottom >= SCREENRECT.bottom:
-            self.kill()
-
-        if not self.is_player and pg.sprite.spritecollide(self, players, ):
-            player = pg.sprite.spritecollideany(self, players)
-            Explosion(self, all)
-            Explosion(player, all)
-            player.kill()
-            self.kill()
-            
-            
+    @classmethod
+    def frame(cls, angle, is_player):
+        image = 0 if is_player else 1
+        return heading_frame(image, *cls.velocity(angle, is_player), cls.headings[image])
 
+    @classmethod
+    def spawn(cls, world, pos, angle, is_player):
+        size = cls.sizes[0 if is_player else 1]
+        x, y = anchored(size, midbottom=pos) if is_player else anchored(size, midtop=pos)
+        dx, dy = cls.velocity(angle, is_player)
+        return world.spawn(
+            cls, x, y, vx=dx, vy=dy, frame=cls.frame(angle, is_player), size=size,
+            owner=PLAYER if is_player else ALIEN, groups=SHOTS if is_player else BOMBS,
+        )
 
 
 class Score(pg.sprite.Sprite):
@@ -327,129 +277,59 @@ class Score(pg.sprite.Sprite):
         self.font = pg.font.Font(None, 20)
         self.font.set_italic(1)
         self.color ="white"
+        self.value = 0  # 表示するスコア。試合を持つループがMatch.scoreを入れる
         self.lastscore = -1
         self.update()
         self.rect = self.image.get_rect().move(10, 450)
 
     def update(self):
         """We only update the score in update() when it has changed."""
-        if SCORE != self.lastscore:
-            self.lastscore = SCORE
-            msg = f"Score: {SCORE}"
+        if self.value != self.lastscore:
+            self.lastscore = self.value
+            msg = f"Score: {self.value}"
             self.image = self.font.render(msg, 0, self.color)
             
             
-class Item(pg.sprite.Sprite):
+class Item(Archetype):
     """
-    ゲーム内でアイテムを表現するクラス。
+    ゲーム内でアイテムを表現するアーキタイプ。
+    画面の中央に生成され、左右に一定速度で動き、画面端で反射する。
+    弾に当たったら消え、Match.item_spawnのタイマーで再び生成される。
     speed : int : アイテムの移動速度。
     images : List[pg.Surface] : アイテムを表現する画像のリスト。
-    rect : pg.Rect : アイテムの位置とサイズを表す矩形。
-    spawned : bool : アイテムが生成されたかどうかを示すフラグ。
-    メソッド:
-    update():アイテムの位置を更新し、画面端との衝突を処理する。
-    spawn():アイテムを画面の中央に生成する。
-    is_spawned() -> bool:アイテムが現在生成されているかどうかを確認する。
-    collide_bombs(bombs: pg.sprite.Group) -> bool:爆弾との衝突を確認し、処理する。
-    collide_shots(shots: pg.sprite.Group) -> bool:ショットとの衝突を確認し、処理する。
-    reset():アイテムを初期状態にリセットする。
     """
 
     speed: int = 2 #itemの移動速度
+    size = (64, 48)
+    bounds = BOUNCE
     images: List[pg.Surface] = []#itemの画像リスト
 
-    def __init__(self, *groups: pg.sprite.AbstractGroup) -> None:
-        """
-        Itemオブジェクトを初期化する。
-        引数: *groups : pg.sprite.AbstractGroup : スプライトが所属するグループ。
-        """
-        pg.sprite.Sprite.__init__(self, *groups)
-        self.image = pg.transform.scale(self.images[0], (64, 48))  # 画像サイズを変更
-        self.image.set_colorkey((255, 255, 255))  # 背景を透明に設定
-        self.rect = self.image.get_rect(center=SCREENRECT.center)  # 矩形を取得
-        self.rect.topleft = (-100, -100)  # 初期位置を画面外に設定
-        self.spawned = False  # アイテムが生成されたかどうかのフラグ
-
-    def update(self) -> None:
-        """
-        アイテムの位置を更新し、画面端との衝突を処理する。
-        """
-        if self.spawned:
-            self.rect.move_ip(self.speed, 0)  # アイテムを移動
-            if self.rect.top > SCREENRECT.height:
-                self.kill()  # 画面外に出たらアイテムを消す
-                self.spawned = False  # フラグをリセット
-            if self.rect.right >= SCREENRECT.right or self.rect.left <= 0:
-                self.speed = -self.speed  # 画面端に当たったら移動方向を反転
-
-    def spawn(self) -> None:
+    @classmethod
+    def spawn(cls, world):
         """
         アイテムを画面の中央に生成する。
         """
-        if not self.spawned:
-            self.rect.center = SCREENRECT.center  # アイテムを中央に移動
-            self.spawned = True  # フラグを設定
+        x, y = anchored(cls.size, center=SCREENRECT.center)
+        return world.spawn(cls, x, y, vx=cls.speed)
 
-    def is_spawned(self) -> bool:
-        """
-        アイテムが現在生成されているかどうかを確認する。
-        戻り値: bool : アイテムが生成されていればTrue、そうでなければFalse。
-        """
-        return self.spawned
 
-    def collide_bombs(self, bombs: pg.sprite.Group) -> bool:
-        """
-        爆弾との衝突を確認し、処理する。
-        引数: bombs : pg.sprite.Group : 衝突を確認する爆弾のグループ。
-        戻り値: bool : アイテムが爆弾と衝突した場合はTrue、そうでない場合はFalse。
-        """
-        if self.spawned:
-            collided = pg.sprite.spritecollide(self, bombs, True)  # 衝突を確認
-        
-            if collided:
-                self.kill()  # 衝突したらアイテムを消す
-                self.spawned = False  # フラグをリセット
-                self.rect.topleft = (-100, -100)  # 初期位置にリセット
-                return True
-        return False
-
-    def collide_shots(self, shots: pg.sprite.Group) -> bool:
-        """
-        ショットとの衝突を確認し、処理する。
-        引数: shots : pg.sprite.Group : 衝突を確認するショットのグループ。
-        戻り値: bool : アイテムがショットと衝突した場合はTrue、そうでない場合はFalse。
-        """
-        if self.spawned:
-            collided = pg.sprite.spritecollide(self, shots, True)
-            if collided:
-                self.kill()
-                self.spawned = False  # 衝突したらフラグをリセット
-                self.rect.topleft = (-100, -100)  # 画面外の初期位置にリセット
-                return True
-        return False
-
-    def reset(self) -> None:
-        """
-        アイテムを初期状態にリセットする。
-        """
-        self.spawned = False # フラグをリセット
-        self.rect.topleft = (-100, -100)  # 画面外に初期位置をリセット
+ARCHETYPES = (Player, Alien, Shot, Bomb, WavyShot, SpreadShot, Explosion, Item)
 
 
 class Win(pg.sprite.Sprite):
     """
     ・プレイヤーがエイリアンに爆弾を当てた際に画像と文字を呼び出す。
     ・エイリアンがプレイヤーに爆弾を当てた際に画像と文字を呼び出す。
+    画像はmain()で一度だけ読み込んだものを使う
     """
+    images: dict = {}
+
     def __init__(self, winner, *groups):
         pg.sprite.Sprite.__init__(self, *groups)
         self.image = pg.Surface(SCREENRECT.size)
         self.image.fill("black")
         
-        if winner == "Player":
-            win_image = load_image("player_win.png")
-        else:
-            win_image = load_image("alien_win.png")
+        win_image = self.images[winner]
         
         # この画像を小さくリサイズする
         win_image = pg.transform.scale(win_image, (SCREENRECT.width // 2, SCREENRECT.height // 4))
@@ -465,28 +345,333 @@ class Win(pg.sprite.Sprite):
         text_surface = self.font.render(win_text, True, self.color)
         text_rect = text_surface.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 100))
         self.image.blit(text_surface, text_rect)
+
+        # 再戦・終了の操作を案内する
+        hint_font = pg.font.Font(None, 28)
+        hint_surface = hint_font.render("R: Rematch   ESC: Quit", True, self.color)
+        hint_rect = hint_surface.get_rect(center=(SCREENRECT.centerx, SCREENRECT.centery + 160))
+        self.image.blit(hint_surface, hint_rect)
         
         self.rect = self.image.get_rect()
 
 
-def main(winstyle=0):
-    # Initialize pygame
+class Match:
+    """
+    1試合分の状態をまとめ、入力から1tickずつ進めるクラス
+    エンティティはWorldのコンポーネント配列が持ち、描画とサウンドは持たないので、
+    画面のない別プロセスでも動かせる
+    winner : 決着がついたら勝者("Player"か"Alien")、それまではNone
+    score : スコア。モジュールの変数ではなく試合ごとに持つので、探索用の試合を別スレッドで
+            restore()しても遊んでいる試合のスコアは変わらない
+    """
 
-    # global shots, bombs, WavyShot, spread_shots, all, boom_sound, shoot_sound, background, players
+    def __init__(self, seed=None):
+        self.rng = random.Random(seed)
+        self.world = World(ARCHETYPES, SCREENRECT)
+        self.winner = None
+        self.score = 0
+        self.quiet = False  # Trueの間はテレメトリを出さない(CPUの先読みやサーバーの試合)
+        self.recorded = None  # リストなら、イベントはテレメトリに出さずにここへ(名前, 値)を溜める
+        self.world.callbacks.append(self.spawn_item)
+        self.start()
+
+    @property
+    def tick(self):
+        return self.world.tick
+
+    def start(self):
+        """
+        PlayerとAlienを初期位置に置き、ゲージとアイテムのタイマーを登録する
+        """
+        world = self.world
+        self.player = Player.spawn(world)
+        self.alien = Alien.spawn(world)
+        world.add_gauge(self.player, Gauge.capacity, Gauge.recharge_ticks)  # プレイヤーのゲージ
+        world.add_gauge(self.alien, Gauge.capacity, Gauge.recharge_ticks)  # エイリアンのゲージ
+        self.player_reloading = 0
+        self.alien_reloading = 0
+        self.item = None  # 出現中のアイテムのID
+        self.item_spawn = world.timers.schedule(self.rng.randint(300, 600), self.spawn_item)  # 初回のアイテム出現時間をランダムに設定
+
+    def reset(self):
+        """
+        再戦のために盤面を初期状態に戻す。
+        画像・サウンドは読み込み直さず、Worldの配列もそのまま使い回す
+        """
+        self.world.clear()
+        self.winner = None
+        self.start()
+        self.emit("rematch")
 
-    if pg.get_sdl_version()[0] == 2:
-        pg.mixer.pre_init(44100, 32, 2, 1024)
-    pg.init()
-    if pg.mixer and not pg.mixer.get_init():
-        print("Warning, no sound")
-        pg.mixer = None
+    def spawn_item(self):
+        self.item = Item.spawn(self.world)
 
-    fullscreen = False
-    winstyle = 0  # |FULLSCREEN
-    bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
-    screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
+    def emit(self, event, **fields):
+        if self.quiet:
+            return
+        if self.recorded is not None:
+            self.recorded.append((event, fields))  # ロールバックで確定してから出す
+            return
+        telemetry.emit(event, **fields)
+
+    def save(self):
+        """
+        ロールバック用に試合の状態を丸ごと記録する
+        """
+        return (
+            self.world.save(), self.rng.getstate(), self.winner, self.score, self.player, self.alien,
+            self.player_reloading, self.alien_reloading, self.item, self.item_spawn,
+        )
+
+    def load(self, state):
+        """
+        save()した時点の状態に戻す
+        """
+        (
+            world, rng, self.winner, self.score, self.player, self.alien,
+            self.player_reloading, self.alien_reloading, self.item, self.item_spawn,
+        ) = state
+        self.world.load(world)
+        self.rng.setstate(rng)
+
+    def snapshot(self):
+        """
+        試合の状態(エンティティ、ゲージ、タイマー、乱数、スコア)を固定レイアウトのバイト列にする
+        画像やサウンドは含まないので、restore()する側で読み込んでおく
+        """
+        version, internal, gauss = self.rng.getstate()
+        header = MATCH_SNAPSHOT.pack(
+            MATCH_SNAPSHOT_MAGIC, WINNERS.index(self.winner), self.player_reloading, self.alien_reloading,
+            self.player, self.alien, self.item or 0, self.score,
+        )
+        rng = RNG_STATE.pack(*internal, gauss is not None, gauss or 0.0)
+        return header + rng + self.world.snapshot()
+
+    def restore(self, data):
+        """
+        snapshot()したバイト列から試合の状態を戻す
+        """
+        (
+            magic, winner, self.player_reloading, self.alien_reloading,
+            self.player, self.alien, item, self.score,
+        ) = MATCH_SNAPSHOT.unpack_from(data)
+        if magic != MATCH_SNAPSHOT_MAGIC:
+            raise ValueError("not a match snapshot")
+        self.winner = WINNERS[winner]
+        self.item = item or None
+        *internal, has_gauss, gauss = RNG_STATE.unpack_from(data, MATCH_SNAPSHOT.size)
+        self.rng.setstate((3, tuple(internal), gauss if has_gauss else None))
+        self.world.restore(data, MATCH_SNAPSHOT.size + RNG_STATE.size)
+        self.item_spawn = self.world.timers.find(self.spawn_item)
+
+    def step(self, player_bits, alien_bits):
+        """
+        入力ビットに従って1tick進める
+        戻り値: このtickで鳴らすサウンド名のリスト("shoot", "boom")
+        """
+        sounds = []
+        world = self.world
+        player, alien = self.player, self.alien
+
+        world.update()  # 弾の移動・画面端の処理・爆発のアニメーション・タイマー
+
+        Player.move(world, player, bool(player_bits & MOVE_RIGHT) - bool(player_bits & MOVE_LEFT))
+
+        firing = player_bits & FIRE
+        if not self.player_reloading and firing and world.count(SHOTS) < MAX_SHOTS and world.spend(player, 2):
+            Shot.spawn(world, Player.gunpos(world, player))
+            sounds.append("shoot")
+            self.emit("shot", shooter="Player", kind="Shot")
+            self.emit("gauge_spend", owner="Player", amount=2, remaining=world.gauge_value(player))
+        self.player_reloading = firing
+
+        Alien.move(world, alien, bool(alien_bits & MOVE_RIGHT) - bool(alien_bits & MOVE_LEFT))
+
+        firing = alien_bits & FIRE
+        if not self.alien_reloading and firing and world.count(BOMBS) < MAX_BOMBS and world.spend(alien, 2):
+            Bomb.spawn(world, Alien.gunpos(world, alien))
+            sounds.append("shoot")
+            self.emit("shot", shooter="Alien", kind="Bomb")
+            self.emit("gauge_spend", owner="Alien", amount=2, remaining=world.gauge_value(alien))
+        self.alien_reloading = firing
+
+        if player_bits & SPREAD:#第一回を参考に圧されている間じゃなくて押されたときに変更する必要がある
+            for angle in SpreadShot.angles:
+                SpreadShot.spawn(world, Player.gunpos(world, player), angle, True)  # Player用のSpreadShot
+            sounds.append("shoot")
+            self.emit("shot", shooter="Player", kind="SpreadShot")
+
+        if alien_bits & WAVY:
+            WavyShot.spawn(world, Alien.gunpos(world, alien), False)
+            sounds.append("shoot")
+            self.emit("shot", shooter="Alien", kind="WavyShot")
+
+        if alien_bits & SPREAD:
+            for angle in SpreadShot.angles:
+                SpreadShot.spawn(world, Alien.gunpos(world, alien), angle, False)
+            sounds.append("shoot")
+            self.emit("shot", shooter="Alien", kind="SpreadShot")
+
+        for target, groups, winner in ((alien, SHOTS, "Player"), (player, BOMBS, "Alien")):
+            hits = world.collide(target, groups)
+            if hits:
+                Explosion.spawn(world, world.center(hits[0]))
+                Explosion.spawn(world, world.center(target))
+                for hit in hits:
+                    world.despawn(hit)
+                world.despawn(target)
+                sounds.append("boom")
+                self.emit("hit", target="Alien" if target == alien else "Player", by=winner)
+                self.emit("match_result", winner=winner, score=self.score)
+                self.winner = winner
+                return sounds
+
+        # アイテムが弾と衝突したかを確認
+        if self.item is not None:
+            for groups, owner in ((BOMBS, "Alien"), (SHOTS, "Player")):
+                hits = world.collide(self.item, groups)
+                if hits:
+                    for hit in hits:
+                        world.despawn(hit)
+                    world.despawn(self.item)
+                    self.item = None
+                    self.item_spawn = world.timers.schedule(self.rng.randint(300, 600), self.spawn_item)  # 新しいアイテム出現時間を設定
+                    self.emit("item_pickup", by=owner)
+                    break
+
+        return sounds
+
+
+class OnlineMatch(Match):
+    """
+    オンライン対戦用のMatch
+    再戦も入力ビット(REMATCH_REQUEST)で決めるので、両方の端末で同じtickに再戦が始まる
+    """
+
+    def step(self, player_bits, alien_bits):
+        if self.winner is None:
+            return super().step(player_bits, alien_bits)
+        if (player_bits | alien_bits) & REMATCH_REQUEST:
+            self.reset()
+        return []
+
+
+class CpuAlien:
+    """
+    Alienを操作するCPU
+    移動(左・止まる・右)と発射(なし・爆弾・SpreadShot)の組み合わせを候補に、
+    AnytimePlannerで試合を実際に先読みして一番生き残れて当てられる手を選ぶ
+    Playerは直前の向きに動き続け、撃てるときは必ず撃ってくるものとして予測する
+    budget : 1フレームあたりに先読みに使うCPU時間(秒)
+    special_interval : SpreadShotを続けて撃てる間隔(tick)。連打しすぎないようにする
+    """
 
-    # Load images, assign to sprite classes
+    moves = (0, MOVE_LEFT, MOVE_RIGHT)
+    shots = (0, FIRE, SPREAD)  # WavyShotは動かず当たり判定もないので使わない
+    danger = 60  # Playerの弾とのx方向の距離がこれより近いと減点する
+
+    def __init__(self, budget=0.002, special_interval=20):
+        self.special_interval = special_interval
+        self.last_special = -special_interval
+        self.player_x = None
+        self.player_move = 0
+        candidates = [(move, shot) for shot in self.shots for move in self.moves]
+        self.planner = AnytimePlanner(self.create_match, candidates, self.inputs, self.evaluate, budget).start()
+
+    @staticmethod
+    def create_match():
+        match = Match()
+        match.quiet = True  # 先読みのイベントはテレメトリに出さない
+        return match
+
+    def bits(self, match):
+        """
+        ゲームループから毎フレーム呼び、Alienの入力ビットを返す
+        探索はしないので、どんな盤面でもスナップショットを渡す時間しかかからない
+        """
+        world = match.world
+        if world.alive(match.player):
+            x = world.x[world.slot_of[match.player]]
+            if self.player_x is not None and x != self.player_x:
+                self.player_move = MOVE_RIGHT if x > self.player_x else MOVE_LEFT
+            self.player_x = x
+        specials = match.tick - self.last_special >= self.special_interval
+        move, shot = self.planner.observe(match.snapshot(), (self.player_move, specials))
+        if shot == SPREAD:
+            if not specials:
+                shot = 0
+            else:
+                self.last_special = match.tick
+        if shot == FIRE and match.alien_reloading:
+            shot = 0  # 押しっぱなしでは撃てないので一度離す
+        return move | shot
+
+    def inputs(self, candidate, tick, context):
+        """
+        先読み中の入力。Alienは最初のtickだけ撃ち、あとは同じ向きに動き続ける
+        """
+        move, shot = candidate
+        player_move, specials = context
+        if shot == SPREAD and not specials:
+            shot = 0
+        player_bits = player_move | (FIRE if tick % 2 == 0 else 0)
+        return player_bits, move | (shot if tick == 0 else 0)
+
+    def evaluate(self, match, ticks, context):
+        """
+        Alienから見た盤面の評価値
+        負ける手はできるだけ遅く、勝てる手はできるだけ早く。決着しなければ、
+        Playerの弾から離れ、Playerの真上にいて、ゲージを残しているほどよい
+        """
+        if match.winner == "Player":
+            return -100000 + ticks
+        if match.winner == "Alien":
+            return 100000 - ticks
+        world = match.world
+        alien_x, alien_y = world.center(match.alien)
+        player_x, _ = world.center(match.player)
+        score = world.gauge_value(match.alien) * 3 - abs(alien_x - player_x) * 0.1
+        x, y, w, groups = world.x, world.y, world.w, world.groups
+        for slot in range(len(x)):
+            distance = abs(x[slot] + w[slot] // 2 - (alien_x if groups[slot] & SHOTS else player_x))
+            if groups[slot] & SHOTS and y[slot] > alien_y and distance < self.danger:
+                score -= (self.danger - distance) * 10
+            elif groups[slot] & BOMBS and distance < self.danger:
+                score += self.danger - distance
+        return score
+
+    def close(self):
+        self.planner.close()
+
+
+def read_input(keystate):
+    """
+    キーボードの状態をPlayerとAlienの入力ビットに変換する
+    Player: 矢印キーで移動、スペースで発射、k/lでSpreadShot
+    Alien: a/dで移動、tで発射、5でWavyShot、6でSpreadShot
+    """
+    player_bits = (
+        MOVE_LEFT * keystate[pg.K_LEFT]
+        | MOVE_RIGHT * keystate[pg.K_RIGHT]
+        | FIRE * keystate[pg.K_SPACE]
+        | SPREAD * (keystate[pg.K_k] or keystate[pg.K_l])
+    )
+    alien_bits = (
+        MOVE_LEFT * keystate[pg.K_a]
+        | MOVE_RIGHT * keystate[pg.K_d]
+        | FIRE * keystate[pg.K_t]
+        | WAVY * keystate[pg.K_5]
+        | SPREAD * keystate[pg.K_6]
+    )
+    return player_bits, alien_bits
+
+
+def load_images():
+    """
+    最初のフレームから使う画像を読み込んでアーキタイプに割り当てる
+    (画面を作った後に呼ぶこと)
+    アイテムと勝利画面の画像はqueue_assets()でバックグラウンドで読み込む
+    """
     img = load_image("3.png")
     Player.images = [img, pg.transform.flip(img, 1, 0)]
     img = load_image("explosion1.gif")
@@ -495,200 +680,602 @@ def main(winstyle=0):
     Bomb.images = [load_image("bomb.gif")]
     Shot.images = [load_image("shot.gif")]
     WavyShot.images = [load_image("shot.gif")] #追加
-    SpreadShot.player_images = [load_image("shot.gif")]
-    SpreadShot.alien_images = [load_image("bomb.gif")] #追加
-    Item.images = [load_image("item.png")]  # アイテム画像を読み込む
-
-    icon = pg.transform.scale(Alien.images[0], (32, 32))
-    pg.display.set_icon(icon)
-    pg.display.set_caption("Pygame Aliens")
-    pg.mouse.set_visible(0)
-
-    bgdtile = load_image("utyuu.jpg")
-    background = pg.Surface(SCREENRECT.size)
-    background.blit(bgdtile, (0, 0))
-    screen.blit(background, (0, 0))
-    pg.display.flip()
+    # 向きごとに回した画像はキャッシュから引く。撃つ角度は決まっているので先に作っておく
+    SpreadShot.images = RotationCache([load_image("shot.gif"), load_image("bomb.gif")])
+    SpreadShot.images.prewarm(
+        SpreadShot.frame(angle, is_player) for is_player in (True, False) for angle in SpreadShot.angles
+    )
+    # 読み込みが終わるまでは透明な仮の画像にしておく。Rendererがリストを持っているので中身だけ差し替える
+    Item.images[:] = [pg.Surface(Item.size, pg.SRCALPHA)]
+
+
+def set_item_image(surface):
+    img = pg.transform.scale(surface.convert(), Item.size)  # アイテム画像を読み込み、サイズを変更
+    img.set_colorkey((255, 255, 255))  # 背景を透明に設定
+    Item.images[:] = [img]
+
+
+def queue_assets(assets, sounds):
+    """
+    最初のフレームに要らないアセットをバックグラウンドの読み込みに登録する
+    サウンドは読み込めた順にsoundsに入るので、それまでは鳴らないだけで済む
+    """
+    assets.add("mixer", init_mixer)
+    assets.add("sound:boom", lambda: load_sound("boom.wav"), lambda sound: sounds.__setitem__("boom", sound))
+    assets.add("sound:shoot", lambda: load_sound("car_door.wav"), lambda sound: sounds.__setitem__("shoot", sound))
+    assets.add("image:item", lambda: read_image("item.png"), set_item_image)
+    for winner, file in (("Player", "player_win.png"), ("Alien", "alien_win.png")):
+        assets.add("win:" + winner, lambda file=file: read_image(file),
+                   lambda surface, winner=winner: Win.images.__setitem__(winner, surface.convert()))
+    assets.add("music", play_music)
+
+
+class WinScreens(dict):
+    """
+    勝利画面を初めて使うときに作り、以後は使い回す
+    画像がまだ読み込み中なら読み終わるまで待つ
+    """
+
+    def __init__(self, assets):
+        super().__init__()
+        self.assets = assets
+
+    def __missing__(self, winner):
+        self.assets.wait("win:" + winner)
+        screen = self[winner] = Win(winner)
+        return screen
 
-    boom_sound = load_sound("boom.wav")
-    shoot_sound = load_sound("car_door.wav")
-    if pg.mixer:
-        music = os.path.join(main_dir, "data", "house_lo.wav")
-        pg.mixer.music.load(music)
-        pg.mixer.music.play(-1)
-
-    player = pg.sprite.Group()
-    aliens = pg.sprite.Group()
-    shots = pg.sprite.Group()
-    bombs = pg.sprite.Group()
-    items = pg.sprite.Group()
-    all = pg.sprite.RenderUpdates()
-
-    global SCORE
-    player = Player(all)
-    #players.add(player)
-    alien = Alien(aliens, all)
-    
-    all.add(player.gauge)  # プレイヤーのゲージを追加
-    all.add(alien.gauge)  # エイリアンのゲージを追加
-
-    aliens.add(alien)
+
+WINNERS = (None, "Player", "Alien")
+
+
+def simulation_process(shm_name, tick_rate=40):
+    """
+    --splitモードのシミュレーションプロセス
+    描画プロセスが書いた入力を読み、tick_rateの一定間隔でMatchを進めて盤面を共有メモリに書く
+    Matchは画像を使わないので、このプロセスでは画面を作らない
+    共有メモリの値: [勝者, 発射音の累計, 爆発音の累計, 処理済みの再戦要求, Playerのゲージ, Alienのゲージ]
+    入力: [Playerの入力ビット, Alienの入力ビット, 再戦要求の累計, 終了フラグ]
+    """
+    frame = SharedFrame(shm_name)
+    match = Match()
+    counts = {"shoot": 0, "boom": 0}
+    rematches = 0
+    period = 1.0 / tick_rate
+    next_tick = time.perf_counter()
+    while True:
+        player_bits, alien_bits, rematch, quit = frame.read_input()
+        if quit:
+            break
+        if match.winner is not None and rematch != rematches:
+            rematches = rematch
+            match.reset()
+        if match.winner is None:
+            for sound in match.step(player_bits, alien_bits):
+                counts[sound] += 1
+        world = match.world
+        values = (
+            WINNERS.index(match.winner), counts["shoot"], counts["boom"], rematches,
+            world.gauge_value(match.player), world.gauge_value(match.alien),
+        )
+        frame.publish(match.tick, values, world.records())
+
+        # 描画の重さに関係なく一定間隔でtickを刻む。大きく遅れたら追いつこうとせずに基準を戻す
+        next_tick += period
+        delay = next_tick - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -period * 4:
+            next_tick = time.perf_counter()
+    frame.close()
+
+
+def setup_display(winstyle=0, startup=None):
+    """
+    画面を作って最初のフレーム(背景)を出すところまでをメインスレッドで行い、
+    サウンドやBGM、アイテムと勝利画面の画像はバックグラウンドで読み込む
+    メインループは毎フレームassets.poll()を呼ぶこと
+    戻り値: (screen, background, sounds, assets)
+    """
+    startup = startup or Startup(STARTED)
+    with startup.step("pg.init"):
+        pg.display.init()  # ミキサーなどはここでは初期化しない
+        pg.font.init()
+
+    with startup.step("display"):
+        winstyle = 0  # |FULLSCREEN
+        bestdepth = pg.display.mode_ok(SCREENRECT.size, winstyle, 32)
+        screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
+
+    # Load images, assign to archetypes
+    with startup.step("images"):
+        load_images()
+
+    with startup.step("background"):
+        icon = pg.transform.scale(Alien.images[0], (32, 32))
+        pg.display.set_icon(icon)
+        pg.display.set_caption("Pygame Aliens")
+        pg.mouse.set_visible(0)
+
+        bgdtile = load_image("utyuu.jpg")
+        background = pg.Surface(SCREENRECT.size)
+        background.blit(bgdtile, (0, 0))
+        screen.blit(background, (0, 0))
+        pg.display.flip()
+    startup.mark("first_frame")
+
+    sounds = {}
+    assets = AssetLoader(startup)
+    queue_assets(assets, sounds)
+    return screen, background, sounds, assets.start()
+
+
+def create_hud():
+    """
+    ゲージとスコアの表示を作る
+    戻り値: (hudのグループ, Playerのゲージ, Alienのゲージ, スコア)。フォントが使えなければスコアはNone
+    """
+    hud = pg.sprite.RenderUpdates()
+    player_gauge = Gauge((10, SCREENRECT.height - 100), hud)  # プレイヤーのゲージ
+    alien_gauge = Gauge((10, 10), hud)  # エイリアンのゲージ
+    score = None
     if pg.font:#ここでスコア表示
-        all.add(Score(all))
+        score = Score(hud)
+    return hud, player_gauge, alien_gauge, score
+
 
-    alien = Alien(aliens, all)
-    item = Item(items, all)  # アイテムを初期化し追加
+def toggle_fullscreen(screen, fullscreen):
+    """
+    フルスクリーンとウィンドウを切り替える
+    戻り値: (新しいscreen, 切り替え後のfullscreen)
+    """
+    bestdepth = pg.display.mode_ok(SCREENRECT.size, 0, 32)
+    if not fullscreen:
+        telemetry.emit("display_mode", fullscreen=True)
+        screen_backup = screen.copy()
+        screen = pg.display.set_mode(SCREENRECT.size, pg.FULLSCREEN, bestdepth)
+        screen.blit(screen_backup, (0, 0))
+    else:
+        telemetry.emit("display_mode", fullscreen=False)
+        screen_backup = screen.copy()
+        screen = pg.display.set_mode(SCREENRECT.size, 0, bestdepth)
+        screen.blit(screen_backup, (0, 0))
+    pg.display.flip()
+    return screen, not fullscreen
 
-    if pg.font:
-        all.add(Score(all))
 
-    item_spawn_time = random.randint(300, 600)  # 初回のアイテム出現時間をランダムに設定 (5秒から10秒）
-    item_timer = 0
-    item_spawned = False
+def play_sound(sounds, name, limit=None):
+    """
+    limit : 同じサウンドを同時に鳴らせる数。すでにその数だけ鳴っていたら鳴らさない
+    """
+    sound = sounds.get(name)
+    if pg.mixer and sound is not None and (limit is None or sound.get_num_channels() < limit):
+        sound.play()
+
+
+def dump_crash(match):
+    """
+    例外で落ちたときの試合の状態をlogs/crash-<tick>.binに書き出す
+    Match.restore()で読み込めば、落ちる直前の盤面から再現できる
+    """
+    path = os.path.join(main_dir, "logs", f"crash-{match.tick}.bin")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(match.snapshot())
+    print(f"Crash dump written to {path}")
+
+
+def main(winstyle=0, spectate_port=None, alloc_profile=False, cpu=False):
+    """
+    spectate_port : 指定するとそのポートで観戦用の配信を行う
+    alloc_profile : Trueならフレーム単位のメモリ確保を計測し、終了時にlogsへレポートを書く
+    cpu : TrueならAlienをCPUが操作する
+    """
+    # Initialize pygame
+    screen, background, sounds, assets = setup_display(winstyle)
+    fullscreen = False
+
+    match = Match()
+    feed = None
+    if spectate_port is not None:
+        feed = SpectatorFeed(spectate_port).start()
+        print(f"Spectator feed on port {feed.address[1]}")
+    profiler = AllocationProfiler(os.path.join(main_dir, "logs")).start() if alloc_profile else None
+    cpu = CpuAlien() if cpu else None
+    idle = IdleWaiter()
+    try:
+        run_match(match, screen, background, sounds, assets, fullscreen, feed, profiler, cpu, idle)
+    except Exception:
+        dump_crash(match)
+        raise
+    finally:
+        idle.report()
+        if cpu is not None:
+            cpu.close()
+        if feed is not None:
+            feed.stop()
+        if profiler is not None:
+            print(f"Allocation report written to {profiler.stop()}")
+
+
+def run_match(match, screen, background, sounds, assets, fullscreen, feed=None, profiler=None, cpu=None, idle=None):
+    """
+    ローカル対戦のメインループ
+    F5で盤面をセーブし、F9でセーブした盤面に戻す
+    フレームが予算(25ms)に収まらなくなったらQualityGovernorが描画の品質を下げる
+    勝利画面の間と、誰も操作せず盤面が止まっている間は、IdleWaiterで入力か次のタイマーまで待つ
+    assets : バックグラウンドで読み込み中のアセット
+    feed : 毎tickの盤面を配るSpectatorFeed
+    profiler : フレームの区切りを知らせるAllocationProfiler
+    cpu : Alienを操作するCpuAlien。Noneなら2人目がキーボードで操作する
+    idle : アイドル中の待ち合わせに使うIdleWaiter
+    """
+    if idle is None:
+        idle = IdleWaiter()
+    wins = WinScreens(assets)  # 勝利画面は使い回す
+    renderer = Renderer(ARCHETYPES)
+    hud, player_gauge, alien_gauge, score = create_hud()
 
     clock = pg.time.Clock()
+    governor = QualityGovernor()
+    state = PLAYING
+    saved = None  # F5でセーブした盤面
 
-    while player.alive() and alien.alive():
+    while True:
+        assets.poll()
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 return
             if event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE:
                 return
-            if event.type == pg.KEYDOWN:
-                if event.key == pg.K_f:
-                    if not fullscreen:
-                        print("Changing to FULLSCREEN")
-                        screen_backup = screen.copy()
-                        screen = pg.display.set_mode(SCREENRECT.size, winstyle | pg.FULLSCREEN, bestdepth)
-                        screen.blit(screen_backup, (0, 0))
-                    else:
-                        print("Changing to windowed mode")
-                        screen_backup = screen.copy()
-                        screen = pg.display.set_mode(SCREENRECT.size, winstyle, bestdepth)
-                        screen.blit(screen_backup, (0, 0))
-                    pg.display.flip()
-                    fullscreen = not fullscreen
-
-        keystate = pg.key.get_pressed()
-
-        all.clear(screen, background)
-        all.update()
-
-        direction = keystate[pg.K_RIGHT] - keystate[pg.K_LEFT]
-        player.move(direction)
-
-        player.gauge.update()
-        player.gauge.increase()
-
-        firing = keystate[pg.K_SPACE]
-        if not player.reloading and firing and len(shots) < MAX_SHOTS and player.gauge.can_fire():
-            Shot(player.gunpos(), shots, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-            player.gauge.current_value -= 2
-        player.reloading = firing
-
-        direction = keystate[pg.K_d] - keystate[pg.K_a]
-        alien.move(direction)
-
-        # alien.gauge.update()
-        alien.gauge.increase()
-
-        firing = keystate[pg.K_t]
-        if not alien.reloading and firing and len(bombs) < MAX_BOMBS and alien.gauge.can_fire():
-            Bomb(alien.gunpos(), bombs, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-            alien.gauge.current_value -= 2
-        alien.reloading = firing
-
-
-        if keystate[pg.K_k]:
-            SpreadShot(player.gunpos(), -15, True, shots, all)  # Player用のSpreadShot
-            SpreadShot(player.gunpos(), 0, True, shots, all)
-            SpreadShot(player.gunpos(), 15, True, shots, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-
-        if keystate[pg.K_l]:#第一回を参考に圧されている間じゃなくて押されたときに変更する必要がある
-            SpreadShot(player.gunpos(), -15, True, shots, all) #変更 player用spreadShot
-            SpreadShot(player.gunpos(), 0, True, shots, all)
-            SpreadShot(player.gunpos(), 15, True, shots, all)
-
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-
-        
-        if keystate[pg.K_5]:
-            WavyShot(alien.gunpos(), bombs, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-
-        if keystate[pg.K_6]:
-            SpreadShot(alien.gunpos(), -15, bombs, all)
-            SpreadShot(alien.gunpos(), 0, bombs, all)
-            SpreadShot(alien.gunpos(), 15, bombs, all)
-            if pg.mixer and shoot_sound is not None:
-                shoot_sound.play()
-        
-        for shot in pg.sprite.spritecollide(alien, shots, 1):
-            Explosion(shot, all)
-            Explosion(alien, all)
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
-            all.add(Win("Player"))
-            all.draw(screen)
+            if state == VICTORY and event.type == pg.KEYDOWN and event.key in (pg.K_r, pg.K_RETURN):
+                state = REMATCH
+            if event.type == pg.KEYDOWN and event.key == pg.K_f:
+                screen, fullscreen = toggle_fullscreen(screen, fullscreen)
+            if event.type == pg.KEYDOWN and event.key == pg.K_F10:
+                sampler.toggle()  # 数秒間だけプロファイルを取る
+            if event.type == pg.KEYDOWN and event.key == pg.K_F5:
+                saved = match.snapshot()
+                telemetry.emit("save_state", tick=match.tick, size=len(saved))
+            if event.type == pg.KEYDOWN and event.key == pg.K_F9 and saved is not None:
+                match.restore(saved)
+                telemetry.emit("load_state", tick=match.tick)
+                screen.blit(background, (0, 0))
+                if match.winner is not None:
+                    screen.blit(wins[match.winner].image, wins[match.winner].rect)
+                pg.display.flip()
+                renderer.reset()
+                state = PLAYING if match.winner is None else VICTORY
+
+        if state == VICTORY:
+            # 勝利画面の間もイベントは処理し続ける。画面は変わらないので、読み込み中のアセットがなければ入力を待つ
+            if assets.done:
+                idle.wait()
+                clock.tick()  # 待った時間を次のフレームの処理時間に数えない
+            else:
+                clock.tick(40)
+            if profiler is not None:
+                profiler.skip()  # 試合を進めていない周はフレームに数えない
+            continue
+
+        if state == REMATCH:
+            match.reset()
+            screen.blit(background, (0, 0))
             pg.display.flip()
-            pg.time.wait(5000)
-            alien.kill()
-            return
-
-        for bomb in pg.sprite.spritecollide(player, bombs, 1):
-            Explosion(bomb, all)
-            Explosion(player, all)
-            if pg.mixer and boom_sound is not None:
-                boom_sound.play()
-            player.kill()
-
-            # Display win screen for alien
-            all.add(Win("Alien"))
-            all.draw(screen)
+            renderer.reset()
+            state = PLAYING
+
+        player_bits, alien_bits = read_input(pg.key.get_pressed())
+        if cpu is not None:
+            alien_bits = cpu.bits(match)
+
+        if cpu is None and not player_bits and not alien_bits and assets.done and match.world.is_static():
+            # 盤面が止まっているので、次のタイマーまでは入力がなければ何も変わらない (CPUは毎フレーム考えるので待たない)
+            due = match.world.timers.next_expiry()
+            ticks = MAX_WAIT_TICKS if due is None else due - match.tick - 1
+            if ticks > 0:
+                # 待っていた間のtickを進めて実時間に合わせる。入力はないので盤面は変わらない
+                for _ in range(idle.wait(ticks)):
+                    match.step(0, 0)
+                if feed is not None:
+                    feed.publish(match.tick, *describe_match(match))
+                clock.tick()
+                if profiler is not None:
+                    profiler.skip()
+                continue  # 目を覚ました入力はすぐ次の周で処理する
+
+        for sound in match.step(player_bits, alien_bits):
+            play_sound(sounds, sound, governor.quality.sound_limit)
+        if feed is not None:
+            feed.publish(match.tick, *describe_match(match))
+
+        if match.winner is not None:
+            # 勝利画面を出して、ループは止めずにvictory状態へ移る
+            screen.blit(wins[match.winner].image, wins[match.winner].rect)
             pg.display.flip()
-            pg.time.wait(5000)
-            return
-        
-        all.add(player.gauge)  # プレイヤーのゲージを毎フレーム追加する
-        all.add(alien.gauge)  # エイリアンのゲージを毎フレーム追加する
-
-
-        # draw the scene
-        dirty = all.draw(screen)
-        pg.display.update(dirty)
-        item_timer += 1# アイテム生成タイマーを更新
-        if not item_spawned and item_timer >= item_spawn_time:
-            item.spawn()  # アイテムを生成
-            item_spawned = True
-
-        # アイテムが爆弾と衝突したかを確認
-        if item.collide_bombs(bombs):
-            item_timer = 0
-            item_spawn_time = random.randint(300, 600)  # 新しいアイテム出現時間を設定
-            item = Item(items, all)  # アイテムを初期化し再度作成
-            item_spawned = False
-        
-        if item.collide_shots(shots):
-            item_timer = 0
-            item_spawn_time = random.randint(300, 600)  # 新しいアイテム出現時間を設定
-            item = Item(items, all)  # アイテムを初期化し再度作成
-            item_spawned = False
-        
-        pg.display.update(all.draw(screen))
+            state = VICTORY
+            if profiler is not None:
+                profiler.frame()
+            continue
+
+        # draw the scene (品質が下がっている間は描画を間引く。試合は毎フレーム進む)
+        if governor.render_due():
+            renderer.clear(screen, background)
+            hud.clear(screen, background)
+            if governor.hud_due():
+                player_gauge.current_value = match.world.gauge_value(match.player)
+                alien_gauge.current_value = match.world.gauge_value(match.alien)
+                if score is not None:
+                    score.value = match.score
+                hud.update()
+            dirty = renderer.draw(screen, match.world.records(), group_rects(hud))
+            dirty += hud.draw(screen)
+            pg.display.update(dirty)
 
         clock.tick(40)
-    if pg.mixer:
-        pg.mixer.music.fadeout(1000)
-    pg.time.wait(1000)
+        idle.frame()
+        if profiler is not None:
+            profiler.frame()
+        if governor.frame(clock.get_rawtime() / 1000):
+            match.world.set_clip(Explosion, Explosion.clip if governor.quality.animate_explosions else None)
+
+
+def main_split(winstyle=0):
+    """
+    シミュレーションを別プロセスで動かし、このプロセスは入力と描画だけを行うモード
+    盤面は共有メモリのダブルバッファで受け取る
+    """
+    screen, background, sounds, assets = setup_display(winstyle)
+    fullscreen = False
+    wins = WinScreens(assets)
+    renderer = Renderer(ARCHETYPES)
+    hud, player_gauge, alien_gauge, score = create_hud()
+
+    frame = SharedFrame()
+    context = multiprocessing.get_context("spawn")
+    simulation = context.Process(target=simulation_process, args=(frame.name,), daemon=True)
+    simulation.start()
+
+    clock = pg.time.Clock()
+    rematches = 0
+    last_tick = -1
+    played = {"shoot": 0, "boom": 0}
+    try:
+        while simulation.is_alive():
+            assets.poll()
+            for event in pg.event.get():
+                if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                    return
+                if event.type == pg.KEYDOWN and event.key in (pg.K_r, pg.K_RETURN):
+                    rematches += 1
+                if event.type == pg.KEYDOWN and event.key == pg.K_f:
+                    screen, fullscreen = toggle_fullscreen(screen, fullscreen)
+                if event.type == pg.KEYDOWN and event.key == pg.K_F10:
+                    sampler.toggle()  # 数秒間だけプロファイルを取る
+            player_bits, alien_bits = read_input(pg.key.get_pressed())
+
+            tick, values, records = frame.read()
+            winner, shoot_count, boom_count, rematches_done = WINNERS[values[0]], *values[1:4]
+            if winner is None or rematches_done == rematches:
+                rematches = rematches_done  # 決着前に押されたRは無視する
+            frame.write_input(player_bits, alien_bits, rematches, 0)
+
+            if tick == last_tick:
+                clock.tick(40)
+                continue
+            last_tick = tick
+            for name, count in (("shoot", shoot_count), ("boom", boom_count)):
+                if count > played[name]:
+                    play_sound(sounds, name)
+                played[name] = count
+
+            if winner is not None:
+                screen.blit(wins[winner].image, wins[winner].rect)
+                pg.display.flip()
+                screen.blit(background, (0, 0))  # 再戦後は背景から描き直す
+                renderer.reset()
+                clock.tick(40)
+                continue
+
+            # 前のフレームで描いた場所を背景で消してから描き直す
+            renderer.clear(screen, background)
+            hud.clear(screen, background)
+            player_gauge.current_value, alien_gauge.current_value = values[4], values[5]
+            hud.update()
+            dirty = renderer.draw(screen, records, group_rects(hud))
+            dirty += hud.draw(screen)
+            pg.display.update(dirty)
+            clock.tick(40)
+    finally:
+        frame.write_input(0, 0, rematches, 1)
+        simulation.join(1.0)
+        frame.close()
+
+
+def main_online(side, port, peer, seed=0, winstyle=0):
+    """
+    UDPでつながった相手とロールバック方式で対戦するモード
+    side : 自分が操作する側("player"か"alien")。操作キーはローカル対戦と同じ
+    port : 待ち受けるUDPポート
+    peer : 相手の (ホスト, ポート)。Noneなら最初に届いたパケットの送信元
+    seed : 両方の端末で同じ値にする乱数の種
+    """
+    screen, background, sounds, assets = setup_display(winstyle)
+    fullscreen = False
+    wins = WinScreens(assets)
+    renderer = Renderer(ARCHETYPES)
+    hud, player_gauge, alien_gauge, score = create_hud()
+
+    match = OnlineMatch(seed)
+    local_index = 0 if side == "player" else 1
+    session = RollbackSession(match, UdpTransport(("0.0.0.0", port), peer), local_index)
+
+    clock = pg.time.Clock()
+    showing = None  # 表示中の勝利画面
+    try:
+        while True:
+            assets.poll()
+            for event in pg.event.get():
+                if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                    return
+                if event.type == pg.KEYDOWN and event.key == pg.K_f:
+                    screen, fullscreen = toggle_fullscreen(screen, fullscreen)
+                if event.type == pg.KEYDOWN and event.key == pg.K_F10:
+                    sampler.toggle()  # 数秒間だけプロファイルを取る
+            keystate = pg.key.get_pressed()
+            bits = read_input(keystate)[local_index]
+            if keystate[pg.K_r] or keystate[pg.K_RETURN]:
+                bits |= REMATCH_REQUEST
+
+            played = session.advance(bits)
+            if played is None:
+                clock.tick(40)  # 相手の入力待ち
+                continue
+            for sound in played:
+                play_sound(sounds, sound)
+
+            # ロールバックで決着が取り消されることもあるので、毎フレーム今の状態に合わせる
+            if match.winner != showing:
+                showing = match.winner
+                screen.blit(background, (0, 0))
+                if showing is not None:
+                    screen.blit(wins[showing].image, wins[showing].rect)
+                pg.display.flip()
+                renderer.reset()
+            if showing is not None:
+                clock.tick(40)
+                continue
+
+            renderer.clear(screen, background)
+            hud.clear(screen, background)
+            player_gauge.current_value = match.world.gauge_value(match.player)
+            alien_gauge.current_value = match.world.gauge_value(match.alien)
+            if score is not None:
+                score.value = match.score
+            hud.update()
+            dirty = renderer.draw(screen, match.world.records(), group_rects(hud))
+            dirty += hud.draw(screen)
+            pg.display.update(dirty)
+            clock.tick(40)
+    finally:
+        session.close()
+
+
+def describe_match(match):
+    """
+    サーバーからクライアントに送る盤面
+    戻り値: ([勝者, Playerのゲージ, Alienのゲージ], (kind, frame, x, y)の配列)
+    """
+    world = match.world
+    values = (WINNERS.index(match.winner), world.gauge_value(match.player), world.gauge_value(match.alien))
+    return values, world.columns()
+
+
+def create_server_match(match_id):
+    match = OnlineMatch(match_id)  # 試合IDを乱数の種にする
+    match.quiet = True  # 数百試合分のイベントでテレメトリが溢れないようにする
+    return match
+
+
+def main_server(port, bots=0, duration=None):
+    """
+    画面を持たないサーバーとして、たくさんの試合を1つのイベントループで進めるモード
+    bots : 負荷試験としてローカルのクライアントでつなぐ試合の数
+    """
+    server = matchserver.MatchServer(create_server_match, describe_match)
+    try:
+        asyncio.run(matchserver.serve(server, port=port, bots=bots, duration=duration))
+    except KeyboardInterrupt:
+        pass
+
+
+def main_watch(address, winstyle=0):
+    """
+    SpectatorFeedの配信を受け取って表示するだけの観戦モード
+    """
+    screen, background, _, assets = setup_display(winstyle)
+    fullscreen = False
+    wins = WinScreens(assets)
+    renderer = Renderer(ARCHETYPES)
+    hud, player_gauge, alien_gauge, score = create_hud()
+    client = SpectatorClient(address)
+
+    clock = pg.time.Clock()
+    last_tick = None
+    showing = None  # 表示中の勝利画面
+    try:
+        while client.connected:
+            assets.poll()
+            for event in pg.event.get():
+                if event.type == pg.QUIT or (event.type == pg.KEYDOWN and event.key == pg.K_ESCAPE):
+                    return
+                if event.type == pg.KEYDOWN and event.key == pg.K_f:
+                    screen, fullscreen = toggle_fullscreen(screen, fullscreen)
+                if event.type == pg.KEYDOWN and event.key == pg.K_F10:
+                    sampler.toggle()  # 数秒間だけプロファイルを取る
+            latest = client.latest
+            if latest is None or latest[0] == last_tick:
+                clock.tick(40)
+                continue
+            last_tick, values, records = latest
+
+            winner = WINNERS[values[0]]
+            if winner != showing:
+                showing = winner
+                screen.blit(background, (0, 0))
+                if showing is not None:
+                    screen.blit(wins[showing].image, wins[showing].rect)
+                pg.display.flip()
+                renderer.reset()
+            if showing is not None:
+                clock.tick(40)
+                continue
+
+            renderer.clear(screen, background)
+            hud.clear(screen, background)
+            player_gauge.current_value, alien_gauge.current_value = values[1], values[2]
+            hud.update()
+            dirty = renderer.draw(screen, records, group_rects(hud))
+            dirty += hud.draw(screen)
+            pg.display.update(dirty)
+            clock.tick(40)
+    finally:
+        client.close()
+
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--split", action="store_true", help="シミュレーションを別プロセスで動かす")
+    parser.add_argument("--online", metavar="HOST:PORT", nargs="?", const="", help="UDPでオンライン対戦する (相手のアドレス)")
+    parser.add_argument("--port", type=int, default=50007, help="オンライン対戦で待ち受けるポート")
+    parser.add_argument("--side", choices=("player", "alien"), default="player", help="オンライン対戦で操作する側")
+    parser.add_argument("--seed", type=int, default=0, help="オンライン対戦の乱数の種 (両方で同じにする)")
+    parser.add_argument("--server", metavar="PORT", type=int, nargs="?", const=50010, help="画面なしの対戦サーバーとして動かす")
+    parser.add_argument("--bots", type=int, default=0, help="サーバーの負荷試験でローカルからつなぐ試合の数")
+    parser.add_argument("--duration", type=float, help="サーバーを動かす秒数")
+    parser.add_argument("--spectate", metavar="PORT", type=int, nargs="?", const=50020, help="ローカル対戦を観戦用に配信する")
+    parser.add_argument("--watch", metavar="HOST:PORT", help="配信されている試合を観戦する")
+    parser.add_argument("--alloc-profile", action="store_true", help="フレーム単位のメモリ確保を計測する")
+    parser.add_argument("--cpu", action="store_true", help="AlienをCPUが操作する")
+    args = parser.parse_args()
+    telemetry.start(os.path.join(main_dir, "logs"))
+    sampler.install(os.path.join(main_dir, "logs"))  # F10かSIGUSR1でプロファイルを取る
+    try:
+        if args.server is not None:
+            main_server(args.server, args.bots, args.duration)
+        elif args.online is not None:
+            main_online(args.side, args.port, parse_address(args.online) if args.online else None, args.seed)
+        elif args.watch:
+            main_watch(parse_address(args.watch))
+        elif args.split:
+            main_split()
+        else:
+            main(spectate_port=args.spectate, alloc_profile=args.alloc_profile, cpu=args.cpu)
+    finally:
+        telemetry.stop()
     pg.quit()
@@ -0,0 +1,152 @@
+"""
+ゲーム内のイベントを構造化して記録するテレメトリ
+
+emit()はイベントをキューに積むだけで、JSONへの変換やファイル書き込みは
+バックグラウンドのライタースレッドがまとめて行う。
+出力先はローテーションするJSONLファイル(telemetry.jsonl, telemetry.1.jsonl, ...)。
+ライタースレッドが書き込みで詰まってもメモリが増え続けないよう、キューはqueue_size件までで、
+溢れたイベントは捨てて数え、次に書き出すときにtelemetry_droppedとして記録する。
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class Telemetry:
+    """
+    イベントキューとライタースレッドをまとめたクラス
+    directory : 出力先ディレクトリ
+    max_bytes : 1ファイルの最大サイズ。超えたらローテーションする
+    backup_count : 残しておく古いファイルの数
+    flush_interval : ライタースレッドがキューを吸い出す間隔(秒)
+    queue_size : キューに溜めておけるイベントの数。超えた分は捨てる
+    """
+
+    filename = "telemetry.jsonl"
+
+    def __init__(self, directory, max_bytes=1 << 20, backup_count=5, flush_interval=0.5, queue_size=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        # deque.append/popleftはGILの下でアトミックなので、ロックを取らずに
+        # ゲームスレッドとライタースレッドで共有できる
+        self.queue = collections.deque()
+        self.overflowed = 0  # キューが溢れて捨てたイベントの数 (ゲームスレッドだけが増やす)
+        self.unencodable = 0  # JSONにできずに捨てたイベントの数 (ライタースレッドだけが増やす)
+        self.reported = 0  # telemetry_droppedとして記録済みのdropped
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="telemetry-writer", daemon=True)
+        self._file = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._file = open(self._path(0), "a", encoding="utf-8")
+        self._thread.start()
+
+    def stop(self):
+        """
+        ライタースレッドを止め、残っているイベントを書き出してファイルを閉じる
+        """
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._drain()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def dropped(self):
+        """捨てたイベントの数"""
+        return self.overflowed + self.unencodable
+
+    def emit(self, event, **fields):
+        """
+        イベントを1件キューに積む。ゲームループから呼ばれるので余計な処理はしない
+        """
+        if len(self.queue) >= self.queue_size:
+            self.overflowed += 1
+            return
+        self.queue.append((time.time(), event, fields))
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._drain()
+
+    def _drain(self):
+        """
+        キューにたまったイベントをまとめてJSONLとして書き出す
+        """
+        queue = self.queue
+        lines = []
+        while queue:
+            ts, event, fields = queue.popleft()
+            record = {"ts": round(ts, 6), "event": event}
+            record.update(fields)
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False))
+            except (TypeError, ValueError):
+                self.unencodable += 1
+        dropped = self.dropped
+        if dropped != self.reported:
+            lines.append(json.dumps({
+                "ts": round(time.time(), 6), "event": "telemetry_dropped",
+                "dropped": dropped - self.reported, "total": dropped,
+            }))
+            self.reported = dropped
+        if not lines or self._file is None:
+            return
+        self._file.write("\n".join(lines) + "\n")
+        self._file.flush()
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _path(self, index):
+        if index == 0:
+            return os.path.join(self.directory, self.filename)
+        stem, ext = os.path.splitext(self.filename)
+        return os.path.join(self.directory, f"{stem}.{index}{ext}")
+
+    def _rotate(self):
+        """
+        telemetry.jsonl -> telemetry.1.jsonl -> ... と古いファイルをずらす
+        """
+        self._file.close()
+        for index in range(self.backup_count - 1, 0, -1):
+            src = self._path(index)
+            if os.path.exists(src):
+                os.replace(src, self._path(index + 1))
+        if self.backup_count > 0:
+            os.replace(self._path(0), self._path(1))
+        else:
+            os.remove(self._path(0))
+        self._file = open(self._path(0), "a", encoding="utf-8")
+
+
+_active = None
+
+
+def start(directory, **options):
+    """テレメトリを開始する。開始前のemit()は何もしない"""
+    global _active
+    if _active is None:
+        _active = Telemetry(directory, **options)
+        _active.start()
+    return _active
+
+
+def stop():
+    global _active
+    if _active is not None:
+        _active.stop()
+        _active = None
+
+
+def emit(event, **fields):
+    if _active is not None:
+        _active.emit(event, **fields)
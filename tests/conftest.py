@@ -0,0 +1,25 @@
+"""
+テストの共通設定
+
+画面やサウンドのない環境でも動くようにSDLのダミードライバを使う。
+suta-_koukaton.pyはファイル名にハイフンがあってimportできないので、gameフィクスチャで読み込む。
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def game():
+    spec = importlib.util.spec_from_file_location("suta_koukaton", os.path.join(ROOT, "suta-_koukaton.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,145 @@
+"""
+MatchServerを127.0.0.1のソケットで動かすテスト
+試合は入力を覚えておくだけの代役を使い、tickはrun()ではなくstep()で1つずつ進める
+"""
+
+import asyncio
+import socket
+from array import array
+
+from matchserver import DATAGRAM, HELLO, MAGIC, STATE, MatchServer
+
+
+class FakeMatch:
+    def __init__(self, match_id):
+        self.match_id = match_id
+        self.tick = 0
+        self.inputs = []
+
+    def step(self, *inputs):
+        self.tick += 1
+        self.inputs.append(inputs)
+
+
+def describe(match):
+    return [match.match_id], (array("B", [1]), array("B", [0]), array("h", [10]), array("h", [20]))
+
+
+async def settle():
+    """接続やデータの受け渡しをイベントループに済ませさせる"""
+    for _ in range(20):
+        await asyncio.sleep(0.005)
+
+
+async def started(**options):
+    server = MatchServer(FakeMatch, describe, **options)
+    tcp_port, udp_port = await server.start("127.0.0.1", 0, 0)
+    return server, tcp_port, udp_port
+
+
+def udp_client():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setblocking(False)
+    return sock
+
+
+def test_tcp_client_drives_its_match_and_receives_state():
+    async def scenario():
+        server, tcp_port, _ = await started()
+        reader, writer = await asyncio.open_connection("127.0.0.1", tcp_port)
+        writer.write(HELLO.pack(MAGIC, 7, 1) + bytes((5,)))
+        await settle()
+        server.step()
+        match_id, tick, count, *values = STATE.unpack(await reader.readexactly(STATE.size))
+        assert (match_id, tick, count, values[0]) == (7, 1, 1, 7)
+        assert server.rooms[7].match.inputs == [(0, 5)]
+        writer.close()
+        await settle()
+        assert 7 not in server.rooms  # 最後のクライアントが切れたら閉じる
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_udp_cannot_open_rooms():
+    async def scenario():
+        server, _, udp_port = await started()
+        sock = udp_client()
+        for match_id in range(100):
+            sock.sendto(DATAGRAM.pack(MAGIC, match_id, 0, 1), ("127.0.0.1", udp_port))
+        await settle()
+        server.step()
+        assert server.rooms == {}
+        assert server.unknown == 100
+        sock.close()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_udp_joins_an_open_room():
+    async def scenario():
+        server, _, udp_port = await started()
+        server.open(3)
+        sock = udp_client()
+        sock.sendto(DATAGRAM.pack(MAGIC, 3, 0, 9), ("127.0.0.1", udp_port))
+        await settle()
+        server.step()
+        await settle()
+        data = sock.recv(2048)
+        assert STATE.unpack_from(data)[:2] == (3, 1)
+        assert server.rooms[3].match.inputs == [(9, 0)]
+        sock.close()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_hello_beyond_max_rooms_is_refused():
+    async def scenario():
+        server, tcp_port, _ = await started(max_rooms=1)
+        first = await asyncio.open_connection("127.0.0.1", tcp_port)
+        first[1].write(HELLO.pack(MAGIC, 1, 0))
+        await settle()
+        reader, writer = await asyncio.open_connection("127.0.0.1", tcp_port)
+        writer.write(HELLO.pack(MAGIC, 2, 0))
+        await settle()
+        assert await reader.read() == b""  # サーバーが閉じた
+        assert list(server.rooms) == [1]
+        assert server.rejected == 1
+        writer.close()
+        first[1].close()
+        await settle()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_a_side_belongs_to_whoever_claimed_it_first():
+    async def scenario():
+        server, tcp_port, udp_port = await started()
+        reader, writer = await asyncio.open_connection("127.0.0.1", tcp_port)
+        writer.write(HELLO.pack(MAGIC, 4, 0) + bytes((1,)))
+        await settle()
+        owner, intruder = udp_client(), udp_client()
+        owner.sendto(DATAGRAM.pack(MAGIC, 4, 1, 2), ("127.0.0.1", udp_port))
+        await settle()
+        intruder.sendto(DATAGRAM.pack(MAGIC, 4, 1, 7), ("127.0.0.1", udp_port))  # UDPで取った側
+        intruder.sendto(DATAGRAM.pack(MAGIC, 4, 0, 7), ("127.0.0.1", udp_port))  # TCPで取った側
+        second = await asyncio.open_connection("127.0.0.1", tcp_port)
+        second[1].write(HELLO.pack(MAGIC, 4, 0))
+        await settle()
+        server.step()
+        assert server.rooms[4].match.inputs == [(1, 2)]
+        assert server.foreign == 3
+        assert list(server.rooms[4].peers) == [owner.getsockname()]
+        assert await second[0].read() == b""
+        for sock in (owner, intruder):
+            sock.close()
+        writer.close()
+        second[1].close()
+        await settle()
+        server.close()
+
+    asyncio.run(scenario())
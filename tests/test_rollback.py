@@ -0,0 +1,154 @@
+"""
+RollbackSessionをループバックのUDPでつないだ2人分で動かすテスト
+"""
+
+import random
+import time
+import zlib
+
+from rollback import MAGIC, PACKET, RollbackSession, UdpTransport, loopback_pair
+
+FRAME_BUDGET = 0.025  # 40fpsの1フレーム
+
+
+def inputs(seed, frames):
+    """しばらく同じ入力を押し続けては変える、予測が外れやすい入力列"""
+    rng = random.Random(seed)
+    bits = []
+    while len(bits) < frames:
+        bits += [rng.choice((0, 1, 2, 4, 5, 6))] * rng.randint(1, 12)
+    return bits[:frames]
+
+
+def settle(sessions, timeout=5.0):
+    """
+    お互いの入力が最後まで届き、外れた予測を進め直すまで待つ
+    """
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        for session in sessions:
+            session.poll()
+            session.send()
+            if session.rollback_from is not None:
+                session.resimulate()
+        if all(session.remote_frame == session.frame - 1 and session.rollback_from is None for session in sessions):
+            return
+        time.sleep(0.001)
+    raise AssertionError("sessions did not receive each other's inputs")
+
+
+def checksum(match):
+    return zlib.crc32(match.snapshot())
+
+
+def play(game, delay, loss, frames=240, seed=1):
+    """
+    遅延と欠落のあるループバックで2人分のセッションをframesフレームまで進める
+    """
+    transports = loopback_pair(delay=delay, jitter=delay / 2, loss=loss, seed=seed)
+    sessions = [RollbackSession(game.OnlineMatch(seed), transport, index) for index, transport in enumerate(transports)]
+    plans = [inputs(seed * 2 + index, frames) for index in range(2)]
+    try:
+        while any(session.frame < frames for session in sessions):
+            for session, plan in zip(sessions, plans):
+                if session.frame < frames:
+                    session.advance(plan[session.frame])
+                else:
+                    # 先に着いた側も、相手が追いつけるように入力の送受信は続ける
+                    session.poll()
+                    session.send()
+            time.sleep(0.002)
+        settle(sessions)
+    finally:
+        for session in sessions:
+            session.close()
+    return sessions
+
+
+def test_checksums_converge_over_delay_and_loss(game):
+    sessions = play(game, delay=0.03, loss=0.2)
+    assert all(session.rollbacks for session in sessions)
+    assert checksum(sessions[0].sim) == checksum(sessions[1].sim)
+
+
+def test_checksums_converge_on_a_clean_line(game):
+    sessions = play(game, delay=0.0, loss=0.0)
+    assert checksum(sessions[0].sim) == checksum(sessions[1].sim)
+
+
+def test_long_resimulation_fits_in_a_frame(game):
+    sessions = play(game, delay=0.06, loss=0.1)
+    assert max(session.max_resim_frames for session in sessions) >= 8
+    assert max(session.max_resim_seconds for session in sessions) < FRAME_BUDGET
+
+
+def test_packets_from_strangers_are_ignored():
+    a, b = loopback_pair()
+    stranger = UdpTransport(("127.0.0.1", 0), b.address)
+    try:
+        stranger.send(PACKET.pack(MAGIC, 0, 1000, 1) + bytes((1,)))
+        a.send(b"from the peer")
+        time.sleep(0.05)
+        assert b.receive() == [b"from the peer"]
+    finally:
+        for transport in (a, b, stranger):
+            transport.close()
+
+
+class Recorder:
+    """送ったものを捨てて、渡されたパケットだけを返す通信路"""
+
+    def __init__(self):
+        self.inbox = []
+
+    def send(self, data):
+        pass
+
+    def receive(self):
+        inbox, self.inbox = self.inbox, []
+        return inbox
+
+    def close(self):
+        pass
+
+
+def test_forged_ack_and_far_inputs_are_not_trusted(game):
+    transport = Recorder()
+    session = RollbackSession(game.OnlineMatch(1), transport, 0)
+    for _ in range(5):
+        session.advance(1)
+    transport.inbox.append(PACKET.pack(MAGIC, 0, 1000, 1) + bytes((2,)))
+    transport.inbox.append(PACKET.pack(MAGIC, 10000, 0, 1) + bytes((2,)))
+    session.poll()
+    assert session.acked == session.frame - 1  # 送ったフレームより先は受け取ったことにしない
+    assert max(session.remote_inputs) == 0
+    session.advance(1)
+    assert session.frame - 1 in session.local_inputs  # 確認されていない入力は捨てない
+
+
+def test_only_confirmed_frames_reach_telemetry(game, monkeypatch):
+    import rollback
+
+    flushed = {}  # セッション -> そのセッションが出したゲームのイベント
+    prune = rollback.RollbackSession.prune
+
+    def recording_prune(session):
+        def emit(event, **fields):
+            if not event.startswith("rollback"):
+                flushed.setdefault(session, []).append((event, fields))
+
+        monkeypatch.setattr(rollback.telemetry, "emit", emit)
+        prune(session)
+
+    monkeypatch.setattr(rollback.RollbackSession, "prune", recording_prune)
+    sessions = play(game, delay=0.03, loss=0.2, frames=400)
+    for session in sessions:
+        session.prune()
+    reference = game.OnlineMatch(1)
+    reference.recorded = []
+    for bits in zip(*(inputs(2 + index, 400) for index in range(2))):
+        reference.step(*bits)
+    assert reference.recorded  # 比べるイベントが出るくらいは進める
+    assert all(session.rollbacks for session in sessions)
+    for session in sessions:
+        assert flushed[session] == reference.recorded  # 予測で進めたフレームのイベントは混ざらない
@@ -0,0 +1,68 @@
+"""
+Match.snapshot()/restore()と、スナップショットの差分(snapshot.delta)のテスト
+"""
+
+import random
+
+from snapshot import apply_delta, delta
+
+
+def inputs(game, seed, frames, calm=60):
+    """
+    動き回りながらときどき撃つ、両側の入力ビットの列。calmが大きいほど撃たない
+    決着がついても続くように再戦も求める (OnlineMatchは決着後の入力で再戦を始める)
+    """
+    rng = random.Random(seed)
+    moves = (0, game.MOVE_LEFT, game.MOVE_RIGHT)
+    shots = (0,) * calm + (game.FIRE, game.SPREAD, game.WAVY)
+    return [
+        tuple(rng.choice(moves) | rng.choice(shots) | game.REMATCH_REQUEST * (rng.random() < 0.05) for _ in range(2))
+        for _ in range(frames)
+    ]
+
+
+def played(game, frames, seed=1):
+    """framesフレーム進めたあと、決着前で弾などが出ているところで止めたOnlineMatch"""
+    match = game.OnlineMatch(seed)
+    match.quiet = True
+    plan = inputs(game, seed, frames * 2)
+    for bits in plan[:frames]:
+        match.step(*bits)
+    for bits in plan[frames:]:
+        if match.winner is None and len(match.world) > 2:
+            break
+        match.step(*bits)
+    return match
+
+
+def test_restored_match_steps_identically(game):
+    match = played(game, 400)
+    assert match.winner is None and len(match.world) > 2
+    copy = game.OnlineMatch(99)  # 乱数の種が違っても、restore()で同じ状態になる
+    copy.quiet = True
+    copy.restore(match.snapshot())
+    assert copy.snapshot() == match.snapshot()
+    assert copy.item_spawn.expires == match.item_spawn.expires  # アイテムのタイマーも引き継ぐ
+    for bits in inputs(game, 2, 600, calm=10):  # 決着と再戦も挟む
+        assert copy.step(*bits) == match.step(*bits)
+        assert copy.snapshot() == match.snapshot()
+
+
+def test_delta_rebuilds_the_snapshot_from_a_keyframe(game):
+    match = played(game, 200)
+    keyframe = match.snapshot()
+    for bits in inputs(game, 3, 150):
+        match.step(*bits)
+        current = match.snapshot()
+        patch = delta(keyframe, current)
+        assert apply_delta(keyframe, patch) == current
+        assert len(patch) < len(current)
+    copy = game.OnlineMatch()
+    copy.restore(apply_delta(keyframe, patch))
+    assert copy.snapshot() == current
+
+
+def test_delta_handles_a_shorter_snapshot():
+    old, new = bytes(range(200)), bytes(range(40)) + b"changed"
+    assert apply_delta(old, delta(old, new)) == new
+    assert apply_delta(new, delta(new, old)) == old
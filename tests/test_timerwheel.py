@@ -0,0 +1,151 @@
+"""
+TimerWheelを、すべてのタイマーを毎tick見て回す素朴な実装と比べるテスト
+"""
+
+import random
+
+from timerwheel import LEVELS, SLOT_BITS, TimerWheel
+
+
+def plan(seed, count=400, horizon=20000):
+    """
+    (登録するtick, 遅延, 繰り返し間隔) の並び。段をまたぐ遅延も混ぜる
+    繰り返し間隔が0でなければevery()で登録し、遅延は使わない
+    """
+    rng = random.Random(seed)
+    timers = []
+    for _ in range(count):
+        delay = rng.choice((rng.randint(1, 70), rng.randint(60, horizon // 4), rng.randint(horizon // 5, horizon)))
+        interval = rng.choice((0, 0, 0, rng.randint(1, 300)))
+        timers.append((rng.randint(0, 3000), delay, interval))
+    return sorted(timers, key=lambda timer: timer[0])
+
+
+def expected(timers, ticks):
+    """素朴な実装で求めた、tickごとに発火するタイマーの番号の集合"""
+    fired = {}
+    for number, (start, delay, interval) in enumerate(timers):
+        tick = start + (interval or delay)
+        while tick <= ticks:
+            fired.setdefault(tick, set()).add(number)
+            if not interval:
+                break
+            tick += interval
+    return fired
+
+
+def run(timers, ticks, between=None):
+    """
+    timersを登録しながらticksまで進め、発火した (tick, 番号) を順に返す
+    between(wheel, fired) : 毎tickの前に呼ぶ。保存と復元を挟むのに使う
+    """
+    wheel = TimerWheel()
+    fired = []
+    pending = list(enumerate(timers))
+    while wheel.tick < ticks:
+        while pending and pending[0][1][0] == wheel.tick:
+            number, (_, delay, interval) = pending.pop(0)
+            if interval:
+                wheel.every(interval, fired_at, wheel, fired, number)
+            else:
+                wheel.schedule(delay, fired_at, wheel, fired, number)
+        if between is not None:
+            between(wheel, fired)
+        wheel.advance()
+    return fired
+
+
+def fired_at(wheel, fired, number):
+    fired.append((wheel.tick, number))
+
+
+def test_every_timer_fires_at_its_tick():
+    timers = plan(1)
+    fired = run(timers, 12000)
+    by_tick = {}
+    for tick, number in fired:
+        by_tick.setdefault(tick, set()).add(number)
+    assert by_tick == expected(timers, 12000)
+
+
+def test_firing_order_is_deterministic():
+    timers = plan(2)
+    assert run(timers, 8000) == run(timers, 8000)
+
+
+def test_cascade_across_every_level():
+    wheel = TimerWheel()
+    fired = []
+    delays = [(1 << (SLOT_BITS * level)) + offset for level in range(LEVELS) for offset in (-1, 0, 1)]
+    for delay in delays:
+        wheel.schedule(delay, fired.append, delay)
+    wheel.advance(delays[-1])
+    assert fired == sorted(delays)
+    assert wheel.next_expiry() is None
+
+
+def test_beyond_the_top_level_still_fires():
+    wheel = TimerWheel()
+    fired = []
+    delay = (1 << (SLOT_BITS * LEVELS)) + 5
+    wheel.schedule(delay, fired.append, "late")
+    wheel.advance(delay - 1)
+    assert fired == []
+    wheel.advance()
+    assert fired == ["late"]
+
+
+def test_save_and_load_roll_back_everything_after_the_save():
+    timers = plan(3, count=200, horizon=3000)
+
+    def rewind(wheel, fired):
+        # ロールバックと同じ使い方: 保存して先へ進め、保存した時点に戻して進め直す
+        if wheel.tick != 1000:
+            return
+        state, count = wheel.save(), len(fired)
+        wheel.schedule(5, fired.append, (0, -1))  # 戻したら消えるタイマー
+        wheel.advance(300)
+        assert len(fired) > count + 1
+        wheel.load(state)
+        del fired[count:]
+
+    assert run(timers, 4000, rewind) == run(timers, 4000)
+
+
+def test_load_revives_a_timer_that_fired_after_the_save():
+    wheel = TimerWheel()
+    timer = wheel.schedule(10)
+    state = wheel.save()
+    wheel.advance(10)
+    assert not timer.pending
+    wheel.load(state)
+    assert timer.pending and timer.expires == 10
+    wheel.advance(9)
+    assert timer.pending
+    wheel.advance()
+    assert not timer.pending
+
+
+def test_pack_and_unpack_round_trip():
+    fired = []
+    callbacks = [fired.append]
+    wheel = TimerWheel()
+    rng = random.Random(4)
+    for _ in range(300):
+        if rng.random() < 0.3:
+            wheel.every(rng.randint(1, 500), fired.append, rng.randint(0, 1000))
+        else:
+            wheel.schedule(rng.randint(1, 30000), fired.append, rng.randint(0, 1000))
+        wheel.advance(rng.randint(0, 20))
+    wheel.schedule(50)  # コールバックのない待ち時間だけのタイマー
+    data = wheel.pack(callbacks)
+    copy = TimerWheel()
+    assert copy.unpack(b"head" + data, callbacks, offset=4) == 4 + len(data)
+    assert copy.pack(callbacks) == data
+    assert copy.next_expiry() == wheel.next_expiry()
+
+    fired.clear()
+    wheel.advance(20000)
+    expected_fired, fired[:] = list(fired), []
+    copy.advance(20000)
+    assert fired == expected_fired
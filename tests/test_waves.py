@@ -0,0 +1,37 @@
+"""
+WaveScheduleとWaveCursorが種だけで決まることのテスト
+"""
+
+from waves import WaveCursor, WaveSchedule
+
+
+def played(seed, ticks=3000, level=0):
+    """WaveCursorをticksまで進めて、出来事のあったtickと内容を並べる"""
+    cursor = WaveCursor(WaveSchedule(seed), level)
+    events = []
+    for tick in range(ticks):
+        facing, bomb = cursor.advance(tick)
+        if facing or bomb:
+            events.append((tick, facing, bomb))
+    return events
+
+
+def test_same_seed_same_waves():
+    assert played(7) == played(7)
+
+
+def test_different_seeds_differ():
+    assert played(7) != played(8)
+
+
+def test_a_level_is_the_same_on_its_own():
+    schedule = WaveSchedule(7)
+    alone = schedule.level(3)
+    cursor = WaveCursor(schedule)
+    for tick in range(alone.start + 1):
+        cursor.advance(tick)
+    assert cursor.level.number == 3
+    assert (cursor.level.spawns, cursor.level.facings, cursor.level.bombs) == (alone.spawns, alone.facings, alone.bombs)
+    assert played(7, ticks=alone.length, level=3) == [
+        (tick - alone.start, facing, bomb) for tick, facing, bomb in played(7, ticks=alone.end) if tick >= alone.start
+    ]
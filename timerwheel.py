@@ -0,0 +1,211 @@
+"""
+シミュレーションのtick数で動く階層型タイマーホイール
+
+ゲージの回復、アイテムの出現、爆発の寿命、リロードの待ち時間などを
+コールバックとして登録しておき、毎フレームadvance()を1回呼ぶ。
+1フレームの処理量は登録されているタイマーの数ではなく、
+そのフレームに発火するタイマーの数に比例する。
+壁時計を使わないので、ヘッドレスで同じ入力を再生すれば同じ順番で発火する。
+"""
+
+import struct
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS  # 1段あたりのスロット数
+SLOT_MASK = SLOTS - 1
+LEVELS = 4  # 64 ** 4 tick (40fpsで約4.8日) まで直接表現できる
+
+# pack()の形式
+PACKED = struct.Struct("<qI")  # tick, タイマーの数
+PACKED_TIMER = struct.Struct("<BBqIBBq")  # 段, スロット, 発火tick, 間隔, コールバック番号, 引数の数, 引数
+
+
+class Timer:
+    """
+    登録されたタイマー1件
+    expires : 発火するtick
+    interval : 繰り返し間隔。0なら1回だけ
+    """
+
+    __slots__ = ("expires", "interval", "callback", "args", "pending")
+
+    def __init__(self, expires, interval, callback, args):
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.pending = True  # 発火待ちならTrue。発火済み・キャンセル済みならFalse
+
+    def cancel(self):
+        self.pending = False
+
+
+class TimerWheel:
+    """
+    階層型タイマーホイール
+    tick : 処理済みのtick数
+    0段目は1tick単位、1段目は64tick単位…とスロットの粒度が上がっていき、
+    上の段のスロットは時間が来たら下の段に振り分け直す(カスケード)
+    """
+
+    def __init__(self):
+        self.tick = 0
+        self.wheels = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+
+    def schedule(self, delay, callback=None, *args):
+        """
+        delay tick後に1回だけcallback(*args)を呼ぶ。
+        callbackを省略すると、Timer.pendingで待ち時間が終わったかを調べるだけのタイマーになる
+        """
+        timer = Timer(self.tick + max(1, int(delay)), 0, callback, args)
+        self._insert(timer, self.tick)
+        return timer
+
+    def every(self, interval, callback, *args):
+        """
+        interval tickごとにcallback(*args)を呼び続ける
+        """
+        interval = max(1, int(interval))
+        timer = Timer(self.tick + interval, interval, callback, args)
+        self._insert(timer, self.tick)
+        return timer
+
+    def advance(self, ticks=1):
+        """
+        時間をticks分進めて、期限が来たタイマーを発火させる
+        同じtickのタイマーはスロットに入った順に発火する。上の段から振り分け直したタイマーは
+        その時点で入るので登録順とは限らないが、同じ操作をすれば順番はいつも同じになる
+        """
+        for _ in range(ticks):
+            now = self.tick + 1
+            index = now & SLOT_MASK
+            if index == 0:
+                self._cascade(now)
+            self.tick = now
+            slot = self.wheels[0][index]
+            if not slot:
+                continue
+            self.wheels[0][index] = []
+            for timer in slot:
+                if not timer.pending:
+                    continue
+                if timer.interval:
+                    timer.expires = now + timer.interval
+                    self._insert(timer, now)
+                else:
+                    timer.pending = False
+                if timer.callback is not None:
+                    timer.callback(*timer.args)
+
+    def clear(self):
+        """
+        登録されているタイマーをすべて破棄する
+        """
+        for wheel in self.wheels:
+            for slot in wheel:
+                for timer in slot:
+                    timer.pending = False
+                slot.clear()
+
+    def save(self):
+        """
+        ロールバック用に、発火待ちのタイマーとその位置を記録する
+        Timerオブジェクトはそのまま使い回すので、呼び出し側が持っている参照も
+        load()の後にそのまま使える
+        """
+        saved = []
+        for level, wheel in enumerate(self.wheels):
+            for index, slot in enumerate(wheel):
+                for timer in slot:
+                    if timer.pending:
+                        saved.append((level, index, timer, timer.expires, timer.interval))
+        return self.tick, saved
+
+    def load(self, state):
+        """
+        save()した時点の状態に戻す。その後に登録されたタイマーは破棄される
+        """
+        self.clear()
+        self.tick, saved = state
+        wheels = self.wheels
+        for level, index, timer, expires, interval in saved:
+            timer.expires = expires
+            timer.interval = interval
+            timer.pending = True
+            wheels[level][index].append(timer)
+
+    def next_expiry(self):
+        """
+        発火待ちのタイマーのうち一番早いものの発火tick。なければNone
+        全スロットを見るので毎tickではなく、しばらく何も起きないかを調べるときに使う
+        """
+        expires = [timer.expires for wheel in self.wheels for slot in wheel for timer in slot if timer.pending]
+        return min(expires) if expires else None
+
+    def find(self, callback):
+        """
+        callbackを呼ぶ発火待ちのタイマーを1つ返す。なければNone
+        """
+        for wheel in self.wheels:
+            for slot in wheel:
+                for timer in slot:
+                    if timer.pending and timer.callback == callback:
+                        return timer
+        return None
+
+    def pack(self, callbacks):
+        """
+        発火待ちのタイマーをバイト列にする
+        コールバックは関数そのものではなくcallbacksの中の番号で記録するので、
+        callbacksにないコールバックや、整数1つより多い引数を持つタイマーは記録できない
+        """
+        tick, saved = self.save()
+        parts = [PACKED.pack(tick, len(saved))]
+        for level, index, timer, expires, interval in saved:
+            number = 0 if timer.callback is None else callbacks.index(timer.callback) + 1
+            args = timer.args
+            parts.append(PACKED_TIMER.pack(level, index, expires, interval, number, len(args), args[0] if args else 0))
+        return b"".join(parts)
+
+    def unpack(self, data, callbacks, offset=0):
+        """
+        pack()したバイト列から状態を戻す。Timerオブジェクトは作り直す
+        戻り値: 読み終わった位置
+        """
+        self.clear()
+        self.tick, count = PACKED.unpack_from(data, offset)
+        offset += PACKED.size
+        wheels = self.wheels
+        for level, index, expires, interval, number, nargs, arg in PACKED_TIMER.iter_unpack(
+            data[offset:offset + PACKED_TIMER.size * count]
+        ):
+            callback = callbacks[number - 1] if number else None
+            wheels[level][index].append(Timer(expires, interval, callback, (arg,) if nargs else ()))
+        return offset + PACKED_TIMER.size * count
+
+    def _insert(self, timer, now):
+        delta = timer.expires - now
+        for level in range(LEVELS):
+            if delta < 1 << (SLOT_BITS * (level + 1)):
+                index = (timer.expires >> (SLOT_BITS * level)) & SLOT_MASK
+                self.wheels[level][index].append(timer)
+                return
+        # 表現できる範囲を超えたら一番上の段の最後に入れ、カスケード時に入れ直す
+        level = LEVELS - 1
+        expires = now + (1 << (SLOT_BITS * LEVELS)) - 1
+        index = (expires >> (SLOT_BITS * level)) & SLOT_MASK
+        self.wheels[level][index].append(timer)
+
+    def _cascade(self, now):
+        """
+        下の段が一周したら、上の段の該当スロットを下の段に振り分け直す
+        """
+        for level in range(1, LEVELS):
+            index = (now >> (SLOT_BITS * level)) & SLOT_MASK
+            slot = self.wheels[level][index]
+            self.wheels[level][index] = []
+            for timer in slot:
+                if timer.pending:
+                    self._insert(timer, now)
+            if index != 0:
+                break
@@ -0,0 +1,148 @@
+"""
+aliens.pyのウェーブ(レベル)ごとの出現・爆弾の予定表
+
+エイリアンの出現と爆弾の投下を毎フレーム乱数で決めるのをやめ、レベルに入るときに
+そのレベルの全tick分の予定をまとめて作っておく。毎フレームの処理は
+「次の予定のtickに達したか」を添字で比べるだけになる。
+
+予定は (種, レベルの番号) だけで決まるので、同じ種なら何度遊んでも同じ
+ウェーブになり、途中のレベルだけを取り出して再現・計測することもできる。
+レベルが上がるほど出現と投下の間隔が短くなる。
+"""
+
+import math
+import random
+from array import array
+
+import telemetry
+
+
+class Level:
+    """
+    1レベル分の予定
+    number : レベルの番号 (0から)
+    start : 始まるtick
+    length : 続くtick数
+    spawns : エイリアンが出現するtick (昇順)
+    facings : 出現したエイリアンの向き (-1: 左へ, 1: 右へ)。spawnsと同じ並び
+    bombs : 爆弾を落とすtick (昇順)
+    """
+
+    def __init__(self, number, start, length):
+        self.number = number
+        self.start = start
+        self.length = length
+        self.spawns = array("q")
+        self.facings = array("b")
+        self.bombs = array("q")
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+
+class WaveSchedule:
+    """
+    レベルごとの予定を作る
+    seed : 乱数の種
+    level_ticks : 1レベルのtick数
+    alien_odds : レベル0で、1tickあたりエイリアンが出現する確率の逆数
+    bomb_odds : レベル0で、1tickあたり爆弾を落とす確率の逆数
+    alien_reload : エイリアンが出現してから次が出現できるまでのtick数
+    escalation : レベルが1つ上がるごとにoddsに掛ける値 (1より小さいほど速く難しくなる)
+    min_alien_odds, min_bomb_odds : oddsの下限
+    """
+
+    def __init__(self, seed=0, level_ticks=800, alien_odds=22, bomb_odds=60, alien_reload=12,
+                 escalation=0.85, min_alien_odds=4, min_bomb_odds=10):
+        self.seed = seed
+        self.level_ticks = level_ticks
+        self.alien_odds = alien_odds
+        self.bomb_odds = bomb_odds
+        self.alien_reload = alien_reload
+        self.escalation = escalation
+        self.min_alien_odds = min_alien_odds
+        self.min_bomb_odds = min_bomb_odds
+
+    def odds(self, number):
+        """
+        レベルnumberの (出現のodds, 投下のodds)
+        """
+        scale = self.escalation ** number
+        return max(self.min_alien_odds, self.alien_odds * scale), max(self.min_bomb_odds, self.bomb_odds * scale)
+
+    def level(self, number):
+        """
+        レベルnumberの予定を作る
+        毎tick 1/odds の確率で起きることを、次に起きるまでのtick数(幾何分布)を
+        直接引いて並べるので、乱数はtickごとではなく出来事ごとに1回しか引かない
+        """
+        rng = random.Random(self.seed * 1000003 + number)
+        level = Level(number, number * self.level_ticks, self.level_ticks)
+        alien_odds, bomb_odds = self.odds(number)
+        end = level.end
+        tick = level.start  # ウェーブはエイリアン1体から始まる
+        while tick < end:
+            level.spawns.append(tick)
+            level.facings.append(rng.choice((-1, 1)))
+            tick += self.alien_reload + gap(rng, alien_odds)
+        tick = level.start + gap(rng, bomb_odds)
+        while tick < end:
+            level.bombs.append(tick)
+            tick += 1 + gap(rng, bomb_odds)
+        return level
+
+
+def gap(rng, odds):
+    """
+    毎tick 1/odds の確率で起きることが、次に起きるまでに起きなかったtick数
+    """
+    if odds <= 1:
+        return 0
+    return int(math.log(1.0 - rng.random()) / math.log(1.0 - 1.0 / odds))
+
+
+class WaveCursor:
+    """
+    予定表を先頭から順に読んでいくカーソル
+    advance(tick) を毎フレーム1回呼び、そのtickの出来事を受け取る
+    レベルの終わりに達したら次のレベルの予定を作る
+    level : 始めるレベル
+    tick : 始めるときのゲームのtick。予定のtickとの差はずっと保つ
+    """
+
+    def __init__(self, schedule, level=0, tick=0):
+        self.schedule = schedule
+        self.enter(schedule.level(level))
+        self.offset = self.level.start - tick
+
+    def enter(self, level):
+        self.level = level
+        self.spawn_index = 0
+        self.bomb_index = 0
+        telemetry.emit(
+            "wave_start", level=level.number, tick=level.start,
+            spawns=len(level.spawns), bombs=len(level.bombs),
+        )
+
+    def advance(self, tick):
+        """
+        tickまで予定を進める
+        戻り値: (出現するエイリアンの向き。出現しなければ0, 爆弾を落とすならTrue)
+        """
+        tick += self.offset
+        level = self.level
+        while tick >= level.end:
+            self.enter(self.schedule.level(level.number + 1))
+            level = self.level
+        facing = 0
+        spawns = level.spawns
+        while self.spawn_index < len(spawns) and spawns[self.spawn_index] <= tick:
+            facing = level.facings[self.spawn_index]
+            self.spawn_index += 1
+        bomb = False
+        bombs = level.bombs
+        while self.bomb_index < len(bombs) and bombs[self.bomb_index] <= tick:
+            bomb = True
+            self.bomb_index += 1
+        return facing, bomb